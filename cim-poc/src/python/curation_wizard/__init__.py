@@ -1,4 +1,4 @@
 from .curation_wizard import CurationWizard
 from .curation_sales_order import CurationSalesOrder
 from .curation_soldto_account import CurationSoldToAccount
-from . import preprocess_loc_row
\ No newline at end of file
+from . import executors, preprocess_loc_row
\ No newline at end of file
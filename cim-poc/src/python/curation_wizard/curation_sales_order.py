@@ -127,9 +127,11 @@ class CurationSalesOrder(CurationWizard):
         contains_street_suffix_mask = super().smart_apply(
             df.OPS_STREET,
             super().contains_street_suffix,
+            unique=True,
         )
 
-        first_token_valid_streetnum_mask = super().smart_apply(df.OPS_STREET, super().first_token_is_valid_streetnum)
+        first_token_valid_streetnum_mask = super().smart_apply(df.OPS_STREET, super().first_token_is_valid_streetnum,
+                                                               unique=True)
 
         is_intersection_mask = df["IS_INTERSECTION"]
 
@@ -143,6 +145,7 @@ class CurationSalesOrder(CurationWizard):
         df["OPS_STREET"] = super().smart_apply(
             df["OPS_STREET"],
             super().remove_garbage_after_suffix,
+            unique=True,
         )
 
         if not simple_mode:
@@ -157,8 +160,8 @@ class CurationSalesOrder(CurationWizard):
                 GEOCODE_ACCURACY=pd.NA
             )
 
-        road_names = set(USPS_DICT.values())
-        df["OPS_STREET"] = super().smart_apply(df["OPS_STREET"], super().clean_final_street_address, args=(road_names,))
+        road_names = frozenset(USPS_DICT.values())
+        df["OPS_STREET"] = super().clean_final_street_address_series(df["OPS_STREET"], road_names)
 
         df["OPS_LOC_NAME"] = (
                 df["ORGANIZATION_ID"].astype(str) + " @ " + df["OPS_STREET"] + " " + df["OPS_SUBLOCATION"].fillna("")
@@ -109,15 +109,18 @@ class CurationSoldToAccount(CurationWizard):
         contains_street_suffix_mask = CurationWizard.smart_apply(
             df.OPS_STREET,
             CurationWizard.contains_street_suffix,
+            unique=True,
         )
 
-        first_token_valid_streetnum_mask = super().smart_apply(df.OPS_STREET, super().first_token_is_valid_streetnum)
+        first_token_valid_streetnum_mask = super().smart_apply(df.OPS_STREET, super().first_token_is_valid_streetnum,
+                                                               unique=True)
 
         df = df[(contains_street_suffix_mask & first_token_valid_streetnum_mask) | is_pobox_mask]
 
         df["OPS_STREET"] = super().smart_apply(
             df["OPS_STREET"],
             super().remove_garbage_after_suffix,
+            unique=True,
         )
 
         if not simple_mode:
@@ -132,8 +135,8 @@ class CurationSoldToAccount(CurationWizard):
                 GEOCODE_ACCURACY=pd.NA
             )
 
-        road_names = set(USPS_DICT.values())
-        df["OPS_STREET"] = super().smart_apply(df["OPS_STREET"], super().clean_final_street_address, args=(road_names,))
+        road_names = frozenset(USPS_DICT.values())
+        df["OPS_STREET"] = super().clean_final_street_address_series(df["OPS_STREET"], road_names)
         df["OPS_CITY"] = df["OPS_CITY"].str.title()
 
         df["OPS_LOC_NAME"] = (
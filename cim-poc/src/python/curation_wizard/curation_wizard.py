@@ -1,29 +1,25 @@
 from abc import abstractmethod
 from curses.ascii import US
+from functools import lru_cache
 import re
 import time
 
 import numpy as np
-import pandarallel
 import pandas as pd
 from fuzzywuzzy.fuzz import ratio
-from timeout_decorator import timeout
 from uszipcode import SearchEngine
 from toolz import compose
 
 import geocode
-from curation_wizard import preprocess_loc_row
+from curation_wizard import executors, preprocess_loc_row
 from curation_wizard.preprocess_loc_row import ADDRESS_DICT, SPANISH_STREET_SUFFIXES, VALID_STREET_SUFFIXES, \
     VALID_DIRECTIONS
-from loggers import get_logger, timer
+from loggers import get_logger, timer, timer_metrics
 from scopes import ScopeBase
 from utils.usaddress_util import get_number_street
 
-pandarallel.pandarallel.initialize(use_memory_fs=False)
-
 logger = get_logger("CURATION-WIZARD")
 
-MIN_LEN_PARALLEL = 100000
 USZIP_ENG = SearchEngine()
 
 # construct regular expressions
@@ -41,6 +37,7 @@ MARKER_BASE_DICT = {
     "DOOR": r"DOOR",
     "GSTORE": r"GSTORE",
 }
+OPS_MARKER_CACHE_SIZE = 2**14
 
 POBOX_PATTERN = re.compile(r"^\s*P\.?\s?O\.?\s?B\s?[0O]?\s?X?\s?(\d+)\s*$", flags=re.IGNORECASE)
 INTERSTATE_PATTERN = re.compile(r"^(.*)\sIN?T?E?R?S?T?A?T?E?\s(\d+)", flags=re.IGNORECASE)
@@ -51,6 +48,59 @@ VALID_SUFFIXLESS_STREETNAMES = [
     "concourse"
 ]
 
+INTERSECTION_KEYWORDS = "(?:st|street|ave|avenue|pier|blvd|rd|ln|lane|road|drive|dr|jn|junction|fm|farmtomarket|east|west|north|south)"
+INTERSECTION_PATTERNS = [
+    # US - 191 & AZ - 264  |||   US - NUMBER AND & (2 OR 3 CHARS) - NUMBER(2 OR 3
+    # Rule 1: Starts with US-NUMBER then any character any number of times
+    re.compile(r"^US.?[0-9][0-9].*(?:and|&).*[0-9][0-9]$", flags=re.IGNORECASE),
+    # Hwy 59 & Conde St ||| hwy 59 & (CHARS)( kw - st / street / ave / avenue / peier / blvd / rd /
+    # ln / lane / road / drive / dr / jn / junction / fm / farmtomarket)
+    # Rule 2
+    re.compile(f"^(?:hwy|highway).?[0-9][0-9].*(?:and|&).*{INTERSECTION_KEYWORDS}$", flags=re.IGNORECASE),
+    # I 26 & Hwy 21 South
+    # I(number, 2 or 3) & ({hwy - (number) / ave / junction / rd / lane….or (number-chars)
+    # Rule 3
+    re.compile(f"^I.?[0-9][0-9].*(?:and|&).?(?:hwy|highway).?[0-9][0-9].?{INTERSECTION_KEYWORDS}$", flags=re.IGNORECASE),
+    # Rule 4
+    # East Hwy 160 And Warrior Drive ||||
+    re.compile(r"^.*(?:hwy|highway).?[0-9][0-9].*(?:and|&).*$", flags=re.IGNORECASE),
+]
+
+# e.g. "10 Street Avenue" -> "10st Avenue", applied in this order
+ORDINAL_STREET_SUFFIXES = [
+    ("Street", "st"),
+    ("Road", "rd"),
+    ("Th", "th"),
+    ("Nd", "nd"),
+]
+# cheap check for the streets worth running the road name alternations on
+ORDINAL_STREET_HINT_PATTERN = re.compile(r"\d (?:Street|Road|Th|Nd) ")
+
+
+@lru_cache(maxsize=16)
+def ordinal_street_patterns(roadnames: frozenset) -> list:
+    """
+    Compiles the (pattern, replacement) pairs used by clean_final_street_address once per
+    set of road names. Replacements are callables, a template string would be re-parsed
+    against the (large) compiled pattern on every substitution.
+    """
+    alternation = "|".join(roadnames)
+    return [
+        (re.compile(rf"(\d+) {ordinal} ({alternation})"), lambda match, suffix=suffix: f"{match[1]}{suffix} {match[2]}")
+        for ordinal, suffix in ORDINAL_STREET_SUFFIXES
+    ]
+
+
+@lru_cache(maxsize=OPS_MARKER_CACHE_SIZE)
+def compile_ops_marker(ops_marker: str) -> re.Pattern:
+    """ Compiled form of an OPS_MARKER string, shared by every candidate that is matched against it """
+    return re.compile(ops_marker, flags=re.IGNORECASE)
+
+
+def normalize_sublocation(sublocation_lvl1: str) -> str:
+    # a whitespace only sublocation stays distinct from an empty one, infer_ops_marker gives it an empty marker
+    return " ".join(sublocation_lvl1.split()) or sublocation_lvl1[:1]
+
 
 class CurationWizard:
     """ Super class for all curation wizards """
@@ -62,10 +112,12 @@ class CurationWizard:
             self,
             geocode_accuracy_thresh=0.0,
             auto_label: bool = False,
-            simple_mode: bool = False
+            simple_mode: bool = False,
+            dim_df: pd.DataFrame = None
     ):
+        """ Curates the dim records of the scope, dim_df can be passed when they were already fetched """
 
-        df = self.scope.get_dim()
+        df = self.scope.get_dim() if dim_df is None else dim_df
         df = self.preprocess_dim(df)
         df = self.precurate_df(df)
 
@@ -85,10 +137,40 @@ class CurationWizard:
         pass
 
     @staticmethod
-    def smart_apply(series: pd.Series, func: callable, **kws):
-        if len(series) < MIN_LEN_PARALLEL:
-            return series.apply(func, **kws)
-        return series.parallel_apply(func, **kws)
+    def smart_apply(series: pd.Series, func: callable, unique: bool = False, backend: str = None, **kws):
+        """
+        Applies func to a series, in parallel when the estimated runtime is worth it.
+        backend overrides the SMART_APPLY_BACKEND setting for this call, see
+        curation_wizard.executors. With unique=True, func must be a pure function of a
+        single value; it is then only evaluated on the distinct values of the series
+        and the results are broadcast back.
+        """
+        if unique:
+            return CurationWizard.unique_apply(series, func, backend=backend, **kws)
+        return executors.parallel_apply(series, func, backend=backend, **kws)
+
+    @staticmethod
+    @timer(logger)
+    def unique_apply(series: pd.Series, func: callable, backend: str = None, **kws):
+        codes, uniques = pd.factorize(series)
+        uniques = pd.Series(uniques, dtype=object)
+
+        # factorize drops missing values, evaluate them once as an extra unique value
+        missing = codes < 0
+        if missing.any():
+            codes[missing] = len(uniques)
+            uniques = pd.concat([uniques, pd.Series([series[missing].iloc[0]], dtype=object)], ignore_index=True)
+
+        # the distinct values may still be numerous enough to run in parallel
+        values = CurationWizard.smart_apply(uniques, func, backend=backend, **kws)
+
+        n_rows, n_unique = len(series), len(uniques)
+        timer_metrics(
+            func_applied=getattr(func, "__name__", str(func)),
+            n_unique=n_unique,
+            hit_ratio=1 - n_unique / n_rows if n_rows > 0 else 0.0,
+        )
+        return pd.Series(values.to_numpy()[codes], index=series.index, name=series.name)
 
     @staticmethod
     def precurate_df(df):
@@ -106,29 +188,23 @@ class CurationWizard:
 
         df = df.fillna("").reset_index(drop=True)
 
-        df["ADDRESS"], df["SUBLOCATION_LVL1"], df["SUBLOCATION_LVL2"] = zip(
-            *CurationWizard.smart_apply(df,
-                                        lambda row: preprocess_loc_row.infer_address_and_sublocations(
-                                            row.STREET_NUM,
-                                            row.STREET,
-                                            row.DEPARTMENT,
-                                            row.ATTENTION,
-                                            row.SUPPLEMENTAL,
-                                            row.RECEIVER,
-                                        ),
-                                        axis=1,
-                                        )
-        )
+        df["ADDRESS"], df["SUBLOCATION_LVL1"], df["SUBLOCATION_LVL2"] = \
+            preprocess_loc_row.infer_addresses_and_sublocations(
+                df.STREET_NUM,
+                df.STREET,
+                df.DEPARTMENT,
+                df.ATTENTION,
+                df.SUPPLEMENTAL,
+                df.RECEIVER,
+            )
 
         df["ADDRESS"] = CurationWizard.smart_apply(
             df["ADDRESS"],
-            CurationWizard.handle_special_addresses
+            CurationWizard.handle_special_addresses,
+            unique=True,
         )
 
-        df["IS_INTERSECTION"] = CurationWizard.smart_apply(
-            df["ADDRESS"],
-            CurationWizard.handle_intersections
-        )
+        df["IS_INTERSECTION"] = CurationWizard.handle_intersections_series(df["ADDRESS"])
 
         statistical_dict = CurationWizard.generate_statistical_dict(
             df["ADDRESS"],
@@ -137,13 +213,10 @@ class CurationWizard:
             order_switch=True,
         )
 
-        df["ADDRESS"] = CurationWizard.smart_apply(df["ADDRESS"],
-                                                   lambda address: CurationWizard.apply_statistical_dict(address,
-                                                                                                         statistical_dict)
-                                                   )
+        df["ADDRESS"] = CurationWizard.apply_statistical_dict_series(df["ADDRESS"], statistical_dict)
 
         # Add OPS_MARKER
-        df["OPS_MARKER"] = CurationWizard.smart_apply(df["SUBLOCATION_LVL1"], CurationWizard.infer_ops_marker)
+        df["OPS_MARKER"] = CurationWizard.smart_apply(df["SUBLOCATION_LVL1"], CurationWizard.cached_ops_marker, unique=True)
 
         # Adds columns representing how many times value is seen in data
         df["ADDRESS_cnt"] = df.groupby("ADDRESS").STREET.transform("count")
@@ -210,6 +283,41 @@ class CurationWizard:
             ops_marker = pd.NA
         return ops_marker
 
+    @staticmethod
+    def cached_ops_marker(sublocation_lvl1: str):
+        """ infer_ops_marker, memoized on the whitespace normalized sublocation """
+        return CurationWizard._normalized_ops_marker(normalize_sublocation(sublocation_lvl1))
+
+    @staticmethod
+    @lru_cache(maxsize=OPS_MARKER_CACHE_SIZE)
+    def _normalized_ops_marker(sublocation_lvl1: str):
+        return CurationWizard.infer_ops_marker(sublocation_lvl1)
+
+    @staticmethod
+    def infer_ops_marker_pattern(sublocation_lvl1: str) -> tuple:
+        """
+        Returns the OPS_MARKER string of a sublocation together with its compiled pattern,
+        or (pd.NA, None) if the sublocation has no marker. Both are cached, so repeated
+        sublocations neither rebuild nor recompile their marker.
+        """
+        ops_marker = CurationWizard.cached_ops_marker(sublocation_lvl1)
+        if pd.isna(ops_marker):
+            return ops_marker, None
+        return ops_marker, compile_ops_marker(ops_marker)
+
+    @staticmethod
+    def ops_marker_patterns(ops: pd.DataFrame, id_col: str = "ID") -> dict:
+        """
+        Compiled OPS_MARKER of every marked OPS location, keyed by id_col. Markers are
+        compiled once per distinct string, so matching code can look them up per
+        candidate pair without recompiling.
+        """
+        marked = ops[ops["OPS_MARKER"].notna() & (ops["OPS_MARKER"] != "")]
+        return {
+            ops_id: compile_ops_marker(ops_marker)
+            for ops_id, ops_marker in zip(marked[id_col], marked["OPS_MARKER"])
+        }
+
     # Generates a dict of {tokenized_address -> fixed_address} based on the whole address population
     @staticmethod
     def generate_statistical_dict(
@@ -419,7 +527,6 @@ class CurationWizard:
                 ops_df[col] = ops_df[col].astype(str)
         return ops_df
 
-    @timeout(60 * 30)
     def apply_geocoding_steps(self, df, geocode_accuracy_thresh):
         # check if addresses are geocodable
         logger.info(f"Batch geocoding {df.shape[0]} records")
@@ -487,12 +594,56 @@ class CurationWizard:
 
     @staticmethod
     def apply_statistical_dict(address, statistical_dict_dict):
-        while tuple(preprocess_loc_row.tokenize(address)) in statistical_dict_dict.keys():
-            address = statistical_dict_dict.get(
-                tuple(preprocess_loc_row.tokenize(address)), address
-            )
+        seen = set()
+        tokens = tuple(preprocess_loc_row.tokenize(address))
+        while tokens in statistical_dict_dict and tokens not in seen:
+            seen.add(tokens)
+            address = statistical_dict_dict[tokens]
+            tokens = tuple(preprocess_loc_row.tokenize(address))
         return address
 
+    # Collapses chains in the statistical dict, e.g. {A: "B", B: "C"} -> {A: "C", B: "C"},
+    # so that every key maps straight to its final address.
+    @staticmethod
+    def resolve_statistical_dict(statistical_dict):
+        resolved = {}
+        for key in statistical_dict:
+            if key in resolved:
+                continue
+
+            path = []
+            on_path = set()
+            tokens = key
+            while True:
+                if tokens in resolved:
+                    address = resolved[tokens]
+                    break
+                if tokens not in statistical_dict:
+                    break
+                if tokens in on_path:
+                    logger.warning(f"Cycle in statistical dict, stopping at '{address}'")
+                    break
+                path.append(tokens)
+                on_path.add(tokens)
+                address = statistical_dict[tokens]
+                tokens = tuple(preprocess_loc_row.tokenize(address))
+
+            for tokens in path:
+                resolved[tokens] = address
+
+        return resolved
+
+    @staticmethod
+    @timer(logger)
+    def apply_statistical_dict_series(address_series: pd.Series, statistical_dict):
+        """ Applies the statistical dict once per distinct address rather than per row """
+        resolved = CurationWizard.resolve_statistical_dict(statistical_dict)
+        mapping = {
+            address: resolved.get(tuple(preprocess_loc_row.tokenize(address)), address)
+            for address in address_series.unique()
+        }
+        return address_series.map(mapping)
+
     # Generates a dict that adds a missing token to the address, if the version with the added token
     # is more common than the version without that token, for such tokens that exist in the input dict values.
     #
@@ -546,33 +697,49 @@ class CurationWizard:
     def generate_order_switch_dict(df):
         df["sorted"] = CurationWizard.smart_apply(df["tokens"], lambda tokens: tuple(sorted(tokens)))
 
-        df["sorted_cnt"] = df.groupby("sorted").address.transform("count")
+        # integer group ids avoid grouping on (variable length) tuples directly
+        df["sorted_group"] = pd.factorize(df["sorted"])[0]
+
+        df["sorted_cnt"] = df.groupby("sorted_group").address.transform("count")
         df = df[df["sorted_cnt"] > 1]
-        order_switch_dict = {}
-
-        for index, row in df.iterrows():
-            most_common_address_with_same_sorted = (
-                df[df["sorted"] == row["sorted"]]
-                .sort_values("cnt", ascending=False)
-                .reset_index(drop=True)
-                .iloc[0]
-                .address
-            )
-            if row.address != most_common_address_with_same_sorted:
-                order_switch_dict[row.tokens] = most_common_address_with_same_sorted
 
-        return order_switch_dict
+        # first row with the highest count in each group is the most common order
+        most_common_rows = df.groupby("sorted_group")["cnt"].idxmax()
+        most_common_address = pd.Series(
+            df.loc[most_common_rows.values, "address"].values,
+            index=most_common_rows.index,
+        )
+        df = df.assign(most_common=df["sorted_group"].map(most_common_address))
+        df = df[df["address"] != df["most_common"]]
+
+        return dict(zip(df["tokens"], df["most_common"]))
 
     @staticmethod
     def clean_final_street_address(street: str, roadnames):
+        if not ORDINAL_STREET_HINT_PATTERN.search(street):
+            return street
 
-        street = re.sub(rf"(\d+) Street ({'|'.join(roadnames)})", r"\1st \2", street)
-        street = re.sub(rf"(\d+) Road ({'|'.join(roadnames)})", r"\1rd \2", street)
-        street = re.sub(rf"(\d+) Th ({'|'.join(roadnames)})", r"\1th \2", street)
-        street = re.sub(rf"(\d+) Nd ({'|'.join(roadnames)})", r"\1nd \2", street)
+        for pattern, replacement in ordinal_street_patterns(frozenset(roadnames)):
+            street = pattern.sub(replacement, street)
 
         return street
 
+    @staticmethod
+    def clean_final_street_address_series(streets: pd.Series, roadnames) -> pd.Series:
+        """ Column-wise clean_final_street_address, only the distinct streets that may need cleaning are rewritten """
+        hint = streets.str.contains(ORDINAL_STREET_HINT_PATTERN, na=False).to_numpy(dtype=bool)
+        if not hint.any():
+            return streets
+
+        codes, uniques = pd.factorize(streets[hint])
+        cleaned = pd.Series(uniques, dtype=object)
+        for pattern, replacement in ordinal_street_patterns(frozenset(roadnames)):
+            cleaned = cleaned.str.replace(pattern, replacement, regex=True)
+
+        streets = streets.copy()
+        streets[hint] = cleaned.to_numpy()[codes]
+        return streets
+
     @staticmethod
     def coalesce(tuples):
         return tuple(sum(map(list, tuples), start=list()))
@@ -593,36 +760,29 @@ class CurationWizard:
 
     @staticmethod
     def handle_intersections(address: str):
-        lst_kw = "(st|street|ave|avenue|pier|blvd|rd|ln|lane|road|drive|dr|jn|junction|fm|farmtomarket|east|west|north|south)"
-
-        # US - 191 & AZ - 264  |||   US - NUMBER AND & (2 OR 3 CHARS) - NUMBER(2 OR 3
-        # Rule 1: Starts with US-NUMBER then any character any number of times
-        if re.search("^US.?[0-9][0-9].*(and|&).*[0-9][0-9]$", address, re.IGNORECASE):
+        if any(pattern.search(address) for pattern in INTERSECTION_PATTERNS):
             return True
 
-        # Hwy 59 & Conde St ||| hwy 59 & (CHARS)( kw - st / street / ave / avenue / peier / blvd / rd /
-        # ln / lane / road / drive / dr / jn / junction / fm / farmtomarket)
-        # Rule 2
-        elif re.search(f"^(hwy|highway).?[0-9][0-9].*(and|&).*{lst_kw}$", address, re.IGNORECASE):
-            return True
-
-        # I 26 & Hwy 21 South
-        # I(number, 2 or 3) & ({hwy - (number) / ave / junction / rd / lane….or (number-chars)
-        # Rule 3
-        elif re.search(f"^I.?[0-9][0-9].*(and|&).?(hwy|highway).?[0-9][0-9].?{lst_kw}$", address, re.IGNORECASE):
-            return True
+        # Rule 5: Starts with int
+        return address.lower().startswith("int")
 
-        # Rule 4
-        # East Hwy 160 And Warrior Drive ||||
-        elif re.search(f"^.*(hwy|highway).?[0-9][0-9].*(and|&).*$", address, re.IGNORECASE):
-            return True
+    @staticmethod
+    def handle_intersections_series(addresses: pd.Series) -> pd.Series:
+        """
+        Column-wise handle_intersections. Rules are evaluated once per distinct address,
+        and each rule only on the addresses no earlier rule matched.
+        """
+        codes, uniques = pd.factorize(addresses)
+        uniques = pd.Series(uniques, dtype=object)
 
-        # Rule 5: Starts with int
-        elif address.lower().startswith("int"):
-            return True
+        is_intersection = uniques.str.lower().str.startswith("int", na=False).to_numpy(dtype=bool)
+        for pattern in INTERSECTION_PATTERNS:
+            rest = ~is_intersection
+            is_intersection[rest] = uniques[rest].str.contains(pattern, na=False).to_numpy(dtype=bool)
 
-        else:
-            return False
+        # missing addresses (code -1) are never intersections
+        is_intersection = np.append(is_intersection, False)
+        return pd.Series(is_intersection[codes], index=addresses.index, name=addresses.name)
 
     @classmethod
     def handle_special_addresses(cls, address: str):
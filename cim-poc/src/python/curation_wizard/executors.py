@@ -0,0 +1,181 @@
+"""
+Executor backends for CurationWizard.smart_apply.
+
+Every backend applies a function to a series (or dataframe, with axis=1) and
+returns the same result as a plain serial `apply`. The "auto" backend times
+func on a sample of the series and only pays the cost of spinning up workers
+when the estimated serial runtime justifies it.
+
+Curation runs next to the pipeline, geocode broker and queue heartbeat threads,
+which may hold locks (logging, pooled connections) at any time. A forked child
+inherits those locks held and can deadlock on them, so the process pool spawns
+its workers, and auto never picks pandarallel, which forks, while other threads run.
+
+Configuration (environment variables):
+    SMART_APPLY_BACKEND                 auto | serial | thread | process | pandarallel
+    SMART_APPLY_WORKERS                 number of workers for the parallel backends
+    SMART_APPLY_MIN_PARALLEL_SECONDS    estimated serial runtime under which auto stays serial
+    SMART_APPLY_MIN_ITEM_SECONDS        per-item cost under which auto stays serial
+    SMART_APPLY_SAMPLE_SIZE             number of items auto times before choosing
+"""
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from loggers import get_logger
+
+logger = get_logger("SMART-APPLY")
+
+BACKEND = os.getenv("SMART_APPLY_BACKEND", "auto")
+N_WORKERS = int(os.getenv("SMART_APPLY_WORKERS", os.cpu_count() or 1))
+MIN_PARALLEL_SECONDS = float(os.getenv("SMART_APPLY_MIN_PARALLEL_SECONDS", 5.0))
+# below this per-item cost, pickling the item to a worker costs more than the work itself
+MIN_ITEM_SECONDS = float(os.getenv("SMART_APPLY_MIN_ITEM_SECONDS", 20e-6))
+SAMPLE_SIZE = int(os.getenv("SMART_APPLY_SAMPLE_SIZE", 200))
+CHUNKS_PER_WORKER = 4
+
+
+def split_chunks(series, n_chunks: int) -> list:
+    """ Splits a series or dataframe into at most n_chunks contiguous, non-empty chunks """
+    n_chunks = max(1, min(n_chunks, len(series)))
+    bounds = np.linspace(0, len(series), n_chunks + 1).astype(int)
+    return [series.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _apply_chunk(chunk, func: callable, kws: dict):
+    return chunk.apply(func, **kws)
+
+
+def is_picklable(func: callable) -> bool:
+    try:
+        pickle.dumps(func)
+    except Exception:
+        return False
+    return True
+
+
+class SerialExecutor:
+    name = "serial"
+
+    def apply(self, series, func: callable, **kws):
+        return series.apply(func, **kws)
+
+
+class ThreadExecutor:
+    """ Only pays off for functions that release the GIL (I/O, numpy, C extensions) """
+    name = "thread"
+
+    def __init__(self, n_workers: int = N_WORKERS):
+        self.n_workers = n_workers
+        self._pool = None
+
+    def apply(self, series, func: callable, **kws):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_workers)
+        chunks = split_chunks(series, self.n_workers)
+        return pd.concat(list(self._pool.map(_apply_chunk, chunks, [func] * len(chunks), [kws] * len(chunks))))
+
+
+class ProcessExecutor:
+    """
+    Sends contiguous chunks of the series to a persistent process pool, a few chunks
+    per worker so a slow chunk does not hold up the others. func must be picklable,
+    i.e. a module level function or a staticmethod, not a lambda.
+    """
+    name = "process"
+
+    def __init__(self, n_workers: int = N_WORKERS, chunks_per_worker: int = CHUNKS_PER_WORKER):
+        self.n_workers = n_workers
+        self.chunks_per_worker = chunks_per_worker
+        self._pool = None
+
+    def apply(self, series, func: callable, **kws):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context("spawn"))
+        chunks = split_chunks(series, self.n_workers * self.chunks_per_worker)
+        return pd.concat(list(self._pool.map(_apply_chunk, chunks, [func] * len(chunks), [kws] * len(chunks))))
+
+
+class PandarallelExecutor:
+    """
+    Uses pandarallel, which serializes func with dill and therefore also accepts lambdas.
+    Its workers are forked, only use it from a single threaded process.
+    """
+    name = "pandarallel"
+
+    def __init__(self, n_workers: int = N_WORKERS):
+        self.n_workers = n_workers
+        self._initialized = False
+
+    def apply(self, series, func: callable, **kws):
+        if not self._initialized:
+            # deferred so that importing the wizards does not fork workers or touch shared memory
+            from pandarallel import pandarallel
+            pandarallel.initialize(nb_workers=self.n_workers, use_memory_fs=False, progress_bar=False, verbose=1)
+            self._initialized = True
+        return series.parallel_apply(func, **kws)
+
+
+EXECUTORS = {
+    executor.name: executor
+    for executor in [SerialExecutor(), ThreadExecutor(), ProcessExecutor(), PandarallelExecutor()]
+}
+
+
+def get_executor(backend: str):
+    try:
+        return EXECUTORS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown smart_apply backend '{backend}', choose from {['auto'] + list(EXECUTORS)}")
+
+
+def choose_backend(
+    item_seconds: float,
+    n_items: int,
+    func: callable,
+    n_workers: int = N_WORKERS,
+    n_threads: int = None,
+) -> str:
+    """
+    Picks a backend from the measured per-item cost of func and the number of items left.
+    n_threads defaults to the threads alive in the process, with more than one forking is unsafe.
+    """
+    if n_workers <= 1 or item_seconds < MIN_ITEM_SECONDS or item_seconds * n_items < MIN_PARALLEL_SECONDS:
+        return "serial"
+    if is_picklable(func):
+        return "process"
+    n_threads = threading.active_count() if n_threads is None else n_threads
+    return "pandarallel" if n_threads <= 1 else "serial"
+
+
+def parallel_apply(series, func: callable, backend: str = None, **kws):
+    """
+    Applies func to series with the given backend, defaulting to SMART_APPLY_BACKEND.
+    In auto mode, func is first applied serially to a sample of the series; its results
+    are kept and the backend for the remaining items is chosen from the sample timing.
+    """
+    backend = backend or BACKEND
+    if backend != "auto":
+        return get_executor(backend).apply(series, func, **kws)
+
+    if len(series) <= SAMPLE_SIZE:
+        return EXECUTORS["serial"].apply(series, func, **kws)
+
+    t0 = time.perf_counter()
+    head = series.iloc[:SAMPLE_SIZE].apply(func, **kws)
+    item_seconds = (time.perf_counter() - t0) / SAMPLE_SIZE
+
+    rest = series.iloc[SAMPLE_SIZE:]
+    chosen = choose_backend(item_seconds, len(rest), func)
+    if chosen != "serial":
+        logger.info(
+            f"Applying {getattr(func, '__name__', func)} to {len(series)} items with the {chosen} backend "
+            f"({item_seconds * 1e6:.1f} us/item)"
+        )
+    return pd.concat([head, get_executor(chosen).apply(rest, func, **kws)])
@@ -1,10 +1,12 @@
 import json
 import os
 import re
+from functools import lru_cache
 
 import nltk
 import pandas as pd
 import numpy as np
+from nltk.tokenize.destructive import MacIntyreContractions
 from nltk.tokenize.treebank import TreebankWordDetokenizer
 
 IGNORED_CHARS = [
@@ -102,8 +104,21 @@ ADDITIONS_DICT = {
 
 REMOVED_ABBREVIATIONS = ["via"]
 
+NUMBER_REGEX = re.compile(r"([0-9]+(\.[0-9]+)?)")
 COORD_REGEX = re.compile(r"^([NSEW])?\s?(\d+)?\s?([NSEW])\s?(\d+)\s?(.*)$", flags=re.IGNORECASE)
 
+# Tokenizer backend used by `tokenize`, either "address" (default) or "nltk"
+TOKENIZER_BACKEND = os.getenv("TOKENIZER_BACKEND", "address")
+TOKENIZER_CACHE_SIZE = 2 ** 17
+
+# For strings made only of word characters, whitespace and "&", the NLTK Treebank
+# rules reduce to padding "&" and splitting on whitespace, except for a handful of
+# contractions (e.g. "cannot" -> "can", "not"). Anything else is handed to NLTK.
+ADDRESS_SAFE_REGEX = re.compile(r"[\w\s&]*")
+CONTRACTION_HINT_REGEX = re.compile(r"cannot|gimme|gonna|gotta|lemme|wanna", flags=re.IGNORECASE)
+CONTRACTION_REGEXES = [re.compile(pattern) for pattern in MacIntyreContractions.CONTRACTIONS2]
+DETOKENIZER_CONTRACTION_HINT_REGEX = re.compile(r"\b(can|d|gim|gon|got|lem|more|wan)\s", flags=re.IGNORECASE)
+
 USPS_JSON_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "usps.json")
 USPS_ES_JSON_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "usps_es.json")
 
@@ -124,14 +139,55 @@ VALID_DIRECTIONS = set(DIRECTIONS_DICT.values())
 def ignore_characters(street, ignored_chars):
     for char in ignored_chars:
         street = street.replace(char, " ")
-    street = re.sub(
-        r"([0-9]+(\.[0-9]+)?)", r" \1 ", street
+    street = NUMBER_REGEX.sub(
+        r" \1 ", street
     )  # Adds space between numerical and alphabetical chars
     return street
 
 
-def tokenize(street):
-    tokens = nltk.word_tokenize(street)
+def ignore_characters_series(streets, ignored_chars):
+    """Vectorized `ignore_characters` for a whole column of strings"""
+    streets = streets.fillna("").astype(str)
+    for char in ignored_chars:
+        streets = streets.str.replace(char, " ", regex=False)
+    return streets.str.replace(NUMBER_REGEX, r" \1 ", regex=True)
+
+
+def nltk_tokenize(street):
+    return nltk.word_tokenize(street)
+
+
+@lru_cache(maxsize=TOKENIZER_CACHE_SIZE)
+def _address_tokens(street):
+    if ADDRESS_SAFE_REGEX.fullmatch(street) is None:
+        return tuple(nltk.word_tokenize(street))
+
+    text = street.replace("&", " & ")
+    if CONTRACTION_HINT_REGEX.search(text):
+        text = f" {text} "
+        for regex in CONTRACTION_REGEXES:
+            text = regex.sub(r" \1 \2 ", text)
+    return tuple(text.split())
+
+
+def address_tokenize(street):
+    """Address tokenizer matching `nltk.word_tokenize` on address strings.
+
+    Plain strings are split with precompiled regexes, anything with punctuation
+    falls back to NLTK. Results are cached by the raw string, since the same
+    streets and supplemental fields repeat across many DIM rows.
+    """
+    return list(_address_tokens(street))
+
+
+TOKENIZER_BACKENDS = {
+    "address": address_tokenize,
+    "nltk": nltk_tokenize,
+}
+
+
+def tokenize(street, backend=None):
+    tokens = TOKENIZER_BACKENDS[backend or TOKENIZER_BACKEND](street)
     return tokens
 
 
@@ -228,11 +284,35 @@ def grab_relevant_tokens(known_tokens, potential_tokens, sublocation_dict):
     return grabbed
 
 
+@lru_cache(maxsize=TOKENIZER_CACHE_SIZE)
+def capitalize_token(token):
+    return " ".join([word.upper() if COORD_REGEX.match(word) else word.capitalize() for word in token.split(" ")])
+
+
+class AddressDetokenizer:
+    """Detokenizer matching `TreebankWordDetokenizer` on address tokens.
+
+    Treebank only rewrites punctuation and a few contractions (e.g. "can not"),
+    so plain address tokens are simply joined. Anything else is delegated to a
+    single shared TreebankWordDetokenizer.
+    """
+
+    def __init__(self):
+        self.treebank = TreebankWordDetokenizer()
+
+    def detokenize(self, tokens):
+        text = " ".join(tokens)
+        if ADDRESS_SAFE_REGEX.fullmatch(text) is None or DETOKENIZER_CONTRACTION_HINT_REGEX.search(text):
+            return self.treebank.detokenize(tokens)
+        return text.strip()
+
+
+ADDRESS_DETOKENIZER = AddressDetokenizer()
+
+
 def detokenize(tokens):
-    tokens = [
-        " ".join([word.upper() if COORD_REGEX.match(word) else word.capitalize() for word in token.split(" ")]) for token in tokens
-    ]
-    address = TreebankWordDetokenizer().detokenize(tokens)
+    tokens = [capitalize_token(token) for token in tokens]
+    address = ADDRESS_DETOKENIZER.detokenize(tokens)
     return address
 
 
@@ -252,6 +332,85 @@ def infer_address_and_sublocations(
         street, IGNORED_CHARS
     )  # Replaces listed characters with spaces, e.g. "Bldg.A" -> "Bldg A"
 
+    cleaned_strings = [
+        ignore_characters(string, IGNORED_CHARS)
+        for string in [department, attention, supplemental, receiver]
+    ]
+
+    return infer_address_and_sublocations_from_cleaned(
+        street_num, cleaned_street, *cleaned_strings
+    )
+
+
+# Batch version of infer_address_and_sublocations over whole DIM columns. Identical
+# input rows are only inferred once, and character cleanup runs column-wise.
+def infer_addresses_and_sublocations(
+    street_num,
+    street,
+    department="",
+    attention="",
+    supplemental="",
+    receiver="",
+):
+    """Infer ADDRESS, SUBLOCATION_LVL1 and SUBLOCATION_LVL2 for whole columns
+
+    Args:
+        street_num (pd.Series): STREET_NUM column
+        street (pd.Series): STREET column
+        department, attention, supplemental, receiver (pd.Series or str):
+            supplemental columns, or a scalar shared by every row
+
+    Returns:
+        tuple: (address, sublocation_lvl1, sublocation_lvl2) numpy arrays
+            aligned with the input rows
+    """
+    df = pd.DataFrame({
+        "STREET_NUM": street_num,
+        "STREET": street,
+        "DEPARTMENT": department,
+        "ATTENTION": attention,
+        "SUPPLEMENTAL": supplemental,
+        "RECEIVER": receiver,
+    })
+    if df.shape[0] == 0:
+        empty = np.array([], dtype=object)
+        return empty, empty.copy(), empty.copy()
+
+    # factorize each column first so that NaN street numbers group together
+    codes = pd.DataFrame({col: pd.factorize(df[col])[0] for col in df.columns})
+    groups = codes.groupby(list(codes.columns), sort=False).ngroup().to_numpy()
+    _, first_rows = np.unique(groups, return_index=True)
+
+    unique_df = df.iloc[first_rows]
+    cleaned = {
+        col: ignore_characters_series(unique_df[col], IGNORED_CHARS).tolist()
+        for col in ["STREET", "DEPARTMENT", "ATTENTION", "SUPPLEMENTAL", "RECEIVER"]
+    }
+
+    results = np.empty((len(first_rows), 3), dtype=object)
+    for i, row in enumerate(zip(
+        unique_df["STREET_NUM"].tolist(),
+        cleaned["STREET"],
+        cleaned["DEPARTMENT"],
+        cleaned["ATTENTION"],
+        cleaned["SUPPLEMENTAL"],
+        cleaned["RECEIVER"],
+    )):
+        results[i] = infer_address_and_sublocations_from_cleaned(*row)
+
+    results = results[groups]
+    return results[:, 0], results[:, 1], results[:, 2]
+
+
+def infer_address_and_sublocations_from_cleaned(
+    street_num,
+    cleaned_street,
+    cleaned_department="",
+    cleaned_attention="",
+    cleaned_supplemental="",
+    cleaned_receiver="",
+):
+
     tokens = tokenize(
         cleaned_street
     )  # Transforms strings into tokens "Jefferson Ave   Bldg A" -> ("Jefferson", "Ave", "Bldg", "A")
@@ -279,13 +438,12 @@ def infer_address_and_sublocations(
         sublocation_tokens, SUBLOCATION_DICT
     )  # Transforms abbreviations into full words
 
-    for string in [
-        department,
-        attention,
-        supplemental,
-        receiver,
+    for cleaned_string in [
+        cleaned_department,
+        cleaned_attention,
+        cleaned_supplemental,
+        cleaned_receiver,
     ]:  # Looks for sublocation_lvl1/lvl2 information from other columns, e.g. ("Building", "A")
-        cleaned_string = ignore_characters(string, IGNORED_CHARS)
         s_tokens = tokenize(cleaned_string)
         d_s_tokens = apply_token_dict(s_tokens, SUBLOCATION_DICT)
         d_sublocation_tokens += grab_relevant_tokens(
@@ -15,12 +15,22 @@ from loggers import get_logger, timer
 logger = get_logger("FLAG-RESIDENTIAL")
 
 
+def residential_clients() -> tuple:
+    """ Logged in UPS and SVS clients, to be shared by the flag_residential_df calls of a run """
+    cfg = environment.read()
+    ups_client = UpsClient(password=cfg['ups_password'])
+    access_token = PingClient(cfg['client_id'], cfg['client_secret'], cfg['ping_url']).login()
+    svs_client = SvsClient_OAuth(token=access_token, env=cfg['env'])
+    return ups_client, svs_client
+
+
 @timer(logger)
-def flag_residential_df(df: pd.DataFrame) -> pd.DataFrame:
+def flag_residential_df(df: pd.DataFrame, clients: tuple = None) -> pd.DataFrame:
     """Check for residential ops locations in a dataframe
 
     Args:
         df (DataFrame): contains OPS rows
+        clients (tuple): UPS and SVS clients from residential_clients, created if not given
 
     Returns:
         DataFrame: OSP rows with is_residential flagged
@@ -43,10 +53,7 @@ def flag_residential_df(df: pd.DataFrame) -> pd.DataFrame:
 
     df = df.rename(columns=temp_names)
 
-    cfg = environment.read()
-    ups_client = UpsClient(password=cfg['ups_password'])
-    access_token = PingClient(cfg['client_id'], cfg['client_secret'], cfg['ping_url']).login()
-    svs_client = SvsClient_OAuth(token=access_token, env=cfg['env'])
+    ups_client, svs_client = clients or residential_clients()
 
     df = ups_client.get_UPS_RDI_async(df)
 
@@ -75,14 +82,15 @@ def flag_residential():
     """ Return dictionary with key as main_loc_name, and value the list of locations"""
 
     sql = f"""SELECT id,ops_street,ops_city,ops_state,ops_zip5 FROM CIM{os.getenv("RUN_SCHEMA_NAME", '')}.location"""
-    df = persistence.get_df(sql)
-
-    df = flag_residential_df(df)
-
     residential_list = []
-    for i, _row in df.iterrows():
-        if _row['is_residential'] == True:
-            residential_list.append(_row['row_index_id'])
+    clients = residential_clients()
+    # locations are flagged batch by batch as they download instead of holding the whole table
+    for batch in persistence.iter_df(sql):
+        df = flag_residential_df(batch, clients)
+
+        for i, _row in df.iterrows():
+            if _row['is_residential'] == True:
+                residential_list.append(_row['row_index_id'])
 
     logger.info('Total rows with is_residential=true ' + str(len(residential_list)))
 
@@ -1,11 +1,14 @@
+import numpy as np
 import pandas as pd
 from geocodio import GeocodioClient
 from snowflake.connector.pandas_tools import write_pandas
-from timeout_decorator import timeout
 import persistence
 
 import environment
-from loggers import get_logger, timer
+import geocode_broker
+import geocode_cache
+import geocode_dispatch
+from loggers import get_logger, timer, timer_metrics
 import query
 
 
@@ -16,7 +19,8 @@ logger = get_logger("GEOCODE")
 """
 To avoid Geocodio API call throttling.
 
-(1) For given (state, organization), try to load geocode information from cached database
+(1) For given (state, organization), try to load geocode information from the local cache,
+    then from the cached database for the addresses missing locally
 (2) Use geocode from cached database if available
 (3) Call Geocodio API for those not existing in cached database
 (4) Return DataFrame with (accuracy, type, lon, lat, formatted_addresss) columns
@@ -24,8 +28,13 @@ To avoid Geocodio API call throttling.
 
 
 class GeocodeTableCache:
+    """
+    Geocode cache keyed on the canonical address alone, the organization that first needed an
+    address is only kept as metadata, so an address shared by organizations is geocoded once.
+    """
 
-    def __init__(self, input_df, id_column, street_column, city_column, state_column, zip_column, organization_column):
+    def __init__(self, input_df, id_column, street_column, city_column, state_column, zip_column, organization_column,
+                 local_cache: geocode_cache.LocalGeocodeCache = None):
         self.input_df = input_df
         self.id_column = id_column
         self.street_column = street_column
@@ -33,80 +42,97 @@ class GeocodeTableCache:
         self.state_column = state_column
         self.zip_column = zip_column
         self.organization_column = organization_column
-
-        self.ops_states = self.input_df[self.state_column].unique()
-        self.organizations = self.input_df[self.organization_column].unique()
+        self.local_cache = local_cache or geocode_cache.local_cache
+        self.address_columns = [street_column, city_column, state_column, zip_column]
+        self.input_keys = geocode_cache.address_keys(self.input_df[self.address_columns])
 
         logger.info('Original dataframe shape {0} '.format(self.input_df.shape))
         self.df_from_cache = self.__load_from_cache__()
         logger.info('Cached from database dataframe shape {0} '.format(self.df_from_cache.shape))
         self.df_without_value_from_cache = None
 
+    def __load_from_cache__(self):
+        """
+        Reads through the local cache: addresses missing there are loaded from the cache table
+        and stored locally, so the next runs do not query the warehouse for them again.
+        Returns one row of KEY, ORGANIZATION_NAME and geocode columns per cached address.
+        """
+        addresses = self.input_df[self.address_columns].assign(KEY=self.input_keys).drop_duplicates(subset="KEY")
+
+        local_df = self.local_cache.get(addresses["KEY"])
+        missing = addresses[~addresses["KEY"].isin(local_df["KEY"])]
+
+        table_df = self.__load_from_table__(missing)
+        self.local_cache.put(table_df)
+        cache_df = pd.concat([local_df, table_df[local_df.columns]], ignore_index=True)
+
+        # input rows served by an address geocoded for another organization, each one an API call
+        # that an organization specific cache would have made
+        requested = self.input_df[[self.organization_column]].assign(KEY=self.input_keys).drop_duplicates()
+        requested = requested.merge(cache_df[["KEY", "ORGANIZATION_NAME"]].rename(columns={"ORGANIZATION_NAME": "CACHED_ORGANIZATION"}),
+                                    on="KEY", how="inner")
+        timer_metrics(
+            geocode_local_hits=len(local_df),
+            geocode_local_misses=len(missing),
+            geocode_table_hits=len(table_df),
+            geocode_cross_organization_hits=int((requested[self.organization_column] != requested["CACHED_ORGANIZATION"]).sum()),
+        )
+        logger.info(f"Geocode cache: {len(local_df)} addresses found locally, {len(table_df)}/{len(missing)} found "
+                    f"in the cache table")
+
+        return cache_df
+
     """
     Load from cache table to create a DataFrame for the given query filters.
     """
 
-    def __load_from_cache__(self):
+    def __load_from_table__(self, addresses):
+
+        columns = ["KEY", "ADDRESS", "ORGANIZATION_NAME", *geocode_cache.RESULT_COLUMNS]
+        if addresses.empty:
+            return pd.DataFrame(columns=columns)
 
-        states_sql = ",".join(f"'{state}'" for state in self.ops_states)
-        organizations_sql = ",".join(f"'{query.escape(org)}'" for org in self.organizations)
+        states_sql = ",".join(f"'{query.escape(str(state))}'" for state in addresses[self.state_column].unique())
+        zips_sql = ",".join(f"'{query.escape(str(zip5))}'" for zip5 in addresses[self.zip_column].unique())
 
-        sql = "SELECT ops_street as {0}, ops_city as {1}, ops_state as {2}, ops_zip5 as {3}, organization_name, type, " \
+        sql = "SELECT ops_street, ops_city, ops_state, ops_zip5, organization_name, type, " \
               "accuracy, lon, lat, FORMATTED_ADDRESS FROM " \
-              "TEMP.DIM_LOCATION_CACHE ".format(
-                  self.street_column, self.city_column, self.state_column, self.zip_column
-            )
-        
-        sql = sql + "WHERE ops_state in ({0}) AND organization_name in ({1}) ".format(
+              "TEMP.DIM_LOCATION_CACHE "
+
+        sql = sql + "WHERE ops_state in ({0}) AND ops_zip5 in ({1}) ".format(
             states_sql,
-            organizations_sql
+            zips_sql
         )
 
         sql = sql + " AND FORMATTED_ADDRESS IS NOT NULL "
 
         logger.debug(sql)
 
-        df = persistence.get_df(sql)
-
-        return df
+        # the cache holds every address of the states and zips, keep only the requested ones
+        # batch by batch so the full cache slice is never held in memory
+        batches = []
+        for batch in persistence.iter_df(sql):
+            address = batch[["OPS_STREET", "OPS_CITY", "OPS_STATE", "OPS_ZIP5"]]
+            batch = batch.assign(KEY=geocode_cache.address_keys(address), ADDRESS=geocode_cache.normalize_address(address))
+            batches.append(batch[batch["KEY"].isin(addresses["KEY"])][columns])
+        if len(batches) == 0:
+            return pd.DataFrame(columns=columns)
+
+        # rows cached for several organizations before the cache was organization agnostic
+        return (
+            pd.concat(batches, ignore_index=True)
+            .sort_values("ACCURACY", ascending=False, kind="stable", na_position="last")
+            .drop_duplicates(subset="KEY")
+            .reset_index(drop=True)
+        )
 
     def df_from_db(self):
         return self.df_from_cache
 
-    def save_to_db(self, df_from_api):
-
-        if df_from_api.empty:
-            return
-
-        df = pd.merge(left=df_from_api,
-                      right=self.df_without_value_from_cache,
-                      on=[self.id_column],
-                      how='inner').drop_duplicates()
-
-        df = df[[self.id_column, self.street_column, self.city_column, self.state_column, self.zip_column,
-                 'type', 'accuracy', 'lon', 'lat', 'ORGANIZATION_NAME', 'formatted_address_from_api']]
-
-        df.rename({self.street_column: 'OPS_STREET',
-                   self.city_column: "OPS_CITY",
-                   self.state_column: "OPS_STATE",
-                   self.zip_column: "OPS_ZIP5",
-                   'formatted_address_from_api': "FORMATTED_ADDRESS"},
-                  axis='columns', inplace=True)
-
-        df_original_with_duplicate = df.copy()
-        df.drop_duplicates(subset=None, keep="first", inplace=True)
-        if df.empty:
-            return
-        with persistence.get_conn() as conn:
-            logger.info('Writing dataframe to TEMP.dim_location_cache rows {0}'.format(df.shape[0]))
-            write_pandas(conn, df.drop(columns=[self.id_column]), table_name='DIM_LOCATION_CACHE', schema='TEMP', quote_identifiers=False)
-
-        return df_original_with_duplicate
-
     def df_difference(self):
-        df = pd.merge(left=self.input_df,
-                      right=self.df_from_cache,
-                      on=[self.street_column, self.city_column, self.state_column, self.zip_column, self.organization_column],
+        df = pd.merge(left=self.input_df.assign(KEY=self.input_keys),
+                      right=self.df_from_cache[["KEY", *geocode_cache.RESULT_COLUMNS]],
+                      on="KEY",
                       how='left').drop_duplicates()
         logger.info('Merged dataframe shape-----{0} '.format(df.shape))
 
@@ -123,16 +149,53 @@ class GeocodeTableCache:
         return df_with_value_from_cache, self.df_without_value_from_cache
 
 
-def reverse_tuple(x):
-    try:
-        x = x[::-1]
-        return x
-    except Exception:
-        logger.error('reverse_tuple failed')
-        return None
+def _normalized_address_sql():
+    """ Snowflake version of geocode_cache.normalize_address over the cache table columns """
+    parts = [
+        f"trim(regexp_replace(upper(coalesce({column}::varchar, '')), '\\\\s+', ' '))"
+        for column in ["ops_street", "ops_city", "ops_state", "ops_zip5"]
+    ]
+    return f"concat_ws('|', {', '.join(parts)})"
+
+
+@timer(logger)
+def cache_savings_report():
+    """
+    Rows of TEMP.DIM_LOCATION_CACHE against its distinct addresses. Every extra row is an address
+    geocoded again for another organization, i.e. an API call the address keyed cache saves.
+    """
+    sql = f"""SELECT
+            COUNT(*) AS CACHE_ROWS,
+            COUNT(DISTINCT {_normalized_address_sql()}) AS ADDRESSES,
+            COUNT(*) - COUNT(DISTINCT {_normalized_address_sql()}) AS SAVED_API_CALLS
+        FROM TEMP.DIM_LOCATION_CACHE"""
+    report = persistence.get_df(sql)
+    logger.info("Geocode cache savings", extra=report.iloc[0].to_dict() if report is not None and len(report) > 0 else {})
+    return report
+
+
+@timer(logger)
+def dedupe_cache_table():
+    """
+    One-off migration to the address keyed cache: keeps one row per normalized address of
+    TEMP.DIM_LOCATION_CACHE, the most accurate one, and swaps it in place of the table.
+    """
+    report = cache_savings_report()
+
+    with persistence.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""CREATE OR REPLACE TABLE TEMP.DIM_LOCATION_CACHE_DEDUPED AS
+            SELECT * FROM TEMP.DIM_LOCATION_CACHE
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY {_normalized_address_sql()}
+                ORDER BY FORMATTED_ADDRESS IS NULL, accuracy DESC NULLS LAST, organization_name
+            ) = 1""")
+        cur.execute("ALTER TABLE TEMP.DIM_LOCATION_CACHE SWAP WITH TEMP.DIM_LOCATION_CACHE_DEDUPED")
+        cur.execute("DROP TABLE TEMP.DIM_LOCATION_CACHE_DEDUPED")
+
+    return report
 
 
-@timeout(15 * 60)
 @timer(logger)
 def geocode_df(input_df, id_column, street_column, city_column, state_column, zip_column, organization_column):
     df_cache = GeocodeTableCache(input_df,
@@ -151,12 +214,20 @@ def geocode_df(input_df, id_column, street_column, city_column, state_column, zi
                                      'ACCURACY': 'accuracy'},
                                     axis='columns', inplace=True)
 
-    df_from_api = geocode_df_from_api(df_without_value_from_cache, id_column, street_column, city_column, state_column,
-                                      zip_column)
-
-    logger.info("To be saved to cache database rows {0}".format(df_from_api.shape[0]))
-
-    df_from_api = df_cache.save_to_db(df_from_api)
+    # addresses shared by several rows or organizations are geocoded once
+    df_to_geocode = df_without_value_from_cache.drop_duplicates(subset=['KEY'])
+    timer_metrics(geocode_api_addresses=len(df_to_geocode), geocode_api_rows=len(df_without_value_from_cache))
+
+    # the broker batches these addresses with the ones of the other scopes of the process,
+    # and caches every batch as it comes back
+    df_to_geocode = df_to_geocode[['KEY', street_column, city_column, state_column, zip_column, organization_column]].set_axis(
+        geocode_broker.BATCH_COLUMNS, axis=1)
+    futures = [broker.submit(chunk) for chunk in geocode_dispatch.split_chunks(df_to_geocode, broker.batch_size)]
+    results = list(broker.as_completed(futures))
+    df_from_api = None
+    if len(results) > 0:
+        df_from_api = df_without_value_from_cache[[id_column, 'KEY']].merge(pd.concat(results), on='KEY').rename(
+            columns={'formatted_address_from_api': 'FORMATTED_ADDRESS'})
 
     # combine
     df_combined = pd.concat([df_with_value_from_cache[[id_column,
@@ -171,9 +242,13 @@ def geocode_df(input_df, id_column, street_column, city_column, state_column, zi
     return df_combined
 
 
-@timeout(60 * 60)
 @timer(logger)
-def geocode_df_from_api(input_df, id_column, street_column, city_column, state_column, zip_column):
+def geocode_df_from_api(input_df, id_column, street_column, city_column, state_column, zip_column,
+                        on_chunk: callable = None):
+    """
+    Geocodes the addresses of input_df, in chunks sent concurrently by geocode_dispatch.
+    on_chunk(df) is called with the result of every chunk as it completes, in the calling thread.
+    """
 
     if input_df.empty:
         return input_df
@@ -215,80 +290,70 @@ def geocode_df_from_api(input_df, id_column, street_column, city_column, state_c
     id_list = id_list
     address_list = address_list
 
-    if len(address_list) <= 10000:
-        # open client & geocode
-        client = GeocodioClient(geocodio_api_key)
-        geocodio_res = client.geocode(address_list)
-
-        # format results
-        ret_df = pd.DataFrame(
-            {
-                'id': id_list,
-                'lat_lon': [reverse_tuple(i) for i in geocodio_res.coords],
-                'type': [i.best_match.get('accuracy_type') for i in geocodio_res],
-                'accuracy': [i.best_match.get('accuracy') for i in geocodio_res],
-                'formatted_address_from_api': geocodio_res.formatted_addresses
-            }
-        )
-    else:
-        # chunk up the address list
-        n = 10000
-        id_chunks = [id_list[i * n:(i + 1) * n] for i in range((len(id_list) + n - 1) // n)]
-        address_chunks = [address_list[i * n:(i + 1) * n] for i in range((len(address_list) + n - 1) // n)]
-        num_chunks = len(address_chunks)
-
-        ret_list = []
-        for nc in range(num_chunks):
-            # open client & geocode
-            client = GeocodioClient(geocodio_api_key)
-            geocodio_res = client.geocode(address_chunks[nc])
-
-            # format results
-            ret_df = pd.DataFrame(
-                {
-                    'id': id_chunks[nc],
-                    'lat_lon': [reverse_tuple(i) for i in geocodio_res.coords],
-                    'type': [i.best_match.get('accuracy_type') for i in geocodio_res],
-                    'accuracy': [i.best_match.get('accuracy') for i in geocodio_res],
-                    'formatted_address_from_api': geocodio_res.formatted_addresses
-                }
-            )
-            ret_list.append(ret_df)
-
-        ret_df = pd.concat(ret_list)
-
-    ret_df[['lon', 'lat']] = ret_df['lat_lon'].astype(
-        str
-    ).str.replace(
-        '(',
-        '',
-        regex=False
-    ).str.replace(
-        ')',
-        '',
-        regex=False
-    ).str.split(
-        ",",
-        expand=True
-    )
+    client = GeocodioClient(geocodio_api_key, timeout=geocode_dispatch.REQUEST_TIMEOUT)
+    id_chunks = geocode_dispatch.split_chunks(id_list, geocode_dispatch.CHUNK_SIZE)
+    address_chunks = geocode_dispatch.split_chunks(address_list, geocode_dispatch.CHUNK_SIZE)
 
-    ret_df.drop(
-        columns=['lat_lon'],
-        inplace=True
-    )
+    ret_list = [None] * len(address_chunks)
+    for nc, geocodio_res in geocode_dispatch.dispatch(address_chunks, client.geocode):
+        ret_list[nc] = format_geocodio_response(id_chunks[nc], geocodio_res, id_column)
+        if on_chunk is not None:
+            on_chunk(ret_list[nc])
+
+    return pd.concat(ret_list)
 
-    ret_df.rename(
-        columns={
-            'id': id_column
-        },
-        inplace=True
-    )
 
-    ret_df['lon'] = ret_df['lon'].replace('None', 0)
-    ret_df['lon'] = ret_df['lon'].fillna(0)
-    ret_df['lat'] = ret_df['lat'].replace('None', 0)
-    ret_df['lat'] = ret_df['lat'].fillna(0)
-    ret_df = ret_df.astype({'lon': 'float', 'lat': 'float'})
+def geocode_batch(batch_df):
+    """ Geocodes a batch of the broker, a dataframe of geocode_broker.BATCH_COLUMNS """
+    return geocode_df_from_api(batch_df, 'KEY', 'STREET', 'CITY', 'STATE', 'ZIP')
+
+
+def save_batch_to_cache(batch_df, result_df):
+    """
+    Checkpoint of the broker: writes a geocoded batch to TEMP.DIM_LOCATION_CACHE and the local
+    cache, one row per address with the organization of its first request as metadata
+    """
+    df = batch_df.merge(result_df, on='KEY').drop_duplicates(subset=['KEY'])
+    if df.empty:
+        return
+
+    df = df.rename(columns={'STREET': 'OPS_STREET',
+                            'CITY': 'OPS_CITY',
+                            'STATE': 'OPS_STATE',
+                            'ZIP': 'OPS_ZIP5',
+                            'formatted_address_from_api': 'FORMATTED_ADDRESS'})
+    df = df[['KEY', 'OPS_STREET', 'OPS_CITY', 'OPS_STATE', 'OPS_ZIP5', 'type', 'accuracy', 'lon', 'lat',
+             'ORGANIZATION_NAME', 'FORMATTED_ADDRESS']]
+
+    with persistence.get_conn() as conn:
+        logger.info('Writing dataframe to TEMP.dim_location_cache rows {0}'.format(df.shape[0]))
+        write_pandas(conn, df.drop(columns=['KEY']), table_name='DIM_LOCATION_CACHE', schema='TEMP', quote_identifiers=False)
+
+    # write through to the local cache
+    geocode_cache.local_cache.put(df.rename(columns={'type': 'TYPE', 'accuracy': 'ACCURACY', 'lon': 'LON', 'lat': 'LAT'}).assign(
+        ADDRESS=geocode_cache.normalize_address(df[['OPS_STREET', 'OPS_CITY', 'OPS_STATE', 'OPS_ZIP5']])
+    ))
+
+
+broker = geocode_broker.GeocodeBroker(geocode_batch, checkpoint=save_batch_to_cache)
+
+
+def format_geocodio_response(id_list, geocodio_res, id_column):
+    """ Result columns of a Geocodio batch response, with NaN coordinates where nothing was found """
+    n = len(geocodio_res)
+    matches = [i.best_match for i in geocodio_res]
+    locations = [match.get('location') or {} for match in matches]
+
+    ret_df = pd.DataFrame(
+        {
+            id_column: id_list,
+            'type': [match.get('accuracy_type') for match in matches],
+            'accuracy': [match.get('accuracy') for match in matches],
+            'formatted_address_from_api': [match.get('formatted_address', '') for match in matches],
+            'lon': np.fromiter((location.get('lng', np.nan) for location in locations), dtype=np.float64, count=n),
+            'lat': np.fromiter((location.get('lat', np.nan) for location in locations), dtype=np.float64, count=n),
+        }
+    )
 
     return ret_df
 
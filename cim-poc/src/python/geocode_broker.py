@@ -0,0 +1,231 @@
+"""
+Per-process broker coalescing geocode requests across scopes.
+
+geocode.geocode_df hands the addresses missing from the cache to `geocode.broker` and
+waits on the returned futures instead of calling Geocodio itself. The broker collects
+the addresses of every scope of the process, requests each distinct address once and
+sends them in batches of GEOCODE_BROKER_BATCH_SIZE. A partial batch goes out once its
+oldest address waited GEOCODE_BROKER_MAX_LATENCY_SECONDS, or right away when every
+producer is waiting on results, since no more addresses can come in then.
+
+Producers are the threads registered with `producer()`, the concurrent process stages
+of utils.pipeline. A thread waiting outside of it counts as a producer while it waits,
+so a serial caller never sits out the latency window.
+
+Every batch is checkpointed once, as soon as it is geocoded and before its results are
+handed out, so an address shared by several scopes is cached once, and a batch still in
+flight when its scopes stop waiting is cached all the same.
+
+Configuration (environment variables):
+    GEOCODE_BROKER_BATCH_SIZE               addresses per batch, at most 10,000 for Geocodio
+    GEOCODE_BROKER_MAX_LATENCY_SECONDS      wait of a partial batch for more addresses
+    GEOCODE_BROKER_TIMEOUT                  wait of a scope for its results before giving up
+"""
+import concurrent.futures
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+import pandas as pd
+
+import geocode_dispatch
+from loggers import get_logger
+
+logger = get_logger("GEOCODE-BROKER")
+
+BATCH_SIZE = int(os.getenv("GEOCODE_BROKER_BATCH_SIZE", geocode_dispatch.CHUNK_SIZE))
+MAX_LATENCY_SECONDS = float(os.getenv("GEOCODE_BROKER_MAX_LATENCY_SECONDS", 5))
+TIMEOUT = float(os.getenv("GEOCODE_BROKER_TIMEOUT", 15 * 60))
+
+ADDRESS_COLUMNS = ["STREET", "CITY", "STATE", "ZIP"]
+# carried along with an address for the checkpoint, from the first request of the address
+METADATA_COLUMNS = ["ORGANIZATION_NAME"]
+BATCH_COLUMNS = ["KEY", *ADDRESS_COLUMNS, *METADATA_COLUMNS]
+
+
+class _Request:
+    """ Addresses of one submit call, resolved batch by batch """
+
+    def __init__(self, n_keys: int):
+        self.future = Future()
+        self.remaining = n_keys
+        self.parts = []
+
+
+class GeocodeBroker:
+
+    def __init__(
+        self,
+        geocode: callable,
+        batch_size: int = BATCH_SIZE,
+        max_latency: float = MAX_LATENCY_SECONDS,
+        max_workers: int = geocode_dispatch.MAX_WORKERS,
+        checkpoint: callable = None,
+    ):
+        """
+        geocode(df) geocodes a dataframe of BATCH_COLUMNS into a dataframe with one row per KEY.
+        checkpoint(df, result), when given, is called with every batch and its result.
+        """
+        self.geocode = geocode
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_workers = max_workers
+        self.stats = Counter()
+        self._cond = threading.Condition()
+        # addresses not sent yet, in submit order
+        self._pending = {}
+        self._pending_since = None
+        # requests waiting on every pending or in flight address
+        self._requests = {}
+        self._producers = Counter()
+        self._waiting = 0
+        self._executor = None
+        self._flusher = None
+
+    @contextmanager
+    def producer(self):
+        """ Registers the current thread as a source of addresses for the duration of the block """
+        ident = threading.get_ident()
+        with self._cond:
+            self._producers[ident] += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._producers[ident] -= 1
+                if self._producers[ident] == 0:
+                    del self._producers[ident]
+                self._cond.notify_all()
+
+    def submit(self, df: pd.DataFrame) -> Future:
+        """
+        Queues the addresses of df, with KEY, ADDRESS_COLUMNS and optionally METADATA_COLUMNS,
+        returns a future of their results
+        """
+        df = df.drop_duplicates(subset=["KEY"]).reindex(columns=BATCH_COLUMNS)
+        request = _Request(len(df))
+        if request.remaining == 0:
+            request.future.set_result(None)
+            return request.future
+
+        with self._cond:
+            for key, *address in df.itertuples(index=False, name=None):
+                if key in self._requests:
+                    self.stats["coalesced"] += 1
+                else:
+                    self._requests[key] = []
+                    self._pending[key] = address
+                self._requests[key].append(request)
+            self.stats["submitted"] += request.remaining
+            if self._pending_since is None and len(self._pending) > 0:
+                self._pending_since = time.monotonic()
+            self._start()
+            self._cond.notify_all()
+        return request.future
+
+    def as_completed(self, futures: list, timeout: float = TIMEOUT):
+        """
+        Yields the results of futures as they complete, counting the current thread as
+        waiting meanwhile. A failed future raises once the others have been yielded.
+        """
+        errors = []
+        with self._waiting_on_results():
+            for future in concurrent.futures.as_completed(futures, timeout=timeout):
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                yield future.result()
+        if len(errors) > 0:
+            raise errors[0]
+
+    @contextmanager
+    def _waiting_on_results(self):
+        ident = threading.get_ident()
+        with self._cond:
+            self._producers[ident] += 1
+            self._waiting += 1
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._waiting -= 1
+                self._producers[ident] -= 1
+                if self._producers[ident] == 0:
+                    del self._producers[ident]
+
+    def _start(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._executor = self._executor or ThreadPoolExecutor(max_workers=max(1, self.max_workers),
+                                                              thread_name_prefix="geocode-broker")
+        self._flusher = threading.Thread(target=self._flush_loop, name="geocode-broker-flusher", daemon=True)
+        self._flusher.start()
+
+    def _next_batch(self):
+        """ The batch due to be sent with the reason, or None and the time until the next one is due """
+        if len(self._pending) == 0:
+            return None, None
+        if len(self._pending) >= self.batch_size:
+            reason = "full"
+        elif self._waiting >= len(self._producers):
+            reason = "all producers waiting"
+        elif time.monotonic() - self._pending_since >= self.max_latency:
+            reason = "max latency"
+        else:
+            return None, self.max_latency - (time.monotonic() - self._pending_since)
+
+        batch = [(key, *self._pending.pop(key)) for key in list(islice(self._pending, self.batch_size))]
+        if len(self._pending) == 0:
+            self._pending_since = None
+        return (batch, reason), None
+
+    def _flush_loop(self):
+        with self._cond:
+            while True:
+                due, wait = self._next_batch()
+                if due is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+                batch, reason = due
+                self.stats["batches"] += 1
+                logger.info(f"Sending {len(batch)} addresses to geocode ({reason})")
+                self._executor.submit(self._send, pd.DataFrame(batch, columns=BATCH_COLUMNS))
+
+    def _send(self, batch_df: pd.DataFrame):
+        try:
+            result = self.geocode(batch_df).reset_index(drop=True)
+        except Exception as error:
+            self._resolve(batch_df["KEY"], error=error)
+            return
+
+        if self.checkpoint is not None:
+            try:
+                self.checkpoint(batch_df, result)
+            except Exception as error:
+                # the results are still good, they are only geocoded again by a later run
+                logger.error(f"Failed to checkpoint a batch of {len(batch_df)} addresses: {error}")
+        self._resolve(result["KEY"], result=result)
+
+    def _resolve(self, keys: pd.Series, result: pd.DataFrame = None, error: Exception = None):
+        positions = {}
+        with self._cond:
+            for position, key in enumerate(keys):
+                for request in self._requests.pop(key, []):
+                    positions.setdefault(request, []).append(position)
+
+            for request, request_positions in positions.items():
+                if request.future.done():
+                    continue
+                if error is not None:
+                    request.future.set_exception(error)
+                    continue
+                request.parts.append(result.iloc[request_positions])
+                request.remaining -= len(request_positions)
+                if request.remaining == 0:
+                    request.future.set_result(pd.concat(request.parts, ignore_index=True))
@@ -0,0 +1,119 @@
+"""
+Local tier of the geocode cache.
+
+geocode.GeocodeTableCache reads through this on-disk SQLite store before querying
+TEMP.DIM_LOCATION_CACHE, fills it with the rows found there, and writes newly geocoded
+addresses to both. Rows are keyed by a hash of the normalized address and expire after
+GEOCODE_CACHE_TTL_DAYS, after which the address is looked up in Snowflake again.
+
+There are two tiers with separate roles: the local file is private to a pod and lives on
+its local disk, where SQLite's own locking is reliable between the processes of the pod,
+while TEMP.DIM_LOCATION_CACHE is the tier shared by all pods and runs. The local file is
+never shared over the network volume, a new pod starts empty and warms it from the table.
+
+Configuration (environment variables):
+    GEOCODE_CACHE_PATH          SQLite file, in the temporary directory of the pod by default
+    GEOCODE_CACHE_TTL_DAYS      age after which a local row is ignored and pruned
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from loggers import get_logger
+
+logger = get_logger("GEOCODE-CACHE")
+
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "geocode_cache.sqlite"))
+GEOCODE_CACHE_TTL_DAYS = float(os.getenv("GEOCODE_CACHE_TTL_DAYS", 90))
+# SQLite caps the number of bound variables of a statement
+MAX_KEYS_PER_QUERY = 500
+
+RESULT_COLUMNS = ["TYPE", "ACCURACY", "LON", "LAT", "FORMATTED_ADDRESS"]
+
+
+def normalize_address(parts: pd.DataFrame) -> pd.Series:
+    """ Upper cased, whitespace collapsed address parts joined with '|' """
+    normalized = [
+        parts[column].fillna("").astype(str).str.upper().str.replace(r"\s+", " ", regex=True).str.strip()
+        for column in parts.columns
+    ]
+    return pd.concat(normalized, axis=1).agg("|".join, axis=1) if len(parts) > 0 else pd.Series([], dtype=object)
+
+
+def address_keys(parts: pd.DataFrame) -> pd.Series:
+    """ Cache key of every row of address parts """
+    return pd.Series(
+        [hashlib.sha1(address.encode()).hexdigest() for address in normalize_address(parts)],
+        index=parts.index,
+        dtype=object,
+    )
+
+
+class LocalGeocodeCache:
+
+    def __init__(self, path: str = GEOCODE_CACHE_PATH, ttl_days: float = GEOCODE_CACHE_TTL_DAYS):
+        self.path = path
+        self.ttl_seconds = ttl_days * 24 * 3600
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    @contextmanager
+    def _locked(self):
+        """ The connection, used by this thread only until the block exits """
+        with self._lock:
+            # other processes of the pod are kept out by SQLite's locks on the local file
+            yield self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        # a forked process opens its own connection
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._pid = os.getpid()
+            with self._conn:
+                self._conn.execute(
+                    "create table if not exists geocode_cache ("
+                    "key text primary key, address text, organization_name text, "
+                    "type text, accuracy real, lon real, lat real, formatted_address text, cached_at real)"
+                )
+                pruned = self._conn.execute(
+                    "delete from geocode_cache where cached_at < ?", (time.time() - self.ttl_seconds,)
+                ).rowcount
+            if pruned > 0:
+                logger.info(f"Pruned {pruned} expired rows from {self.path}")
+        return self._conn
+
+    def get(self, keys) -> pd.DataFrame:
+        """ Fresh cached results of keys, as a dataframe of KEY, ORGANIZATION_NAME and RESULT_COLUMNS """
+        keys = list(dict.fromkeys(keys))
+        min_cached_at = time.time() - self.ttl_seconds
+        rows = []
+        with self._locked() as conn:
+            for i in range(0, len(keys), MAX_KEYS_PER_QUERY):
+                chunk = keys[i:i + MAX_KEYS_PER_QUERY]
+                rows += conn.execute(
+                    "select key, organization_name, type, accuracy, lon, lat, formatted_address from geocode_cache "
+                    f"where key in ({','.join('?' * len(chunk))}) and cached_at >= ?",
+                    (*chunk, min_cached_at)
+                ).fetchall()
+        return pd.DataFrame(rows, columns=["KEY", "ORGANIZATION_NAME", *RESULT_COLUMNS])
+
+    def put(self, df: pd.DataFrame):
+        """ Stores rows of KEY, ADDRESS, ORGANIZATION_NAME and RESULT_COLUMNS """
+        if df.empty:
+            return
+        now = time.time()
+        df = df[["KEY", "ADDRESS", "ORGANIZATION_NAME", *RESULT_COLUMNS]]
+        rows = [(*row, now) for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)]
+        with self._locked() as conn, conn:
+            conn.executemany("insert or replace into geocode_cache values (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+local_cache = LocalGeocodeCache()
@@ -0,0 +1,123 @@
+"""
+Concurrent dispatch of Geocodio batch requests.
+
+geocode.geocode_df_from_api cuts its addresses into chunks of GEOCODIO_CHUNK_SIZE and
+sends them from a thread pool, paced by a token bucket shared by the process. Failed
+requests are retried with exponential backoff. Every chunk is handed back as soon as it
+completes, so callers can checkpoint it before the next one finishes.
+
+Configuration (environment variables):
+    GEOCODIO_CHUNK_SIZE             addresses per batch request, at most 10,000 for Geocodio
+    GEOCODIO_MAX_WORKERS            concurrent batch requests
+    GEOCODIO_REQUESTS_PER_SECOND    sustained request rate of the token bucket
+    GEOCODIO_MAX_RETRIES            retries of a failed request before giving up on its chunk
+    GEOCODIO_BACKOFF_SECONDS        first retry delay, doubled on every retry
+    GEOCODIO_REQUEST_TIMEOUT        seconds before a single request is abandoned and retried
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from geocodio.exceptions import GeocodioAuthError, GeocodioDataError, GeocodioError
+
+from loggers import get_logger
+
+logger = get_logger("GEOCODE-DISPATCH")
+
+CHUNK_SIZE = int(os.getenv("GEOCODIO_CHUNK_SIZE", 10_000))
+MAX_WORKERS = int(os.getenv("GEOCODIO_MAX_WORKERS", 4))
+REQUESTS_PER_SECOND = float(os.getenv("GEOCODIO_REQUESTS_PER_SECOND", 1.0))
+MAX_RETRIES = int(os.getenv("GEOCODIO_MAX_RETRIES", 5))
+BACKOFF_SECONDS = float(os.getenv("GEOCODIO_BACKOFF_SECONDS", 2.0))
+REQUEST_TIMEOUT = float(os.getenv("GEOCODIO_REQUEST_TIMEOUT", 600))
+
+
+class TokenBucket:
+    """ Allows `rate` acquisitions per second on average, with bursts of up to `capacity` """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+bucket = TokenBucket(REQUESTS_PER_SECOND, capacity=max(1, MAX_WORKERS))
+
+
+def is_retryable(error: Exception) -> bool:
+    """ Server errors, rate limiting and network failures are retried, bad keys or addresses are not """
+    if isinstance(error, (GeocodioAuthError, GeocodioDataError)):
+        return False
+    return isinstance(error, (GeocodioError, requests.exceptions.RequestException))
+
+
+def call_with_retries(
+    func: callable,
+    *args,
+    max_retries: int = MAX_RETRIES,
+    backoff_seconds: float = BACKOFF_SECONDS,
+    rate_limiter: TokenBucket = None,
+):
+    """ Calls func(*args), retrying retryable errors after exponentially growing, jittered delays """
+    rate_limiter = rate_limiter or bucket
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        try:
+            return func(*args)
+        except Exception as error:
+            if attempt == max_retries or not is_retryable(error):
+                raise
+            delay = backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(f"Geocodio request failed ({error!r}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def split_chunks(items: list, chunk_size: int = CHUNK_SIZE) -> list:
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def dispatch(chunks: list, func: callable, max_workers: int = MAX_WORKERS, **retry_kws):
+    """
+    Calls func(chunk) for every chunk from a thread pool, with retries, and yields
+    (chunk index, result) pairs in completion order. A chunk that still fails after its
+    retries raises once the chunks already completed have been yielded.
+    """
+    if len(chunks) == 0:
+        return
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks))), thread_name_prefix="geocodio")
+    try:
+        futures = {
+            executor.submit(call_with_retries, func, chunk, **retry_kws): i
+            for i, chunk in enumerate(chunks)
+        }
+        errors = []
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                logger.error(f"Geocodio chunk {futures[future]} failed: {error!r}")
+                errors.append(error)
+                continue
+            yield futures[future], result
+        if len(errors) > 0:
+            raise errors[0]
+    finally:
+        # on timeout or error, do not wait for the requests still queued
+        executor.shutdown(wait=False, cancel_futures=True)
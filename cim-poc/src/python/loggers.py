@@ -1,4 +1,5 @@
 import os
+import threading
 from functools import wraps
 import logging
 import logging.config
@@ -15,9 +16,17 @@ with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'logging.yaml
     config = yaml.safe_load(file.read())
     logging.config.dictConfig(config)
 
+_timer_state = threading.local()
+
 def get_logger(name: str):
     return logging.getLogger(name)
 
+def timer_metrics(**metrics):
+    """Attach extra metrics (e.g. cache hit ratios) to the log record of the innermost running timer"""
+    stack = getattr(_timer_state, "stack", None)
+    if stack:
+        stack[-1].update(metrics)
+
 def timer(logger):
     def decorator(func):
         @wraps(func)
@@ -29,10 +38,16 @@ def timer(logger):
                 func_module=func.__module__,
             )
 
+            stack = _timer_state.__dict__.setdefault("stack", [])
+            stack.append({})
             start = Timer()
-            result = func(*args, **kwargs)
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                metrics = stack.pop()
             end = Timer()
             data["runtime_seconds"] = end - start
+            data.update(metrics)
 
             if len(args) > 0 and type(args[0]) in (pd.Series, pd.DataFrame):
                 data["n_rows"] = len(args[0])
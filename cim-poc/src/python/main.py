@@ -2,10 +2,12 @@ import json
 from argparse import ArgumentParser
 from glob import glob
 import os
+import shutil
 
 from generate_run_id import GenerateRunID
 from loggers import get_logger
 from environment import SCOPES_DIR
+import geocode
 import workflows
 
 
@@ -34,6 +36,7 @@ if __name__ == '__main__':
     parser.add_argument("--max_dims_medium", type=int, required=False)
     parser.add_argument("--group", type=str, required=False)
     parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--queue", action="store_true", help="pull scope chunks from the shared work queue instead of the pod's pickle")
 
     args = parser.parse_args()
 
@@ -44,7 +47,10 @@ if __name__ == '__main__':
 
         # remove all scopefiles
         for file in glob(f"{SCOPES_DIR}/*"):
-            os.remove(file)
+            if os.path.isdir(file):
+                shutil.rmtree(file)
+            else:
+                os.remove(file)
 
         workflows.initialize.salesorder(
             incremental=args.incremental,
@@ -55,6 +61,7 @@ if __name__ == '__main__':
             min_dims_medium=args.min_dims_medium,
             max_dims_medium=args.max_dims_medium,
             max_scopes=args.max_scopes,
+            queue=args.queue,
         )
         workflows.initialize.soldto(
             incremental=args.incremental,
@@ -86,16 +93,19 @@ if __name__ == '__main__':
         )
 
     elif args.action == "generate_ops_locations":
-        check_pid(args.pid)
+        if not args.queue:
+            check_pid(args.pid)
         if args.group == "small":
             workflows.generate.generate_ops_locations_small(
                 pid=args.pid,
                 group=args.group,
+                queue=args.queue,
             )
         else:
             workflows.generate.generate_ops_locations(
                 pid=args.pid,
                 group=args.group,
+                queue=args.queue,
             )
     
     elif args.action == "generate_soldto_ops_locations":
@@ -111,10 +121,12 @@ if __name__ == '__main__':
         )
 
     elif args.action == "build_associations":
-        check_pid(args.pid)
+        if not args.queue:
+            check_pid(args.pid)
         workflows.associate.build_associations(
             pid=args.pid,
             group=args.group,
+            queue=args.queue,
         )
 
     elif args.action == "build_associations_soldto_account":
@@ -149,6 +161,12 @@ if __name__ == '__main__':
     elif args.action == "populate_bridge_table":
         workflows.commit.populate_bridge_table()
 
+    elif args.action == "dedupe_geocode_cache":
+        geocode.dedupe_cache_table()
+
+    elif args.action == "geocode_cache_savings":
+        geocode.cache_savings_report()
+
     elif args.action == 'compute_run_statistics':
         workflows.compute_stats.compute_stats_table()
 
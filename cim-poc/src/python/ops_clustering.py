@@ -1,116 +1,342 @@
 import pandas as pd
 import numpy as np
-from sklearn.metrics.pairwise import haversine_distances
-from sklearn.cluster import AgglomerativeClustering
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.neighbors import BallTree
+import multiprocessing
 import os
-if "ARM64" not in str(os.uname()):
-    from sparse_dot_mkl import dot_product_mkl
-from sklearn.preprocessing import OneHotEncoder
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
 
 from uuid import uuid1
 
 import persistence
 import query
 from scopes.base import ScopeBase
+from upload_df import UploadOpsLocation
 from loggers import get_logger, timer
 
 EARTH_RADIUS_M = 6371007.2
 SEARCH_RADIUS_M = 100
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", os.cpu_count() or 1))
+PARTITIONS_PER_WORKER = 4
+# below this many OPS rows a scope is clustered in process, shipping it to the workers costs more
+MIN_PARALLEL_ROWS = int(os.getenv("CLUSTER_MIN_PARALLEL_ROWS", 20_000))
+# parents are buffered up to this many rows before being written, each write_pandas call has a fixed cost
+PARENT_UPLOAD_BATCH_ROWS = 50_000
+# IDs per DELETE or UPDATE statement, Snowflake caps the length of an IN list
+MAX_IDS_PER_STATEMENT = 10_000
+# a site whose coordinates are further than this from the mean of its children, in degrees, has moved children
+SITE_DRIFT_DEGREES = 1e-7
+# IDs of the OPS rows inserted by the generate tasks of the run, the new rows of incremental clustering
+NEW_OPS_TABLE = "STG_NEW_LOC"
 logger = get_logger("OPS-CLUSTERING")
 
 
-def cluster_desc(df):
-    """ Determine the name of a parent ops row by cluster 
+PARENT_COLUMNS = [
+    "ID", "OPS_LOC_NAME", "MAIN_LOC_NAME", "OPS_STREET", "OPS_CITY", "OPS_STATE", "OPS_ZIP5", "OPS_MARKER",
+    "OPS_SUBLOCATION", "ORGANIZATION_ID", "ORGANIZATION_NAME", "LATITUDE", "LONGITUDE", "CLUSTER", "children",
+    "GEOCODE_ACCURACY", "GEOCODE_LEVEL", "IS_RESIDENTIAL", "CURATED", "IS_SITE", "IS_ADDRESS", "IS_BUILDING",
+]
+MODAL_COLUMNS = ["OPS_CITY", "OPS_STREET", "OPS_STATE", "OPS_ZIP5", "ORGANIZATION_ID", "ORGANIZATION_NAME"]
+
+
+def modal_values(df: pd.DataFrame, by: str, columns: list) -> pd.DataFrame:
+    """ Most common non-null value of each column per group, ties go to the value seen first
+
+        arguments:
+            df (DataFrame): rows to aggregate
+            by (str): name of the group column
+            columns (list): columns to take the mode of
+
+        returns:
+            DataFrame: one row per group (indexed by the group), one column per entry of columns
+    """
+    modes = {}
+    for col in columns:
+        # sort=False keeps (group, value) pairs in order of first appearance, the stable sort keeps the first of ties
+        counts = df.groupby([by, col], sort=False).size().rename("n").reset_index()
+        first_max = counts.sort_values("n", ascending=False, kind="stable").drop_duplicates(by)
+        modes[col] = first_max.set_index(by)[col]
+    return pd.DataFrame(modes).reindex(df[by].unique())
+
+
+def clusters_to_ops(ops_df: pd.DataFrame) -> pd.DataFrame:
+    """ Parent OPS records for every cluster of more than one OPS row
+
+        arguments:
+            ops_df (DataFrame): OPS rows with a CLUSTER column
+
+        returns:
+            DataFrame: one parent row per cluster, children holds the list of child IDs
+    """
+    df = ops_df[ops_df.groupby("CLUSTER")["CLUSTER"].transform("size") > 1]
+    if len(df) == 0:
+        return pd.DataFrame(columns=PARENT_COLUMNS)
+
+    grouped = df.groupby("CLUSTER", sort=False)
+    parents = modal_values(df, "CLUSTER", MODAL_COLUMNS).join(
+        grouped.agg(LATITUDE=("LATITUDE", "mean"), LONGITUDE=("LONGITUDE", "mean"), children=("ID", list))
+    ).rename_axis("CLUSTER").reset_index()
+
+    main_loc_name = (
+        parents.ORGANIZATION_NAME.astype(str) + " " + parents.OPS_STATE.astype(str) + " P" + parents.CLUSTER.astype(str)
+    )
+    parents = parents.assign(
+        ID=[str(uuid1()) for _ in range(len(parents))],
+        OPS_LOC_NAME=main_loc_name + " " + parents.OPS_STREET.astype(str) + " " + parents.OPS_CITY.astype(str),
+        MAIN_LOC_NAME=main_loc_name,
+        OPS_MARKER=None,
+        OPS_SUBLOCATION="",
+        GEOCODE_ACCURACY=None,
+        GEOCODE_LEVEL=None,
+        IS_RESIDENTIAL=False,
+        CURATED=False,
+        IS_SITE=True,
+        IS_ADDRESS=False,
+        IS_BUILDING=False,
+    )
+    return parents[PARENT_COLUMNS]
+
+
+def radius_edges(coords: np.ndarray, radius_m: float = SEARCH_RADIUS_M) -> tuple:
+    """ Pairs of points (as index arrays) closer than radius_m, using a haversine BallTree
+
+        arguments:
+            coords (ndarray): n x 2 array of latitude and longitude, in radians
+            radius_m (float): search radius in meters
+
+        returns:
+            tuple: (ndarray, ndarray) of source and destination indices into coords
+    """
+    neighbors, dists = BallTree(coords, metric="haversine").query_radius(
+        coords, r=radius_m / EARTH_RADIUS_M, return_distance=True
+    )
+    src = np.repeat(np.arange(len(coords)), [len(n) for n in neighbors])
+    dst = np.concatenate(neighbors)
+    # single linkage only merges clusters strictly closer than the threshold
+    keep = np.concatenate(dists) * EARTH_RADIUS_M < radius_m
+    return src[keep], dst[keep]
+
+
+def cluster_labels(ops_df: pd.DataFrame, radius_m: float = SEARCH_RADIUS_M) -> np.ndarray:
+    """ Single linkage clusters of OPS rows within the same organization at radius_m
+
+        Equivalent to agglomerative single linkage clustering with a distance threshold,
+        computed as the connected components of the sparse graph of pairs closer than
+        radius_m, so memory grows with the number of neighbors instead of n^2. Labels
+        are numbered in order of first appearance.
+
+        arguments:
+            ops_df (DataFrame): OPS rows with ORGANIZATION_ID, LATITUDE and LONGITUDE
+            radius_m (float): search radius in meters
+
+        returns:
+            ndarray: cluster label for every row of ops_df
+    """
+    if len(ops_df) == 0:
+        return np.zeros(0, dtype=int)
+
+    # rows sharing organization and coordinates always end up together, build the graph on distinct points
+    points = ops_df[["ORGANIZATION_ID", "LATITUDE", "LONGITUDE"]]
+    point_ix = points.groupby(list(points.columns), sort=False, dropna=False).ngroup().to_numpy()
+    points = points.iloc[np.unique(point_ix, return_index=True)[1]].reset_index(drop=True)
+
+    coords = np.deg2rad(points[["LATITUDE", "LONGITUDE"]].to_numpy(dtype=float))
+    located = ~np.isnan(coords).any(axis=1)
+
+    srcs, dsts = [], []
+    for ix in points[located].groupby("ORGANIZATION_ID", sort=False, dropna=False).indices.values():
+        if len(ix) < 2:
+            continue
+        ix = np.flatnonzero(located)[ix]
+        src, dst = radius_edges(coords[ix], radius_m)
+        srcs.append(ix[src])
+        dsts.append(ix[dst])
+
+    src = np.concatenate(srcs) if srcs else np.zeros(0, dtype=int)
+    dst = np.concatenate(dsts) if dsts else np.zeros(0, dtype=int)
+    graph = coo_matrix((np.ones(len(src), dtype=bool), (src, dst)), shape=(len(points), len(points)))
+    _, point_labels = connected_components(graph, directed=False)
+
+    return pd.factorize(point_labels[point_ix])[0]
+
+
+def touched_neighborhood(ops_df: pd.DataFrame, touched: np.ndarray, radius_m: float = SEARCH_RADIUS_M) -> np.ndarray:
+    """ Rows connected to a touched row by a chain of same organization rows closer than radius_m
+
+        The result is closed under the radius graph, so clustering only these rows gives
+        the same clusters for them as clustering the whole frame.
 
         arguments:
-            df (DataFrame): dataframe for a single cluster
+            ops_df (DataFrame): OPS rows with ORGANIZATION_ID, LATITUDE and LONGITUDE
+            touched (ndarray): boolean mask of new or changed rows
+            radius_m (float): search radius in meters
 
         returns:
-            str: name of cluster
+            ndarray: boolean mask of the rows in the neighborhood of touched rows
     """
-    clustix = df.CLUSTER.iloc[0]
-    city = df.OPS_CITY.value_counts().idxmax()
-    street = df.OPS_STREET.value_counts().idxmax()
-    state = df.OPS_STATE.value_counts().idxmax()
-    zip5 = df.OPS_ZIP5.value_counts().idxmax()
-    orgid = df.ORGANIZATION_ID.value_counts().idxmax()
-    orgname = df.ORGANIZATION_NAME.value_counts().idxmax()
-    return clustix, city, state, street, zip5, orgid, orgname
-
-
-def cluster_to_ops(df):
-    if len(df) > 1:
-        ix, city, state, street, zip5, orgid, orgname = cluster_desc(df)
-        lat = df["LATITUDE"].mean()
-        lon = df["LONGITUDE"].mean()
-        children = df["ID"].values.tolist()
-
-        record = pd.Series(dict(
-            ID=str(uuid1()),
-            OPS_LOC_NAME=f"{orgname} {state} P{ix} {street} {city}",
-            MAIN_LOC_NAME=f"{orgname} {state} P{ix}",
-            OPS_STREET = street,
-            OPS_CITY = city,
-            OPS_STATE = state,
-            OPS_ZIP5 = zip5,
-            OPS_MARKER = None,
-            OPS_SUBLOCATION = "",
-            ORGANIZATION_ID = orgid,
-            ORGANIZATION_NAME = orgname,
-            LATITUDE = lat,
-            LONGITUDE = lon,
-            CLUSTER = ix,
-            children = children,
-            GEOCODE_ACCURACY = None,
-            GEOCODE_LEVEL = None,
-            IS_RESIDENTIAL = False,
-            CURATED = False,
-            IS_SITE = True,
-            IS_ADDRESS = False,
-            IS_BUILDING = False
-        ))
-        return record.to_frame().T
+    reached = np.asarray(touched, dtype=bool).copy()
+    coords = np.deg2rad(ops_df[["LATITUDE", "LONGITUDE"]].to_numpy(dtype=float))
+    located = np.flatnonzero(~np.isnan(coords).any(axis=1))
+
+    for ix in ops_df.iloc[located].groupby("ORGANIZATION_ID", sort=False, dropna=False).indices.values():
+        ix = located[ix]
+        seen = reached[ix]
+        if not seen.any() or seen.all():
+            continue
+
+        tree = BallTree(coords[ix], metric="haversine")
+        frontier = np.flatnonzero(seen)
+        while len(frontier) > 0:
+            neighbors, dists = tree.query_radius(coords[ix[frontier]], r=radius_m / EARTH_RADIUS_M, return_distance=True)
+            candidates = np.unique(np.concatenate(neighbors)[np.concatenate(dists) * EARTH_RADIUS_M < radius_m])
+            frontier = candidates[~seen[candidates]]
+            seen[frontier] = True
+        reached[ix] = seen
+
+    return reached
 
 
 @timer(logger)
-def cluster_ops(ops_df: pd.DataFrame) -> pd.DataFrame:
+def cluster_ops(ops_df: pd.DataFrame, offset: int = 0) -> pd.DataFrame:
     """Cluster OPS locations to determine parent nodes
 
     Args:
         ops_df (pd.DataFrame): dataframe of OPS rows
+        offset (int): first cluster number, parent names are numbered from it
 
     Returns:
         pd.DataFrame: Parent node OPS records
     """
-    onehot_encoding = OneHotEncoder().fit_transform(ops_df[["ORGANIZATION_ID"]])
-    if "ARM64" not in str(os.uname()):
-        organisation_mask = dot_product_mkl(onehot_encoding,onehot_encoding.T).toarray()
-    else:
-        organisation_mask = np.dot(onehot_encoding, onehot_encoding.T).toarray()
-    organisation_mask = organisation_mask.astype(bool)
+    ops_df = ops_df.assign(CLUSTER=cluster_labels(ops_df) + offset)
+    return clusters_to_ops(ops_df)
 
-    dists = haversine_distances(ops_df[["LATITUDE", "LONGITUDE"]].apply(np.deg2rad)) * EARTH_RADIUS_M
-    dists[~organisation_mask] = 1e8
 
-    agg = AgglomerativeClustering(
-        affinity="precomputed",
-        linkage="single",
-        n_clusters=None,
-        distance_threshold = SEARCH_RADIUS_M,
-        compute_full_tree=True
-    ).fit(dists)
+def partition_by_organization(ops_df: pd.DataFrame, n_partitions: int) -> list:
+    """ Splits OPS rows into at most n_partitions frames of whole organizations
 
-    ops_df = ops_df.assign(CLUSTER=agg.labels_)
-    cluster_df = ops_df.groupby("CLUSTER").apply(cluster_to_ops)
+        Clusters never span organizations, so partitions can be clustered independently.
+        Organizations are assigned largest first to the partition with the fewest rows.
 
-    if len(cluster_df) > 0:
-        return cluster_df.dropna(subset=["OPS_LOC_NAME"])
-    return cluster_df
+        arguments:
+            ops_df (DataFrame): OPS rows with ORGANIZATION_ID
+            n_partitions (int): maximum number of partitions
+
+        returns:
+            list: list of DataFrames
+    """
+    org_codes = ops_df.groupby("ORGANIZATION_ID", sort=False, dropna=False).ngroup().to_numpy()
+    org_sizes = np.bincount(org_codes)
+
+    loads = np.zeros(max(1, min(n_partitions, len(org_sizes))), dtype=int)
+    org_partition = np.zeros(len(org_sizes), dtype=int)
+    for org in np.argsort(-org_sizes, kind="stable"):
+        org_partition[org] = loads.argmin()
+        loads[org_partition[org]] += org_sizes[org]
+
+    return [partition for _, partition in ops_df.groupby(org_partition[org_codes])]
+
+
+@contextmanager
+def cluster_pool(n_workers: int = CLUSTER_WORKERS):
+    """ Process pool for the partitions of every scope of a task, None with a single worker
+
+        Open it once per task and pass it to every scope: each spawned worker imports the
+        modules of the task again, which would cost more than small scopes take to cluster.
+    """
+    if n_workers <= 1:
+        yield None
+        return
+    # spawned workers, forking would copy the locks held by the pipeline and connection pool threads
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        yield pool
+
+
+def iter_partition_parents(partitions: list, pool: ProcessPoolExecutor = None):
+    """ Yields the parents of every partition, in order of completion when run on a process pool """
+    # a partition has at most one cluster per row, so these offsets keep cluster numbers, and with
+    # them parent names, unique across partitions even for organizations that share a name
+    offsets = np.cumsum([0] + [len(partition) for partition in partitions[:-1]])
+    if pool is None or len(partitions) <= 1:
+        for partition, offset in zip(partitions, offsets):
+            yield cluster_ops(partition, int(offset))
+        return
+
+    futures = [pool.submit(cluster_ops, partition, int(offset)) for partition, offset in zip(partitions, offsets)]
+    for future in as_completed(futures):
+        yield future.result()
 
 
 @timer(logger)
-def cluster_ops_from_snowflake(scope: ScopeBase):
+def cluster_ops_partitioned(
+    ops_df: pd.DataFrame,
+    on_parents: callable = None,
+    pool: ProcessPoolExecutor = None,
+    n_workers: int = CLUSTER_WORKERS,
+    min_parallel_rows: int = MIN_PARALLEL_ROWS,
+) -> pd.DataFrame:
+    """Cluster OPS locations per organization partition, in parallel
 
+    Args:
+        ops_df (pd.DataFrame): dataframe of OPS rows
+        on_parents (callable): called with the parents of each partition as soon as it is done
+        pool (ProcessPoolExecutor): workers of the task, see cluster_pool, in process if None
+        n_workers (int): number of workers of the pool
+        min_parallel_rows (int): number of rows under which the pool is not used
+
+    Returns:
+        pd.DataFrame: Parent node OPS records of all partitions
+    """
+    partitions = partition_by_organization(ops_df, n_workers * PARTITIONS_PER_WORKER)
+    if len(ops_df) < min_parallel_rows:
+        pool = None
+
+    results = []
+    for parents in iter_partition_parents(partitions, pool):
+        if len(parents) == 0:
+            continue
+        if on_parents is not None:
+            on_parents(parents)
+        results.append(parents)
+
+    if len(results) == 0:
+        return pd.DataFrame(columns=PARENT_COLUMNS)
+    return pd.concat(results, ignore_index=True)
+
+
+def upload_parents(parents: pd.DataFrame, uploader: UploadOpsLocation = None):
+    """ Writes parents to the cluster temp table and, if given, to the uploader's preload table """
+    persistence.upload_df(
+        parents[["OPS_LOC_NAME", "children"]].rename(columns={
+            "OPS_LOC_NAME": "parent_loc_name",
+            "children": "child_location_ids",
+        }),
+        table='STG_PARENT_LOC',
+        schema='TEMP'
+    )
+    if uploader is not None:
+        uploader.upload_ops_location_preload_temp_table(parents)
+
+
+@timer(logger)
+def cluster_ops_from_snowflake(scope: ScopeBase, uploader: UploadOpsLocation = None, pool: ProcessPoolExecutor = None):
+    """Cluster the OPS locations of a scope and write the parents as partitions finish
+
+    Args:
+        scope (ScopeBase): scope to cluster
+        uploader (UploadOpsLocation): if given, parents are also streamed to its preload table
+        pool (ProcessPoolExecutor): workers shared by the scopes of the task, see cluster_pool
+
+    Incremental scopes only recluster the neighborhoods of new OPS rows, see cluster_ops_incremental.
+
+    Returns:
+        pd.DataFrame: Parent node OPS records, None if there are none
+    """
+    incremental = scope.incremental
+    if incremental and not scope.has_sites():
+        raise NotImplementedError(f"{type(scope).__name__} has no site query, it cannot be clustered incrementally")
     if scope.incremental:
         scope.incremental = False
 
@@ -120,26 +346,172 @@ def cluster_ops_from_snowflake(scope: ScopeBase):
         logger.warning(f"Not enough OPS locations to cluster")
         return
 
-    parents = cluster_ops(df)
+    if incremental:
+        return cluster_ops_incremental(scope, df, uploader)
+
+    pending = []
+
+    def on_parents(parents):
+        pending.append(parents)
+        if sum(len(p) for p in pending) >= PARENT_UPLOAD_BATCH_ROWS:
+            upload_parents(pd.concat(pending, ignore_index=True), uploader)
+            pending.clear()
+
+    parents = cluster_ops_partitioned(df, on_parents=on_parents, pool=pool)
+
+    if len(pending) > 0:
+        upload_parents(pd.concat(pending, ignore_index=True), uploader)
 
     if len(parents) > 0:
-        
-        # write clusters to temp
-
-        persistence.upload_df(
-            parents[["OPS_LOC_NAME", "children"]].rename(columns={
-                "OPS_LOC_NAME": "parent_loc_name",
-                "children": "child_location_ids",
-            }),
-            table='STG_PARENT_LOC',
-            schema='TEMP'
-        )
         return parents
 
     else:
         logger.warning(f"No valid parents found in scope")
 
 
+def incremental_parent_changes(ops_df: pd.DataFrame, sites_df: pd.DataFrame, new_ids=(), changed_ids=()) -> dict:
+    """Minimal parent changes after new or changed OPS rows, given the existing parents
+
+    Children point at their parent through MAIN_LOC_NAME = parent OPS_LOC_NAME. New rows, changed
+    rows and the former siblings of changed rows are touched; only the clusters in their
+    neighborhood are recomputed. Rows that are neither linked nor new, e.g. the singletons of
+    earlier runs, are only reclustered when they are in that neighborhood. A recomputed cluster keeps the existing parent it shares
+    most children with, otherwise it gets a new parent. Existing parents left without a cluster
+    are deleted, and their children that end up alone are detached.
+
+    Args:
+        ops_df (pd.DataFrame): non-site OPS rows of a scope, with MAIN_LOC_NAME
+        sites_df (pd.DataFrame): existing site (parent) rows of the same scope
+        new_ids: IDs of the OPS rows inserted since the last clustering, see load_new_ops_ids
+        changed_ids: IDs of existing OPS rows whose coordinates changed
+
+    Returns:
+        dict: "insert" and "update" parent frames, "delete" parent IDs and "detach" child IDs
+    """
+    changes = dict(insert=pd.DataFrame(columns=PARENT_COLUMNS), update=pd.DataFrame(columns=PARENT_COLUMNS), delete=[], detach=[])
+
+    site_ids = dict(zip(sites_df.OPS_LOC_NAME, sites_df.ID))
+    site_main_names = dict(zip(sites_df.OPS_LOC_NAME, sites_df.MAIN_LOC_NAME))
+
+    linked = ops_df.MAIN_LOC_NAME.isin(site_ids)
+    touched = ops_df.ID.isin(new_ids) | ops_df.ID.isin(changed_ids)
+    # a changed row may have left its cluster, so its former siblings are reclustered too
+    touched |= linked & ops_df.MAIN_LOC_NAME.isin(ops_df.MAIN_LOC_NAME[touched & linked])
+    if not touched.any():
+        return changes
+
+    hood = ops_df[touched_neighborhood(ops_df, touched.to_numpy())]
+
+    # number new clusters after the existing ones, so parent names stay unique
+    numbers = pd.to_numeric(sites_df.MAIN_LOC_NAME.str.extract(r" P(\d+)$")[0], errors="coerce")
+    offset = int(numbers.max()) + 1 if numbers.notna().any() else 0
+    parents = clusters_to_ops(hood.assign(CLUSTER=cluster_labels(hood) + offset))
+
+    links = (
+        parents[["CLUSTER", "children"]].explode("children").rename(columns={"children": "ID"})
+        .merge(hood[["ID", "MAIN_LOC_NAME"]], on="ID")
+    )
+    links = links[links.MAIN_LOC_NAME.isin(site_ids)]
+    overlap = links.groupby(["CLUSTER", "MAIN_LOC_NAME"], sort=False).size().sort_values(ascending=False, kind="stable")
+
+    kept = {}
+    for cluster, name in overlap.index:
+        if cluster not in kept and name not in kept.values():
+            kept[cluster] = name
+
+    old_children = hood[hood.MAIN_LOC_NAME.isin(site_ids)].groupby("MAIN_LOC_NAME")["ID"].agg(frozenset)
+    is_kept = parents.CLUSTER.isin(kept)
+    updates = parents[is_kept].copy()
+    updates["OPS_LOC_NAME"] = updates.CLUSTER.map(kept)
+    updates["ID"] = updates.OPS_LOC_NAME.map(site_ids)
+    updates["MAIN_LOC_NAME"] = updates.OPS_LOC_NAME.map(site_main_names)
+    unchanged = updates.children.apply(frozenset) == updates.OPS_LOC_NAME.map(old_children)
+
+    clustered = set(parents.children.explode())
+    changes["insert"] = parents[~is_kept].reset_index(drop=True)
+    changes["update"] = updates[~unchanged].reset_index(drop=True)
+    changes["delete"] = [site_ids[name] for name in old_children.index if name not in kept.values()]
+    changes["detach"] = hood.ID[hood.MAIN_LOC_NAME.isin(site_ids) & ~hood.ID.isin(clustered)].tolist()
+    return changes
+
+
+def moved_children(ops_df: pd.DataFrame, sites_df: pd.DataFrame) -> list:
+    """IDs of the children of sites that no longer sit at the mean of their children
+
+    A site is written at the mean coordinates of its children, so a site that moved away
+    from that mean lost, gained or moved children since it was clustered.
+
+    Args:
+        ops_df (pd.DataFrame): non-site OPS rows of a scope, with MAIN_LOC_NAME
+        sites_df (pd.DataFrame): existing site (parent) rows of the same scope
+
+    Returns:
+        list: IDs of the current children of those sites
+    """
+    linked = ops_df[ops_df.MAIN_LOC_NAME.isin(sites_df.OPS_LOC_NAME)]
+    means = linked.groupby("MAIN_LOC_NAME")[["LATITUDE", "LONGITUDE"]].mean()
+    sites = sites_df.drop_duplicates("OPS_LOC_NAME").set_index("OPS_LOC_NAME")[["LATITUDE", "LONGITUDE"]]
+    sites = sites.reindex(means.index)
+    moved = ~np.isclose(
+        means.to_numpy(dtype=float), sites.to_numpy(dtype=float), rtol=0, atol=SITE_DRIFT_DEGREES, equal_nan=True
+    ).all(axis=1)
+    return linked.ID[linked.MAIN_LOC_NAME.isin(means.index[moved])].tolist()
+
+
+def clear_new_ops_table():
+    """ Creates or empties the table of the OPS rows inserted by the run """
+    with persistence.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""create table if not exists TEMP{os.getenv("RUN_SCHEMA_NAME", '')}.{NEW_OPS_TABLE} (ID VARCHAR(36))""")
+    persistence.truncate_table("TEMP", NEW_OPS_TABLE)
+
+
+@lru_cache(maxsize=1)
+def load_new_ops_ids() -> frozenset:
+    """ IDs of the OPS rows inserted by the run, loaded once per process """
+    df = persistence.get_df(f"""select distinct ID from TEMP{os.getenv("RUN_SCHEMA_NAME", '')}.{NEW_OPS_TABLE}""")
+    if df is None:
+        raise RuntimeError(f"Could not load the new OPS rows from {NEW_OPS_TABLE}")
+    return frozenset(df.ID)
+
+
+@timer(logger)
+def cluster_ops_incremental(scope: ScopeBase, ops_df: pd.DataFrame, uploader: UploadOpsLocation = None, new_ids=None) -> pd.DataFrame:
+    """Recluster only the neighborhoods of new or moved OPS rows of a scope and apply the parent changes
+
+    Args:
+        scope (ScopeBase): scope to cluster
+        ops_df (pd.DataFrame): non-residential, non-site OPS rows of the scope
+        uploader (UploadOpsLocation): if given, new parents are also written to its preload table
+        new_ids: IDs of the new OPS rows, the ones inserted by the run by default
+
+    Returns:
+        pd.DataFrame: inserted and updated parent records
+    """
+    sites_df = scope.get_sites()
+    new_ids = load_new_ops_ids() if new_ids is None else new_ids
+    changes = incremental_parent_changes(
+        ops_df, sites_df, new_ids=new_ids, changed_ids=moved_children(ops_df, sites_df)
+    )
+    logger.info(
+        f"Incremental clustering: {len(changes['insert'])} new, {len(changes['update'])} updated, "
+        f"{len(changes['delete'])} deleted parents, {len(changes['detach'])} detached children"
+    )
+
+    if len(changes["delete"]) > 0:
+        delete_ops_locations(changes["delete"])
+    if len(changes["detach"]) > 0:
+        detach_ops_locations(changes["detach"])
+    if len(changes["update"]) > 0:
+        update_parent_coordinates(changes["update"])
+        # children of updated parents are relinked by commit_clusters
+        upload_parents(changes["update"])
+    if len(changes["insert"]) > 0:
+        upload_parents(changes["insert"], uploader)
+
+    return pd.concat([changes["insert"], changes["update"]], ignore_index=True)
+
+
 def clear_cluster_temp_table():
     persistence.truncate_table("TEMP", "STG_PARENT_LOC")
 
@@ -165,3 +537,30 @@ def commit_clusters():
         logger.info("Merging parents into ops rows")
         with conn.cursor() as cur:
             cur.execute(sql)
+
+
+def execute_for_ids(sql: str, ids: list):
+    """ Runs sql, with an {ids} placeholder for the IN list, on batches of at most MAX_IDS_PER_STATEMENT ids """
+    ids = list(ids)
+    with persistence.get_conn() as conn:
+        with conn.cursor() as cur:
+            for i in range(0, len(ids), MAX_IDS_PER_STATEMENT):
+                batch = ids[i:i + MAX_IDS_PER_STATEMENT]
+                cur.execute(sql.format(ids=",".join(["%s"] * len(batch))), batch)
+
+
+def delete_ops_locations(ids: list):
+    execute_for_ids(f"""DELETE FROM CIM{os.getenv("RUN_SCHEMA_NAME", '')}.LOCATION WHERE ID IN ({{ids}});""", ids)
+
+
+def detach_ops_locations(ids: list):
+    execute_for_ids(
+        f"""UPDATE CIM{os.getenv("RUN_SCHEMA_NAME", '')}.LOCATION SET MAIN_LOC_NAME = NULL WHERE ID IN ({{ids}});""", ids
+    )
+
+
+def update_parent_coordinates(parents: pd.DataFrame):
+    with persistence.get_conn() as conn:
+        sql = f"""UPDATE CIM{os.getenv("RUN_SCHEMA_NAME", '')}.LOCATION SET LATITUDE = %s, LONGITUDE = %s WHERE ID = %s;"""
+        with conn.cursor() as cur:
+            cur.executemany(sql, list(zip(parents.LATITUDE.astype(float), parents.LONGITUDE.astype(float), parents.ID)))
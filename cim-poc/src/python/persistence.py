@@ -1,4 +1,7 @@
+import atexit
 import os
+import threading
+import time
 import urllib
 import snowflake.connector as sfc
 from snowflake.connector.pandas_tools import write_pandas
@@ -6,20 +9,175 @@ from sqlalchemy import create_engine
 
 import environment
 
-from loggers import get_logger, timer
+from loggers import get_logger, timer, timer_metrics
 
 logger = get_logger("PERSISTENCE")
-static_connection = None
 
+POOL_SIZE = int(os.getenv("SF_POOL_SIZE", 4))
+POOL_TIMEOUT_SECONDS = float(os.getenv("SF_POOL_TIMEOUT_SECONDS", 600))
+# idle connections older than this are pinged before they are handed out again
+POOL_HEALTH_CHECK_SECONDS = float(os.getenv("SF_POOL_HEALTH_CHECK_SECONDS", 300))
 
-def get_conn():
-    global static_connection
-    logger.debug('Connecting to the Snowflake database...')
-    params = environment.read()
-    if static_connection is None or static_connection.is_closed():
-        static_connection = sfc.connect(**params)
 
-    return static_connection
+class _Lease:
+    """ A pool connection checked out by one thread, shared by its nested get_conn calls """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+
+
+class PooledConnection:
+    """
+    Connection handed out by the pool. Behaves like a snowflake connection, but close() and
+    leaving a `with` block give the connection back to the pool instead of logging out.
+    """
+
+    def __init__(self, pool, lease: _Lease):
+        self._pool = pool
+        self._lease = lease
+        self._released = False
+        lease.depth += 1
+
+    def __getattr__(self, name):
+        return getattr(self._lease.conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # same teardown as the snowflake connection's own context manager, minus the logout
+        try:
+            if not getattr(self._lease.conn, "_session_parameters", {}).get("AUTOCOMMIT", False):
+                if exc_tb is None:
+                    self._lease.conn.commit()
+                else:
+                    self._lease.conn.rollback()
+        finally:
+            self.close()
+
+    def is_closed(self):
+        return self._released or self._lease.conn.is_closed()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._lease)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of snowflake connections. A thread holds at most one connection at a time,
+    nested checkouts in the same thread share it. Idle connections are health checked before
+    reuse, and a forked process starts with an empty pool instead of sharing its parent's sessions.
+    """
+
+    def __init__(
+            self,
+            connect: callable,
+            max_size: int = POOL_SIZE,
+            timeout: float = POOL_TIMEOUT_SECONDS,
+            health_check_seconds: float = POOL_HEALTH_CHECK_SECONDS,
+    ):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._idle = []
+        self._local = threading.local()
+
+    def checkout(self) -> PooledConnection:
+        if os.getpid() != self._pid:
+            self._reset()
+
+        lease = getattr(self._local, "lease", None)
+        if lease is not None and lease.depth > 0:
+            timer_metrics(connection_reused=True)
+            return PooledConnection(self, lease)
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No snowflake connection available after {self.timeout} seconds")
+        try:
+            conn, reused = self._take_idle()
+        except Exception:
+            self._slots.release()
+            raise
+
+        timer_metrics(connection_reused=reused)
+        self._local.lease = _Lease(conn)
+        return PooledConnection(self, self._local.lease)
+
+    def _take_idle(self):
+        while True:
+            with self._lock:
+                if len(self._idle) == 0:
+                    break
+                conn, last_used = self._idle.pop()
+            if self._is_healthy(conn, last_used):
+                return conn, True
+            self._close(conn)
+
+        logger.debug('Connecting to the Snowflake database...')
+        return self._connect(), False
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        if conn.is_closed():
+            return False
+        if time.monotonic() - last_used < self.health_check_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1")
+            return True
+        except Exception as error:
+            logger.warning(f"Dropping unhealthy pooled connection: {error}")
+            return False
+
+    def release(self, lease: _Lease):
+        lease.depth -= 1
+        if lease.depth > 0:
+            return
+        if getattr(self._local, "lease", None) is lease:
+            self._local.lease = None
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            self._idle.append((lease.conn, time.monotonic()))
+        self._slots.release()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as error:
+            logger.debug(error)
+
+    def close_all(self):
+        """ Logs out the idle connections """
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+
+pool = ConnectionPool(lambda: sfc.connect(**environment.read()))
+atexit.register(pool.close_all)
+
+
+def get_conn():
+    """
+    Checks out a pooled connection. Use it as a context manager or close() it when done;
+    either returns it to the pool.
+    """
+    return pool.checkout()
 
 
 def engine(cfg=None, schema=None):
@@ -64,6 +222,23 @@ def get_df(sql):
             logger.debug('Database connection closed.')
 
 
+def iter_df(sql, arrow: bool = False):
+    """
+    Streams the result of sql as it is downloaded, one pandas DataFrame (or pyarrow Table
+    with arrow=True) per result batch of the connector, so consumers only hold a batch at
+    a time. Nothing is yielded for an empty result. Unlike get_df, errors are raised.
+    """
+    n_rows = 0
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            batches = cur.fetch_arrow_batches() if arrow else cur.fetch_pandas_batches()
+            for batch in batches:
+                n_rows += batch.num_rows if arrow else len(batch)
+                yield batch
+    logger.debug(f"Streamed {n_rows} rows")
+
+
 @timer(logger)
 def update_df(df, func):
     conn = None
@@ -2,7 +2,6 @@ import os
 from typing import List
 
 import pandas as pd
-from pandas import Series
 
 import persistence
 
@@ -32,48 +31,63 @@ def insert_stand_alone():
             cur.execute(sql)
 
 
-def get_location():
+BRIDGE_COLUMNS = ['LOCATION_ID_P',
+                  'LOCATION_ID_C',
+                  'LEVELS_REMOVED',
+                  'PARENT_IS_TOP',
+                  'PARENT_IS_BOTTOM',
+                  'CHILD_IS_TOP',
+                  'CHILD_IS_BOTTOM']
+# bridge rows are written in chunks of this size while the locations stream in
+BRIDGE_BATCH_ROWS = 100_000
 
-    truncate_table()
 
-    """ Query from location table to create location hierarchy """
-    """ Return dictionary with key as main_loc_name, and value the list of locations"""
+def iter_location_clusters(batches):
+    """ Yields (main_loc_name, rows) for batches of locations sorted by MAIN_LOC_NAME
+
+        A cluster can straddle two batches, so the last cluster of a batch is only
+        yielded once the next batch (or the end of the stream) shows it is complete.
+    """
+    main_loc_name, rows = None, []
+    for batch in batches:
+        for row in batch[['ID', 'MAIN_LOC_NAME', 'OPS_LOC_NAME']].to_dict('records'):
+            if row['MAIN_LOC_NAME'] != main_loc_name and len(rows) > 0:
+                yield main_loc_name, rows
+                rows = []
+            main_loc_name = row['MAIN_LOC_NAME']
+            rows.append(row)
+    if len(rows) > 0:
+        yield main_loc_name, rows
 
-    sql = f"""SELECT ID, MAIN_LOC_NAME, OPS_LOC_NAME FROM CIM{os.getenv("RUN_SCHEMA_NAME", '')}.location WHERE MAIN_LOC_NAME IS NOT NULL"""
-    df = persistence.get_df(sql)
 
-    loc_dict = {}
+def get_location():
 
-    for index, row in df.iterrows():
-        if loc_dict.get(row['MAIN_LOC_NAME']) is None:
-            loc_dict[row['MAIN_LOC_NAME']] = []
-        if row['MAIN_LOC_NAME'] is not None:
-            loc_dict.get(row['MAIN_LOC_NAME']).append(row)
+    truncate_table()
 
-    bridge_df = pd.DataFrame(data=[], columns=['LOCATION_ID_P',
-                                               'LOCATION_ID_C',
-                                               'LEVELS_REMOVED',
-                                               'PARENT_IS_TOP',
-                                               'PARENT_IS_BOTTOM',
-                                               'CHILD_IS_TOP',
-                                               'CHILD_IS_BOTTOM'])
+    """ Query from location table to create location hierarchy """
+    """ Locations are streamed sorted by main_loc_name, one cluster of locations at a time"""
 
-    for key in loc_dict.keys():
-        to_append_list = find_main_loc(key, loc_dict[key])
-        for item in to_append_list:
-            bridge_df.loc[len(bridge_df)] = item
+    sql = f"""SELECT ID, MAIN_LOC_NAME, OPS_LOC_NAME FROM CIM{os.getenv("RUN_SCHEMA_NAME", '')}.location WHERE MAIN_LOC_NAME IS NOT NULL ORDER BY MAIN_LOC_NAME"""
 
-    logger.info(bridge_df.info())
+    bridge_rows = []
+    n_bridge_rows = 0
+    for main_loc_name, location_cluster in iter_location_clusters(persistence.iter_df(sql)):
+        bridge_rows.extend(find_main_loc(main_loc_name, location_cluster))
+        if len(bridge_rows) >= BRIDGE_BATCH_ROWS:
+            persistence.insert_to_db(pd.DataFrame(bridge_rows, columns=BRIDGE_COLUMNS), 'BRG_LOCATION')
+            n_bridge_rows += len(bridge_rows)
+            bridge_rows = []
 
-    if bridge_df is not None and bridge_df.shape[0] > 0:
+    bridge_df = pd.DataFrame(bridge_rows, columns=BRIDGE_COLUMNS)
+    if bridge_df.shape[0] > 0:
         persistence.insert_to_db(bridge_df, 'BRG_LOCATION')
+    n_bridge_rows += len(bridge_rows)
+    logger.info(f"Inserted {n_bridge_rows} rows into BRG_LOCATION")
 
     insert_stand_alone()
 
-    return bridge_df
-
 
-def find_main_loc(main_loc_name: str, location_cluster: List[Series]):
+def find_main_loc(main_loc_name: str, location_cluster: List[dict]):
     parent_id = None
     for item in location_cluster:
         if item['MAIN_LOC_NAME'] == main_loc_name:
@@ -18,6 +18,14 @@ class ScopeBase:
             self._ops_query()
         )
 
+    def get_sites(self):
+        """
+        Returns a dataframe containing the site (parent) ops records for the given scope
+        """
+        return persistence.get_df(
+            self._sites_query()
+        )
+
     def get_dim(self):
         """
         Returns a dataframe containing the dim records for the given scope
@@ -77,6 +85,16 @@ class ScopeBase:
         })
         return cls(**data.to_dict(orient='list'), incremental=incremental)
 
+    @classmethod
+    def from_manifest(cls, manifest, k: int):
+        """
+        Builds the scope of chunk k of a utils.scopemanifest.ScopeManifest
+        """
+        return cls.from_dataframe(
+            manifest.chunk(k).drop(columns=["SIZE"], errors="ignore"),
+            incremental=manifest.incremental
+        )
+
     @abstractmethod
     def _dim_query(self):
         pass
@@ -85,6 +103,15 @@ class ScopeBase:
     def _ops_query(self):
         pass
 
+    @abstractmethod
+    def _sites_query(self):
+        pass
+
+    @classmethod
+    def has_sites(cls) -> bool:
+        """ Whether the scope implements _sites_query, which incremental clustering needs """
+        return cls._sites_query is not ScopeBase._sites_query
+
     @abstractstaticmethod
     def _dim_size_query(**kws):
         pass
@@ -1,12 +1,21 @@
 import os
+import uuid
 from typing import Union
 
+import pandas as pd
+from snowflake.connector.pandas_tools import write_pandas
+
 import environment
+import persistence
 from .base import MAGIC_SEPARATOR, ScopeBase
 
 SO_SCHEMA = "SALES_ORDER"+os.getenv("RUN_SCHEMA_NAME", '')
 DIM_LOCATION = "DIM_LOCATION_SALES_ORDER"
 FCT_ORDER = "FCT_SALES_ORDER"
+# scopes with at least this many org/state pairs fetch their dims through a temp table join
+# instead of literal IN lists, whose compile time grows with the number of pairs
+BULK_DIM_MIN_SCOPES = int(os.getenv("BULK_DIM_MIN_SCOPES", 100))
+
 
 class ScopeSalesOrderOrgIdState(ScopeBase):
 
@@ -39,7 +48,69 @@ class ScopeSalesOrderOrgIdState(ScopeBase):
         states = ','.join(f"'{state}'" for state in self.states)
         orgstates = ','.join(f"'{org}{MAGIC_SEPARATOR}{state}'" for org, state in zip(self.organization_ids, self.states))
         return orgs, states, orgstates
-    
+
+    def get_dim(self):
+        """
+        Returns a dataframe containing the dim records for the given scope, fetched with a
+        single temp table join when the scope holds many org/state pairs. Unlike the per
+        scope query, a failed bulk query raises instead of returning None.
+        """
+        if len(self.organization_ids) < BULK_DIM_MIN_SCOPES:
+            return super().get_dim()
+
+        # the temporary table only lives in this session, so the join runs on the same connection
+        with persistence.get_conn() as conn:
+            keys_table = self._write_scope_keys(conn)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(self._bulk_dim_query(keys_table))
+                    return cur.fetch_pandas_all()
+            finally:
+                conn.cursor().execute(f"drop table if exists {keys_table}")
+
+    def _write_scope_keys(self, conn) -> str:
+        """ Stages the org/state pairs into a session temporary table and returns its name """
+        schema = f"TEMP{os.getenv('RUN_SCHEMA_NAME', '')}"
+        table = f"SCOPE_KEYS_{uuid.uuid4().hex.upper()}"
+        with conn.cursor() as cur:
+            cur.execute(f"create temporary table {schema}.{table} (ORGANIZATION_ID VARCHAR(32), STATE VARCHAR(200))")
+        keys = pd.DataFrame(
+            list(dict.fromkeys(zip(self.organization_ids, self.states))),
+            columns=["ORGANIZATION_ID", "STATE"]
+        )
+        write_pandas(conn, keys, table_name=table, schema=schema, quote_identifiers=False)
+        return f"{schema}.{table}"
+
+    def _bulk_dim_query(self, keys_table: str):
+        return f"""select distinct
+            dl.ID,
+            dl.SOLD_ACCOUNT, 
+            dl.SHIP_ACCOUNT, 
+            dl.TRACK_CODE,
+            dl.SUB_TRACK_CODE, 
+            dl.DEPARTMENT, 
+            dl.ATTENTION, 
+            dl.SUPPLEMENTAL,
+            dl.RECEIVER, 
+            dl.STREET_NUM, 
+            dl.STREET, 
+            dl.CITY, 
+            dl.STATE,
+            dl.ZIP5, 
+            dl.COUNTRY,
+            oo.ORGANIZATION_NAME,
+            oo.ID as ORGANIZATION_ID
+        from {SO_SCHEMA}.{DIM_LOCATION} dl
+        inner join CIM{os.getenv("RUN_SCHEMA_NAME", '')}.ORGANIZATION_SOLDTO_ACCOUNT oa on oa.ACCOUNT = dl.SOLD_ACCOUNT 
+        inner join {keys_table} sk on sk.ORGANIZATION_ID = oa.ORGANIZATION_ID and sk.STATE = dl.STATE
+        left join CIM{os.getenv("RUN_SCHEMA_NAME", '')}.ORGANIZATION oo on oa.ORGANIZATION_ID = oo.ID
+        where oa.ACCOUNT not in (
+            SELECT ACCOUNT FROM {self.reference_table}
+        )
+        {'and OPS_LOCATION_ID is NULL' if self.incremental else ''}
+        order by dl.STREET
+        """
+
     def _dim_query(self):
         orgs, states, orgstates = self._prepare_where_clauses()
 
@@ -74,18 +145,21 @@ class ScopeSalesOrderOrgIdState(ScopeBase):
         order by STREET
         """
 
-    def _ops_query(self):
+    def _ops_query(self, is_site: bool = False):
         orgs, states, orgstates = self._prepare_where_clauses()
 
         return f"""select
             *
         from CIM{os.getenv("RUN_SCHEMA_NAME", '')}.LOCATION
-        where IS_SITE = FALSE
+        where IS_SITE = {'TRUE' if is_site else 'FALSE'}
         and ORGANIZATION_ID in ({orgs}) -- more efficient subset
         and OPS_STATE in ({states})
         and concat(ORGANIZATION_ID, '{MAGIC_SEPARATOR}', OPS_STATE) in ({orgstates})
         """
 
+    def _sites_query(self):
+        return self._ops_query(is_site=True)
+
     @staticmethod
     def _dim_size_query(between: tuple = None, incremental: bool = False):
         reference_table = environment.read()["invalid_accounts_table"]
@@ -0,0 +1,17 @@
+import os
+
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: timing comparison against the legacy code, run with RUN_BENCHMARKS=1")
+
+
+def pytest_collection_modifyitems(config, items):
+    # timings are too noisy for the regular unit run
+    if os.getenv("RUN_BENCHMARKS"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, set RUN_BENCHMARKS=1 to run it")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
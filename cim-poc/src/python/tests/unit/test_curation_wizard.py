@@ -1,6 +1,10 @@
+import re
+import timeit
+
 import src.python.curation_wizard as cw
 import pandas as pd
 import numpy as np
+import pytest
 
 pd.set_option('display.max_rows', None)
 pd.set_option('display.max_columns', None)
@@ -79,6 +83,231 @@ def test_order_switch():
     assert set(result.OPS_STREET) == set(["1 North High Street"])
 
 
+def legacy_order_switch_dict(df):
+    df["sorted"] = df["tokens"].apply(lambda tokens: tuple(sorted(tokens)))
+    df["sorted_cnt"] = df.groupby("sorted").address.transform("count")
+    df = df[df["sorted_cnt"] > 1]
+    order_switch_dict = {}
+    for index, row in df.iterrows():
+        most_common_address_with_same_sorted = (
+            df[df["sorted"] == row["sorted"]]
+            .sort_values("cnt", ascending=False)
+            .reset_index(drop=True)
+            .iloc[0]
+            .address
+        )
+        if row.address != most_common_address_with_same_sorted:
+            order_switch_dict[row.tokens] = most_common_address_with_same_sorted
+    return order_switch_dict
+
+
+def test_order_switch_dict_matches_legacy():
+    rng = np.random.default_rng(42)
+    words = ["North", "High", "Main", "Street", "Avenue"]
+
+    for _ in range(20):
+        addresses = set()
+        for _ in range(rng.integers(1, 80)):
+            tokens = [str(rng.integers(1, 4))] + list(rng.choice(words, size=rng.integers(1, 4), replace=False))
+            addresses.add(" ".join(rng.permutation(tokens)))
+        addresses = sorted(addresses)
+
+        address_series = pd.Series(np.repeat(addresses, rng.integers(1, 6, size=len(addresses))))
+        df = (
+            address_series.value_counts()
+            .rename("cnt")
+            .to_frame()
+            .reset_index()
+            .rename({"index": "address"}, axis=1)
+        )
+        df["tokens"] = df["address"].apply(lambda address: tuple(address.split()))
+
+        expected = legacy_order_switch_dict(df.copy())
+        result = cw.CurationWizard.generate_order_switch_dict(df.copy())
+        assert result == expected
+
+
+def test_order_switch_dict_empty():
+    df = pd.DataFrame({"address": ["1 Main Street"], "cnt": [1], "tokens": [("1", "Main", "Street")]})
+    assert cw.CurationWizard.generate_order_switch_dict(df) == {}
+
+
+def test_resolve_statistical_dict():
+    statistical_dict = {
+        ("Jefferson", "Avenue"): "140 Jefferson Avenue",
+        ("140", "Jefferson", "Avenue"): "140 North Jefferson Avenue",
+        ("1", "High", "Street"): "1 Low Street",
+        ("1", "Low", "Street"): "1 High Street",
+    }
+    resolved = cw.CurationWizard.resolve_statistical_dict(statistical_dict)
+
+    assert resolved[("Jefferson", "Avenue")] == "140 North Jefferson Avenue"
+    assert resolved[("140", "Jefferson", "Avenue")] == "140 North Jefferson Avenue"
+    # cycles terminate instead of looping forever
+    assert resolved[("1", "High", "Street")] in ("1 High Street", "1 Low Street")
+
+    addresses = pd.Series(["Jefferson Avenue", "140 Jefferson Avenue", "9 Oak Road", "Jefferson Avenue"])
+    result = cw.CurationWizard.apply_statistical_dict_series(addresses, statistical_dict)
+    assert result.tolist() == [
+        "140 North Jefferson Avenue",
+        "140 North Jefferson Avenue",
+        "9 Oak Road",
+        "140 North Jefferson Avenue",
+    ]
+    assert result.tolist() == [
+        cw.CurationWizard.apply_statistical_dict(address, statistical_dict) for address in addresses
+    ]
+
+
+def test_smart_apply_unique():
+    calls = []
+
+    def func(address):
+        calls.append(address)
+        return address.upper()
+
+    series = pd.Series(["a", "b", "a", np.nan, "b", "a", np.nan], index=np.arange(10, 17), name="ADDRESS")
+    result = cw.CurationWizard.smart_apply(series, lambda x: func(x) if isinstance(x, str) else "", unique=True)
+
+    assert len(calls) == 2
+    assert result.name == "ADDRESS"
+    assert (result.index == series.index).all()
+    assert result.tolist() == ["A", "B", "A", "", "B", "A", ""]
+
+    result = cw.CurationWizard.smart_apply(series.fillna(""), str.startswith, unique=True, args=("a",))
+    assert result.tolist() == [True, False, True, False, False, True, False]
+
+
+def test_smart_apply_backends():
+    series = pd.Series(["main st", "broad st", "high st"] * 50, index=np.arange(150) * 2, name="ADDRESS")
+    expected = series.apply(str.upper)
+
+    for backend in ["serial", "thread", "process", "auto"]:
+        result = cw.CurationWizard.smart_apply(series, str.upper, backend=backend)
+        pd.testing.assert_series_equal(result, expected)
+
+    result = cw.CurationWizard.smart_apply(series, str.startswith, unique=True, backend="thread", args=("main",))
+    assert result.sum() == 50
+
+    try:
+        cw.CurationWizard.smart_apply(series, str.upper, backend="gpu")
+        assert False, "unknown backend should raise"
+    except ValueError:
+        pass
+
+
+def test_choose_backend():
+    choose = cw.executors.choose_backend
+
+    # cheap items never leave the main process, however many there are
+    assert choose(1e-6, 10_000_000, str.upper, n_workers=4) == "serial"
+    # expensive items, but too few of them to amortize the worker startup
+    assert choose(1e-3, 100, str.upper, n_workers=4) == "serial"
+    assert choose(1e-3, 100_000, str.upper, n_workers=1) == "serial"
+    assert choose(1e-3, 100_000, str.upper, n_workers=4) == "process"
+    # lambdas cannot be pickled for the process pool, pandarallel serializes them with dill
+    assert choose(1e-3, 100_000, lambda x: x, n_workers=4, n_threads=1) == "pandarallel"
+    # but forks its workers, which is unsafe while other threads run
+    assert choose(1e-3, 100_000, lambda x: x, n_workers=4, n_threads=3) == "serial"
+
+
+def test_split_chunks():
+    df = pd.DataFrame({"A": np.arange(10)})
+    chunks = cw.executors.split_chunks(df, 4)
+    assert [len(chunk) for chunk in chunks] == [2, 3, 2, 3]
+    assert pd.concat(chunks).equals(df)
+    assert len(cw.executors.split_chunks(df.iloc[:2], 4)) == 2
+
+
+STREET_REGEX_CORPUS = [
+    "10 Street Avenue",
+    "5 Road Road Street",
+    "7 Th Avenue Apt 2",
+    "12 Nd Street",
+    "123 Main Street",
+    "Hwy 59 & Conde St",
+    "East Hwy 160 And Warrior Drive",
+    "US 191 & AZ 264",
+    "I 26 & Hwy 21 South",
+    "International Pkwy",
+    "45 Slowpoke Lane",
+    "",
+]
+
+
+def legacy_clean_final_street_address(street, roadnames):
+    street = re.sub(rf"(\d+) Street ({'|'.join(roadnames)})", r"\1st \2", street)
+    street = re.sub(rf"(\d+) Road ({'|'.join(roadnames)})", r"\1rd \2", street)
+    street = re.sub(rf"(\d+) Th ({'|'.join(roadnames)})", r"\1th \2", street)
+    street = re.sub(rf"(\d+) Nd ({'|'.join(roadnames)})", r"\1nd \2", street)
+    return street
+
+
+def test_street_regex_series_parity():
+    road_names = frozenset(cw.preprocess_loc_row.USPS_DICT.values())
+    series = pd.Series(STREET_REGEX_CORPUS * 3 + [np.nan], index=np.arange(37) + 5)
+
+    streets = series.fillna("")
+    expected = streets.apply(legacy_clean_final_street_address, args=(road_names,))
+    assert expected.tolist()[:4] == ["10st Avenue", "5rd Road Street", "7th Avenue Apt 2", "12nd Street"]
+    pd.testing.assert_series_equal(streets.apply(cw.CurationWizard.clean_final_street_address, args=(road_names,)), expected)
+    pd.testing.assert_series_equal(cw.CurationWizard.clean_final_street_address_series(streets, road_names), expected)
+
+    expected = streets.apply(cw.CurationWizard.handle_intersections)
+    assert expected.sum() == 3 * 5
+    pd.testing.assert_series_equal(cw.CurationWizard.handle_intersections_series(streets), expected)
+    assert not cw.CurationWizard.handle_intersections_series(series).iloc[-1]
+
+
+@pytest.mark.benchmark
+def test_street_regex_benchmark():
+    road_names = frozenset(cw.preprocess_loc_row.USPS_DICT.values())
+    rng = np.random.default_rng(42)
+    series = pd.Series(rng.choice(STREET_REGEX_CORPUS, 5_000))
+    series = series + " " + pd.Series(rng.integers(0, 500, len(series))).astype(str)
+
+    def compare(name, legacy, vectorized):
+        pd.testing.assert_series_equal(vectorized(), legacy())
+        before = min(timeit.repeat(legacy, number=1, repeat=3))
+        after = min(timeit.repeat(vectorized, number=1, repeat=3))
+        print(f"{name} per row: before {1e6 * before / len(series):.1f}us, after {1e6 * after / len(series):.1f}us")
+        assert after < before
+
+    compare(
+        "clean_final_street_address",
+        lambda: series.apply(legacy_clean_final_street_address, args=(road_names,)),
+        lambda: cw.CurationWizard.clean_final_street_address_series(series, road_names),
+    )
+    compare(
+        "handle_intersections",
+        lambda: series.apply(cw.CurationWizard.handle_intersections),
+        lambda: cw.CurationWizard.handle_intersections_series(series),
+    )
+
+
+def test_ops_marker_pattern_cache():
+    marker, pattern = cw.CurationWizard.infer_ops_marker_pattern("Building  21")
+    assert marker == cw.CurationWizard.infer_ops_marker("Building 21")
+    assert pattern.search("123 main st bldg 21 dock 4")
+    assert not pattern.search("123 main st bldg 210")
+
+    # whitespace variants share the cached marker and compiled pattern
+    assert cw.CurationWizard.infer_ops_marker_pattern(" Building 21 ")[1] is pattern
+    assert cw.CurationWizard.infer_ops_marker_pattern("") == (pd.NA, None)
+    for sublocation in [" ", "   ", "\t "]:
+        assert cw.CurationWizard.cached_ops_marker(sublocation) == cw.CurationWizard.infer_ops_marker(sublocation)
+        assert cw.CurationWizard.infer_ops_marker_pattern(sublocation)[0] == r"\b()\b"
+
+    ops = pd.DataFrame({
+        "ID": ["1", "2", "3", "4"],
+        "OPS_MARKER": [marker, None, marker, cw.CurationWizard.infer_ops_marker("Dock 4")],
+    })
+    patterns = cw.CurationWizard.ops_marker_patterns(ops)
+    assert set(patterns) == {"1", "3", "4"}
+    assert patterns["1"] is patterns["3"] is pattern
+    assert patterns["4"].search("Dock-4")
+
+
 def test_remove_garbage_after_suffix():
     TEST_DF = pd.DataFrame({
         "STREET": 4 * ["45 Slowpoke Lane"] + ["45 Slowpoke Lane asdfwaf"] + 3 * ["46 Slowpoke Lane"] + 2 * [
@@ -0,0 +1,129 @@
+import concurrent.futures
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import geocode_broker
+
+
+def addresses(keys):
+    return pd.DataFrame({
+        "KEY": keys,
+        "STREET": [f"{key} MAIN ST" for key in keys],
+        "CITY": "CHICAGO",
+        "STATE": "IL",
+        "ZIP": "60601",
+    })
+
+
+class FakeGeocode:
+    def __init__(self, fail_keys=()):
+        self.batches = []
+        self.fail_keys = set(fail_keys)
+
+    def __call__(self, batch_df):
+        self.batches.append(list(batch_df["KEY"]))
+        if self.fail_keys & set(batch_df["KEY"]):
+            raise ValueError("geocoding failed")
+        return pd.DataFrame({"KEY": batch_df["KEY"], "lat": 41.0, "lon": -87.0})
+
+
+def test_serial_caller_does_not_wait_for_the_latency_window():
+    fake = FakeGeocode()
+    broker = geocode_broker.GeocodeBroker(fake, batch_size=100, max_latency=60)
+
+    t0 = time.perf_counter()
+    results = list(broker.as_completed([broker.submit(addresses(["a", "b", "a"]))], timeout=5))
+
+    assert time.perf_counter() - t0 < 1
+    assert fake.batches == [["a", "b"]]
+    assert sorted(results[0]["KEY"]) == ["a", "b"]
+
+
+def test_coalesces_addresses_of_concurrent_producers():
+    fake = FakeGeocode()
+    broker = geocode_broker.GeocodeBroker(fake, batch_size=100, max_latency=60)
+    submitted = threading.Barrier(3)
+    results = {}
+
+    def scope(name, keys):
+        with broker.producer():
+            future = broker.submit(addresses(keys))
+            submitted.wait()
+            results[name] = next(broker.as_completed([future], timeout=5))
+
+    threads = [
+        threading.Thread(target=scope, args=("first", ["a", "b", "c"])),
+        threading.Thread(target=scope, args=("second", ["b", "c", "d"])),
+        threading.Thread(target=scope, args=("third", ["d", "e"])),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # one batch once every producer waits, with each address once
+    assert len(fake.batches) == 1 and sorted(fake.batches[0]) == ["a", "b", "c", "d", "e"]
+    assert sorted(results["second"]["KEY"]) == ["b", "c", "d"]
+    assert sorted(results["third"]["KEY"]) == ["d", "e"]
+    assert broker.stats["coalesced"] == 3
+
+
+def test_flushes_full_batches_then_the_rest_after_the_latency_window():
+    fake = FakeGeocode()
+    broker = geocode_broker.GeocodeBroker(fake, batch_size=3, max_latency=0.3)
+    future = None
+
+    with broker.producer():
+        future = broker.submit(addresses(list("abcdefg")))
+        time.sleep(0.1)
+        # full batches go out while the producer is still busy
+        assert sorted(map(len, fake.batches)) == [3, 3]
+
+        time.sleep(0.4)
+        assert sorted(map(len, fake.batches)) == [1, 3, 3]
+
+    assert sorted(future.result(timeout=5)["KEY"]) == list("abcdefg")
+
+
+def test_failed_batch_only_fails_its_requests():
+    fake = FakeGeocode(fail_keys=["bad"])
+    broker = geocode_broker.GeocodeBroker(fake, batch_size=2, max_latency=60)
+
+    with broker.producer():
+        good = broker.submit(addresses(["a", "b"]))
+        bad = broker.submit(addresses(["c", "bad"]))
+        completed = []
+        with pytest.raises(ValueError):
+            for df in broker.as_completed([good, bad], timeout=5):
+                completed.append(df)
+
+    assert [sorted(df["KEY"]) for df in completed] == [["a", "b"]]
+    assert isinstance(bad.exception(), ValueError)
+
+
+def test_checkpoints_every_batch_once_even_after_a_timeout():
+    release = threading.Event()
+    checkpoints = []
+
+    def slow(batch_df):
+        release.wait(5)
+        return FakeGeocode()(batch_df)
+
+    broker = geocode_broker.GeocodeBroker(
+        slow, batch_size=100, max_latency=60, checkpoint=lambda batch, result: checkpoints.append(list(batch["KEY"]))
+    )
+    with broker.producer():
+        first = broker.submit(addresses(["a", "b"]))
+        second = broker.submit(addresses(["b", "c"]))
+        with pytest.raises(concurrent.futures.TimeoutError):
+            list(broker.as_completed([first, second], timeout=0.2))
+
+    # the scopes gave up, the batch in flight is still checkpointed when it comes back
+    release.set()
+    assert sorted(first.result(timeout=5)["KEY"]) == ["a", "b"]
+    second.result(timeout=5)
+    assert [sorted(keys) for keys in checkpoints] == [["a", "b", "c"]]
+    assert broker.stats["coalesced"] == 1
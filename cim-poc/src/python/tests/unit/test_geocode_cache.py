@@ -0,0 +1,163 @@
+import contextlib
+import multiprocessing
+import time
+
+import pandas as pd
+
+import geocode
+import geocode_cache
+
+
+def test_address_keys_normalize_case_and_whitespace():
+    parts = pd.DataFrame({
+        "STREET": ["100 Main  St", " 100 MAIN ST", "100 Main St"],
+        "ZIP5": ["60601", "60601", "60602"],
+    })
+
+    keys = geocode_cache.address_keys(parts)
+
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+
+
+def test_local_cache_expires_rows(tmp_path):
+    cache = geocode_cache.LocalGeocodeCache(str(tmp_path / "cache.sqlite"), ttl_days=1)
+    rows = pd.DataFrame({
+        "KEY": ["a", "b"],
+        "ADDRESS": ["A", "B"],
+        "ORGANIZATION_NAME": ["ORG", "ORG"],
+        "TYPE": ["rooftop", pd.NA],
+        "ACCURACY": [1.0, None],
+        "LON": [-87.6, None],
+        "LAT": [41.9, None],
+        "FORMATTED_ADDRESS": ["A, Chicago", None],
+    })
+    cache.put(rows)
+
+    found = cache.get(["a", "b", "c", "a"])
+    assert sorted(found["KEY"]) == ["a", "b"]
+    assert found.set_index("KEY").loc["a", "LAT"] == 41.9
+
+    cache.ttl_seconds = 0
+    time.sleep(0.01)
+    assert cache.get(["a", "b"]).empty
+
+
+def put_rows(path, keys):
+    cache = geocode_cache.LocalGeocodeCache(path)
+    for key in keys:
+        cache.put(pd.DataFrame({
+            "KEY": [key], "ADDRESS": [key], "ORGANIZATION_NAME": ["ORG"],
+            "TYPE": ["rooftop"], "ACCURACY": [1.0], "LON": [-87.6], "LAT": [41.8], "FORMATTED_ADDRESS": [key],
+        }))
+
+
+def test_local_cache_is_shared_by_the_processes_of_a_pod(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    context = multiprocessing.get_context("spawn")
+    keys = [[f"{p}-{i}" for i in range(50)] for p in range(3)]
+    writers = [context.Process(target=put_rows, args=(path, k)) for k in keys]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+
+    found = geocode_cache.LocalGeocodeCache(path).get([key for k in keys for key in k])
+    assert len(found) == 150
+
+
+TABLE = pd.DataFrame({
+    "OPS_STREET": ["1 A ST", "2 B ST", "2 B  St"],
+    "OPS_CITY": ["CHICAGO", "CHICAGO", "CHICAGO"],
+    "OPS_STATE": ["IL", "IL", "IL"],
+    "OPS_ZIP5": ["60601", "60601", "60601"],
+    "ORGANIZATION_NAME": ["ORG", "ORG", "OTHER ORG"],
+    "TYPE": ["rooftop", "range_interpolation", "rooftop"],
+    "ACCURACY": [1.0, 0.8, 0.9],
+    "LON": [-87.6, -87.7, -87.8],
+    "LAT": [41.8, 41.9, 42.0],
+    "FORMATTED_ADDRESS": ["1 A St, Chicago", "2 B St, Chicago", "2 B St, Chicago"],
+})
+
+
+def make_input(ids, organizations):
+    streets = {1: "1 A ST", 2: "2 B ST", 3: "3 C ST"}
+    return pd.DataFrame({
+        "ID": ids,
+        "STREET": [streets[i % 10] for i in ids],
+        "CITY": ["CHICAGO"] * len(ids),
+        "STATE": ["IL"] * len(ids),
+        "ZIP5": ["60601"] * len(ids),
+        "ORGANIZATION_NAME": organizations,
+    })
+
+
+def test_table_cache_reads_through_local_tier(tmp_path, monkeypatch):
+    cache = geocode_cache.LocalGeocodeCache(str(tmp_path / "cache.sqlite"))
+    queries = []
+
+    def iter_df(sql):
+        queries.append(sql)
+        yield TABLE
+
+    monkeypatch.setattr(geocode.persistence, "iter_df", iter_df)
+
+    def difference(input_df):
+        table_cache = geocode.GeocodeTableCache(
+            input_df, "ID", "STREET", "CITY", "STATE", "ZIP5", "ORGANIZATION_NAME", local_cache=cache
+        )
+        return table_cache.df_difference()
+
+    found, missing = difference(make_input([1, 2, 3], ["ORG"] * 3))
+    assert sorted(found["ID"]) == [1, 2] and list(missing["ID"]) == [3]
+    # duplicated addresses of the table resolve to their most accurate row
+    assert found.set_index("ID").loc[2, "LAT"] == 42.0
+    assert len(queries) == 1
+
+    found_again, missing_again = difference(make_input([1, 2, 3], ["ORG"] * 3))
+    assert sorted(found_again["ID"]) == [1, 2] and list(missing_again["ID"]) == [3]
+    # only the address missing from both tiers goes back to the warehouse
+    assert len(queries) == 2
+    pd.testing.assert_frame_equal(
+        found_again.sort_values("ID")[["ID", "LAT", "LON", "FORMATTED_ADDRESS"]].reset_index(drop=True),
+        found.sort_values("ID")[["ID", "LAT", "LON", "FORMATTED_ADDRESS"]].reset_index(drop=True),
+        check_dtype=False,
+    )
+
+    # addresses are shared across organizations, all found locally without a warehouse query
+    found_local, missing_local = difference(make_input([1, 2, 11], ["ORG", "NEW ORG", "NEW ORG"]))
+    assert sorted(found_local["ID"]) == [1, 2, 11] and missing_local.empty
+    assert len(queries) == 2
+
+
+def test_geocode_df_calls_api_once_per_address(tmp_path, monkeypatch):
+    cache = geocode_cache.LocalGeocodeCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(geocode_cache, "local_cache", cache)
+    monkeypatch.setattr(geocode.persistence, "iter_df", lambda sql: iter([TABLE.iloc[:1]]))
+    monkeypatch.setattr(geocode.persistence, "get_conn", lambda: contextlib.nullcontext())
+    written = []
+    monkeypatch.setattr(geocode, "write_pandas", lambda conn, df, **kws: written.append(df))
+    requested = []
+
+    def geocode_df_from_api(input_df, id_column, street_column, city_column, state_column, zip_column):
+        requested.append(input_df)
+        return pd.DataFrame({
+            id_column: input_df[id_column],
+            "type": "rooftop",
+            "accuracy": 1.0,
+            "lon": -87.0,
+            "lat": 41.0,
+            "formatted_address_from_api": input_df[street_column] + ", Chicago",
+        })
+
+    monkeypatch.setattr(geocode, "geocode_df_from_api", geocode_df_from_api)
+
+    # address 3 is needed by three rows of two organizations
+    input_df = make_input([1, 3, 13, 23], ["ORG", "ORG", "OTHER ORG", "OTHER ORG"])
+    result = geocode.geocode_df(input_df, "ID", "STREET", "CITY", "STATE", "ZIP5", "ORGANIZATION_NAME")
+
+    assert sorted(result["ID"]) == [1, 3, 13, 23]
+    assert len(requested) == 1 and len(requested[0]) == 1
+    assert len(written) == 1 and len(written[0]) == 1
+    assert written[0]["ORGANIZATION_NAME"].tolist() == ["ORG"]
@@ -0,0 +1,173 @@
+import threading
+import time
+import timeit
+
+import numpy as np
+import pandas as pd
+import pytest
+from geocodio.data import LocationCollection
+from geocodio.exceptions import GeocodioDataError, GeocodioServerError
+
+import geocode
+import geocode_dispatch
+
+
+def no_wait():
+    return geocode_dispatch.TokenBucket(rate=1e6, capacity=1e6)
+
+
+def test_token_bucket_paces_acquisitions():
+    bucket = geocode_dispatch.TokenBucket(rate=50, capacity=2)
+
+    t0 = time.perf_counter()
+    for _ in range(7):
+        bucket.acquire()
+    elapsed = time.perf_counter() - t0
+
+    # a burst of 2, then 5 more at 50/s
+    assert 0.08 < elapsed < 0.5
+
+
+def test_retries_server_errors_but_not_bad_data():
+    calls = []
+
+    def flaky(chunk):
+        calls.append(chunk)
+        if len(calls) < 3:
+            raise GeocodioServerError()
+        return chunk
+
+    assert geocode_dispatch.call_with_retries(flaky, "a", backoff_seconds=0.001, rate_limiter=no_wait()) == "a"
+    assert len(calls) == 3
+
+    def bad_data(chunk):
+        calls.append(chunk)
+        raise GeocodioDataError("bad address")
+
+    calls.clear()
+    with pytest.raises(GeocodioDataError):
+        geocode_dispatch.call_with_retries(bad_data, "a", backoff_seconds=0.001, rate_limiter=no_wait())
+    assert len(calls) == 1
+
+
+def test_dispatch_runs_chunks_concurrently_and_yields_completed_chunks_first():
+    active = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def work(chunk):
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.05)
+        with lock:
+            active["now"] -= 1
+        if chunk == [4]:
+            raise GeocodioDataError("bad address")
+        return sum(chunk)
+
+    completed = {}
+    with pytest.raises(GeocodioDataError):
+        for i, result in geocode_dispatch.dispatch([[1], [2], [3], [4], [5]], work, max_workers=3,
+                                                   rate_limiter=no_wait()):
+            completed[i] = result
+
+    assert completed == {0: 1, 1: 2, 2: 3, 4: 5}
+    assert active["max"] == 3
+
+
+class FakeClient:
+    def __init__(self, key, timeout=None):
+        pass
+
+    def geocode(self, addresses):
+        if any(address.startswith("BAD") for address in addresses):
+            raise GeocodioDataError("bad address")
+        return LocationCollection({
+            "query": address,
+            "response": {"results": [{"location": {"lat": 41.0, "lng": -87.0}, "accuracy": 1.0,
+                                      "accuracy_type": "rooftop", "formatted_address": address}]},
+        } for address in addresses)
+
+
+def test_geocode_df_from_api_checkpoints_completed_chunks(monkeypatch):
+    monkeypatch.setattr(geocode, "GeocodioClient", FakeClient)
+    monkeypatch.setattr(geocode_dispatch, "CHUNK_SIZE", 2)
+    monkeypatch.setattr(geocode_dispatch, "bucket", no_wait())
+    input_df = pd.DataFrame({
+        "ID": range(7),
+        "STREET": ["1 A ST", "2 B ST", "BAD ST", "4 D ST", "5 E ST", "6 F ST", "7 G ST"],
+        "CITY": "CHICAGO",
+        "STATE": "IL",
+        "ZIP5": "60601",
+    })
+    checkpoints = []
+
+    with pytest.raises(GeocodioDataError):
+        geocode.geocode_df_from_api(input_df, "ID", "STREET", "CITY", "STATE", "ZIP5", on_chunk=checkpoints.append)
+
+    # only the chunk holding the failing address is lost
+    assert sorted(i for chunk in checkpoints for i in chunk["ID"]) == [0, 1, 4, 5, 6]
+    assert all(chunk["lat"].eq(41.0).all() and chunk["lon"].eq(-87.0).all() for chunk in checkpoints)
+
+    result = geocode.geocode_df_from_api(input_df.drop(index=2), "ID", "STREET", "CITY", "STATE", "ZIP5")
+    assert list(result["ID"]) == [0, 1, 3, 4, 5, 6]
+
+
+def synthetic_response(n):
+    results = []
+    for i in range(n):
+        if i % 10 == 9:
+            # address that could not be geocoded
+            response = {"results": []}
+        else:
+            response = {"results": [{
+                "location": {"lat": 41.0 + i * 1e-6, "lng": -87.0 - i * 1e-6},
+                "accuracy": 0.9,
+                "accuracy_type": "rooftop",
+                "formatted_address": f"{i} Main St, Chicago, IL 60601",
+            }]}
+        results.append({"query": f"{i} Main St, Chicago, IL 60601", "response": response})
+    return LocationCollection(results)
+
+
+def legacy_format_geocodio_response(id_list, geocodio_res, id_column):
+    ret_df = pd.DataFrame({
+        'id': id_list,
+        'lat_lon': [None if i is None else i[::-1] for i in geocodio_res.coords],
+        'type': [i.best_match.get('accuracy_type') for i in geocodio_res],
+        'accuracy': [i.best_match.get('accuracy') for i in geocodio_res],
+        'formatted_address_from_api': geocodio_res.formatted_addresses
+    })
+    ret_df[['lon', 'lat']] = ret_df['lat_lon'].astype(str).str.replace('(', '', regex=False).str.replace(
+        ')', '', regex=False).str.split(",", expand=True)
+    ret_df = ret_df.drop(columns=['lat_lon']).rename(columns={'id': id_column})
+    for col in ['lon', 'lat']:
+        ret_df[col] = ret_df[col].replace('None', 0).fillna(0)
+    return ret_df.astype({'lon': 'float', 'lat': 'float'})
+
+
+def test_format_geocodio_response_leaves_missing_coordinates_empty():
+    ret_df = geocode.format_geocodio_response(list(range(20)), synthetic_response(20), "KEY")
+
+    assert list(ret_df.columns) == ["KEY", "type", "accuracy", "formatted_address_from_api", "lon", "lat"]
+    assert ret_df["lon"].dtype == np.float64 and ret_df["lat"].dtype == np.float64
+    assert ret_df.loc[[9, 19], ["lon", "lat"]].isna().all().all()
+    assert ret_df.loc[[9, 19], "type"].isna().all()
+    assert ret_df.loc[3, "lat"] == 41.0 + 3e-6 and ret_df.loc[3, "lon"] == -87.0 - 3e-6
+
+
+@pytest.mark.benchmark
+def test_format_geocodio_response_benchmark():
+    n = 100_000
+    ids = list(range(n))
+    response = synthetic_response(n)
+    number = 3
+
+    before = timeit.timeit(lambda: legacy_format_geocodio_response(ids, response, "KEY"), number=number)
+    after = timeit.timeit(lambda: geocode.format_geocodio_response(ids, response, "KEY"), number=number)
+
+    print(f"format {n} results: before {before / number:.3f}s, after {after / number:.3f}s")
+    found = np.arange(n) % 10 != 9
+    expected = legacy_format_geocodio_response(ids, response, "KEY")[found]
+    pd.testing.assert_frame_equal(geocode.format_geocodio_response(ids, response, "KEY")[found], expected)
+    assert after < before
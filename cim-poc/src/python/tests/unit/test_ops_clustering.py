@@ -1,7 +1,11 @@
+import numpy as np
 import pandas as pd
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.metrics.pairwise import haversine_distances
 
 
 import ops_clustering as oc
+import scopes
 
 
 TEST_OPS = pd.DataFrame({
@@ -31,4 +35,294 @@ def tests_cluster_ops():
     assert cluster.ORGANIZATION_ID == '1'
     assert cluster.IS_SITE
     assert not cluster.IS_ADDRESS
-    assert not cluster.IS_BUILDING
\ No newline at end of file
+    assert not cluster.IS_BUILDING
+
+
+def legacy_cluster_labels(ops_df):
+    same_org = ops_df.ORGANIZATION_ID.values[:, None] == ops_df.ORGANIZATION_ID.values[None, :]
+    dists = haversine_distances(ops_df[["LATITUDE", "LONGITUDE"]].apply(np.deg2rad)) * oc.EARTH_RADIUS_M
+    dists[~same_org] = 1e8
+
+    return AgglomerativeClustering(
+        affinity="precomputed",
+        linkage="single",
+        n_clusters=None,
+        distance_threshold=oc.SEARCH_RADIUS_M,
+        compute_full_tree=True
+    ).fit(dists).labels_
+
+
+def test_cluster_labels_match_agglomerative():
+    rng = np.random.default_rng(42)
+    n = 600
+    # a few hundred meters around a handful of sites, so chains and near misses are common
+    sites = rng.integers(0, 5, n)
+    ops_df = pd.DataFrame({
+        "ORGANIZATION_ID": rng.choice(["1", "2", "3"], n),
+        "LATITUDE": 41.45 + 0.01 * sites + rng.normal(0, 0.001, n),
+        "LONGITUDE": -82.01 + rng.normal(0, 0.001, n),
+    })
+    # duplicated coordinates are collapsed before building the graph
+    ops_df.iloc[:50, 1:] = ops_df.iloc[50:100, 1:].values
+
+    labels = oc.cluster_labels(ops_df)
+    legacy = legacy_cluster_labels(ops_df)
+
+    assert 1 < len(np.unique(labels)) < n
+    assert (labels == pd.factorize(legacy)[0]).all()
+
+
+def test_cluster_labels_missing_coordinates():
+    ops_df = TEST_OPS.assign(LATITUDE=[41.458933, np.nan, 41.458933], LONGITUDE=[-82.012957, np.nan, -82.012957])
+    assert oc.cluster_labels(ops_df).tolist() == [0, 1, 0]
+    assert len(oc.cluster_labels(ops_df.iloc[:0])) == 0
+
+
+def legacy_cluster_to_ops(df):
+    if len(df) > 1:
+        mode = lambda col: df[col].value_counts().idxmax()
+        ix, orgname, state, street, city = df.CLUSTER.iloc[0], mode("ORGANIZATION_NAME"), mode("OPS_STATE"), \
+            mode("OPS_STREET"), mode("OPS_CITY")
+        return pd.Series(dict(
+            OPS_LOC_NAME=f"{orgname} {state} P{ix} {street} {city}",
+            OPS_ZIP5=mode("OPS_ZIP5"),
+            ORGANIZATION_ID=mode("ORGANIZATION_ID"),
+            LATITUDE=df["LATITUDE"].mean(),
+            children=df["ID"].values.tolist(),
+        )).to_frame().T
+
+
+def test_clusters_to_ops_matches_legacy():
+    rng = np.random.default_rng(42)
+    n = 500
+    ops_df = pd.DataFrame({
+        "ID": np.arange(n).astype(str),
+        "CLUSTER": rng.integers(0, 150, n),
+        "ORGANIZATION_ID": "1",
+        "ORGANIZATION_NAME": "TEST",
+        # skewed choices so every cluster has a clear mode
+        "OPS_STREET": rng.choice(["1 Main Street", "2 Main Street", "3 Broad Street"], n, p=[0.8, 0.15, 0.05]),
+        "OPS_CITY": rng.choice(["Columbus", "Dublin"], n, p=[0.9, 0.1]),
+        "OPS_STATE": "OH",
+        "OPS_ZIP5": "43081",
+        "LATITUDE": rng.uniform(40, 41, n),
+        "LONGITUDE": rng.uniform(-83, -82, n),
+    })
+    ops_df.loc[ops_df.OPS_STREET == "3 Broad Street", "CLUSTER"] = 999  # a cluster made of the least common street
+
+    expected = ops_df.groupby("CLUSTER").apply(legacy_cluster_to_ops).dropna(subset=["OPS_LOC_NAME"])
+    expected = expected.reset_index(level=0).set_index("CLUSTER")
+    result = oc.clusters_to_ops(ops_df).set_index("CLUSTER").loc[expected.index]
+
+    assert list(oc.clusters_to_ops(ops_df).columns) == oc.PARENT_COLUMNS
+    assert result.ID.nunique() == len(result)
+    assert (result.OPS_LOC_NAME == expected.OPS_LOC_NAME).all()
+    assert (result.OPS_ZIP5 == expected.OPS_ZIP5).all()
+    assert np.allclose(result.LATITUDE.astype(float), expected.LATITUDE.astype(float))
+    assert result.children.apply(sorted).tolist() == expected.children.apply(sorted).tolist()
+    assert result.IS_SITE.all() and not result.IS_BUILDING.any()
+
+
+def test_clusters_to_ops_singletons():
+    result = oc.clusters_to_ops(TEST_OPS.assign(CLUSTER=[0, 1, 2]))
+    assert len(result) == 0
+    assert list(result.columns) == oc.PARENT_COLUMNS
+
+
+def random_multi_org_ops(n=400, seed=42):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "ID": np.arange(n).astype(str),
+        "ORGANIZATION_ID": rng.choice(list("ABCDEFG"), n, p=[0.4, 0.2, 0.1, 0.1, 0.1, 0.05, 0.05]),
+        "ORGANIZATION_NAME": "TEST",
+        "OPS_STREET": "1 Main Street",
+        "OPS_CITY": "Columbus",
+        "OPS_STATE": "OH",
+        "OPS_ZIP5": "43081",
+        "LATITUDE": 41.45 + 0.01 * rng.integers(0, 5, n) + rng.normal(0, 0.0005, n),
+        "LONGITUDE": -82.01 + rng.normal(0, 0.0005, n),
+    })
+
+
+def test_partition_by_organization():
+    ops_df = random_multi_org_ops()
+    partitions = oc.partition_by_organization(ops_df, 3)
+
+    assert len(partitions) == 3
+    assert sorted(pd.concat(partitions).ID) == sorted(ops_df.ID)
+    orgs = [set(partition.ORGANIZATION_ID) for partition in partitions]
+    assert sum(len(o) for o in orgs) == ops_df.ORGANIZATION_ID.nunique()  # organizations are never split
+    assert len(oc.partition_by_organization(ops_df, 100)) == ops_df.ORGANIZATION_ID.nunique()
+
+
+def test_cluster_ops_partitioned():
+    ops_df = random_multi_org_ops()
+    streamed = []
+
+    with oc.cluster_pool(2) as pool:
+        parents = oc.cluster_ops_partitioned(ops_df, on_parents=streamed.append, pool=pool, n_workers=2, min_parallel_rows=0)
+    expected = oc.cluster_ops(ops_df)
+
+    assert len(streamed) > 1
+    assert sum(len(p) for p in streamed) == len(parents)
+    assert sorted(map(sorted, parents.children)) == sorted(map(sorted, expected.children))
+    # every organization is named TEST, parent names must not repeat across partitions
+    assert parents.MAIN_LOC_NAME.is_unique
+
+
+class NoPool:
+    def submit(self, *args):
+        raise AssertionError("small scopes are clustered in process")
+
+
+def test_cluster_ops_partitioned_small_scopes_in_process():
+    ops_df = random_multi_org_ops()
+
+    parents = oc.cluster_ops_partitioned(ops_df, pool=NoPool(), n_workers=2, min_parallel_rows=len(ops_df) + 1)
+
+    assert sorted(map(sorted, parents.children)) == sorted(map(sorted, oc.cluster_ops(ops_df).children))
+    assert parents.MAIN_LOC_NAME.is_unique
+
+
+def incremental_fixture(**extra_rows):
+    # sites A and B are ~170m apart, C is far away; 0.0005 degrees of latitude is ~55m
+    rows = {
+        "a1": ("T OH P0 1 Main Street Columbus", 41.4500), "a2": ("T OH P0 1 Main Street Columbus", 41.4500),
+        "b1": ("T OH P3 1 Main Street Columbus", 41.4515), "b2": ("T OH P3 1 Main Street Columbus", 41.4515),
+        "s1": (None, 41.6000), "c1": (None, 41.7000),
+        **extra_rows,
+    }
+    ops_df = pd.DataFrame({
+        "ID": list(rows),
+        "MAIN_LOC_NAME": [name for name, _ in rows.values()],
+        "LATITUDE": [lat for _, lat in rows.values()],
+    }).assign(
+        LONGITUDE=-82.01,
+        ORGANIZATION_ID="1",
+        ORGANIZATION_NAME="T",
+        OPS_STREET="1 Main Street",
+        OPS_CITY="Columbus",
+        OPS_STATE="OH",
+        OPS_ZIP5="43081",
+    )
+    sites_df = pd.DataFrame({
+        "ID": ["site-a", "site-b"],
+        "OPS_LOC_NAME": ["T OH P0 1 Main Street Columbus", "T OH P3 1 Main Street Columbus"],
+        "MAIN_LOC_NAME": ["T OH P0", "T OH P3"],
+    })
+    return ops_df, sites_df
+
+
+def test_touched_neighborhood():
+    ops_df = pd.DataFrame({
+        "ORGANIZATION_ID": ["1", "1", "1", "1", "2"],
+        "LATITUDE": [41.4500, 41.4005, 41.4010, 41.4030, 41.4005],
+        "LONGITUDE": -82.01,
+    })
+    ops_df.loc[0, "LATITUDE"] = 41.4000
+    touched = np.array([True, False, False, False, False])
+
+    # a chain of rows ~55m apart is reached, a row ~220m further and another organization are not
+    assert oc.touched_neighborhood(ops_df, touched).tolist() == [True, True, True, False, False]
+
+
+def test_incremental_parent_changes_grow_and_insert():
+    ops_df, sites_df = incremental_fixture(n1=(None, 41.4503), n2=(None, 41.7003))
+    changes = oc.incremental_parent_changes(ops_df, sites_df, new_ids=["n1", "n2"])
+
+    assert len(changes["update"]) == 1
+    update = changes["update"].iloc[0]
+    assert update.ID == "site-a" and update.OPS_LOC_NAME == "T OH P0 1 Main Street Columbus"
+    assert set(update.children) == {"a1", "a2", "n1"}
+
+    assert len(changes["insert"]) == 1
+    insert = changes["insert"].iloc[0]
+    assert set(insert.children) == {"c1", "n2"}
+    assert int(insert.MAIN_LOC_NAME.split(" P")[1]) > 3  # numbered after the existing P3
+    assert changes["delete"] == [] and changes["detach"] == []
+
+
+def test_incremental_parent_changes_merge():
+    ops_df, sites_df = incremental_fixture(n1=(None, 41.4503), n4=(None, 41.4508))
+    changes = oc.incremental_parent_changes(ops_df, sites_df, new_ids=["n1", "n4"])
+
+    assert len(changes["insert"]) == 0
+    assert changes["update"].ID.tolist() == ["site-a"]  # shares the most children with the merged cluster
+    assert set(changes["update"].children.iloc[0]) == {"a1", "a2", "b1", "b2", "n1", "n4"}
+    assert changes["delete"] == ["site-b"]
+
+
+def test_incremental_parent_changes_moved_row():
+    ops_df, sites_df = incremental_fixture()
+    ops_df.loc[ops_df.ID == "a2", "LATITUDE"] = 41.5000
+    changes = oc.incremental_parent_changes(ops_df, sites_df, changed_ids=["a2"])
+
+    assert len(changes["insert"]) == 0 and len(changes["update"]) == 0
+    assert changes["delete"] == ["site-a"]
+    assert sorted(changes["detach"]) == ["a1", "a2"]
+
+
+def test_incremental_parent_changes_nothing_new():
+    # s1 and c1 are singletons of an earlier run, they are not linked to a site but not new either
+    ops_df, sites_df = incremental_fixture(s2=(None, 41.6001))
+    changes = oc.incremental_parent_changes(ops_df, sites_df)
+
+    assert len(changes["insert"]) == len(changes["update"]) == len(changes["delete"]) == len(changes["detach"]) == 0
+
+
+def test_incremental_parent_changes_attaches_new_building_rows():
+    # a new building row points at its address row, not at a site
+    ops_df, sites_df = incremental_fixture(bld=("T @ 1 Main Street Dock 2", 41.4501))
+    changes = oc.incremental_parent_changes(ops_df, sites_df, new_ids=["bld"])
+
+    assert changes["update"].ID.tolist() == ["site-a"]
+    assert set(changes["update"].children.iloc[0]) == {"a1", "a2", "bld"}
+
+
+def test_moved_children():
+    ops_df, sites_df = incremental_fixture()
+    sites_df = sites_df.assign(LATITUDE=[41.4500, 41.4515], LONGITUDE=-82.01)
+    assert oc.moved_children(ops_df, sites_df) == []
+
+    ops_df.loc[ops_df.ID == "a2", "LATITUDE"] = 41.5000
+    assert sorted(oc.moved_children(ops_df, sites_df)) == ["a1", "a2"]
+    changes = oc.incremental_parent_changes(ops_df, sites_df, changed_ids=oc.moved_children(ops_df, sites_df))
+    assert changes["delete"] == ["site-a"]
+
+
+def test_execute_for_ids_batches_in_lists(monkeypatch):
+    executed = []
+
+    class Cursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+        def execute(self, sql, params):
+            executed.append((sql, params))
+
+    class Conn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+        def cursor(self):
+            return Cursor()
+
+    monkeypatch.setattr(oc.persistence, "get_conn", Conn)
+    monkeypatch.setattr(oc, "MAX_IDS_PER_STATEMENT", 2)
+
+    oc.delete_ops_locations(["a", "b", "c"])
+
+    assert [params for _, params in executed] == [["a", "b"], ["c"]]
+    assert executed[0][0].endswith("WHERE ID IN (%s,%s);")
+    assert executed[1][0].endswith("WHERE ID IN (%s);")
+
+
+def test_incremental_clustering_needs_a_site_query():
+    assert scopes.ScopeSalesOrderOrgIdState.has_sites()
+    assert not scopes.ScopeSoldToAccountOrgIdZip3.has_sites()
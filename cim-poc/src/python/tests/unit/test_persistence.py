@@ -0,0 +1,108 @@
+import threading
+
+import pytest
+
+import persistence
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.commits = 0
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def cursor(self):
+        raise RuntimeError("connection lost")
+
+
+def make_pool(**kws):
+    created = []
+
+    def connect():
+        created.append(FakeConnection())
+        return created[-1]
+
+    return persistence.ConnectionPool(connect, **kws), created
+
+
+def test_pool_reuses_connections():
+    pool, created = make_pool(max_size=2)
+
+    with pool.checkout() as conn:
+        first = conn._lease.conn
+    conn = pool.checkout()
+    assert conn._lease.conn is first
+    conn.close()
+    conn.close()  # closing twice returns the connection once
+
+    assert len(created) == 1
+    assert not first.closed
+    assert first.commits == 1
+
+
+def test_pool_nested_checkout_shares_connection():
+    pool, created = make_pool(max_size=1)
+
+    with pool.checkout() as outer:
+        with pool.checkout() as inner:
+            assert inner._lease.conn is outer._lease.conn
+        # the outer checkout still holds the only slot
+        assert not pool._slots.acquire(blocking=False)
+
+    assert len(created) == 1
+    assert len(pool._idle) == 1
+
+
+def test_pool_is_bounded_per_thread():
+    pool, created = make_pool(max_size=1, timeout=0.1)
+    errors = []
+
+    def other_thread():
+        try:
+            pool.checkout()
+        except TimeoutError as error:
+            errors.append(error)
+
+    with pool.checkout():
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+
+    assert len(errors) == 1
+    assert len(created) == 1
+
+
+def test_pool_replaces_unhealthy_connections():
+    pool, created = make_pool(health_check_seconds=0.0)
+
+    pool.checkout().close()
+    created[0].closed = False
+    # the ping fails (FakeConnection.cursor raises), so a new connection is made
+    conn = pool.checkout()
+    assert conn._lease.conn is created[1]
+    assert created[0].closed
+    conn.close()
+
+    pool.close_all()
+    assert created[1].closed
+
+
+def test_pool_checkout_failure_frees_slot():
+    def connect():
+        raise ConnectionError("login failed")
+
+    pool = persistence.ConnectionPool(connect, max_size=1, timeout=0.1)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            pool.checkout()
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from utils import pipeline
+
+
+def test_run_scopes_processes_and_uploads_every_scope():
+    uploaded = {}
+
+    failed = pipeline.run_scopes(
+        list(range(10)),
+        fetch=lambda scope: scope * 10,
+        process=lambda scope, data: None if scope == 3 else data + 1,
+        upload=lambda scope, result: uploaded.__setitem__(scope, result),
+    )
+
+    assert failed == []
+    assert uploaded == {scope: scope * 10 + 1 for scope in range(10) if scope != 3}
+
+
+def test_run_scopes_keeps_going_after_failures():
+    def fetch(scope):
+        if scope == 1:
+            raise ValueError("fetch failed")
+        return scope
+
+    def upload(scope, result):
+        if scope == 2:
+            raise ValueError("upload failed")
+
+    failed = pipeline.run_scopes([0, 1, 2, 3], fetch, lambda scope, data: data, upload)
+
+    assert sorted(failed) == [1, 2]
+
+
+def test_run_scopes_bounds_prefetch_and_overlaps_stages():
+    lock = threading.Lock()
+    in_flight = {"fetched": 0, "max_fetched": 0}
+
+    def fetch(scope):
+        time.sleep(0.05)
+        with lock:
+            in_flight["fetched"] += 1
+            in_flight["max_fetched"] = max(in_flight["max_fetched"], in_flight["fetched"])
+        return scope
+
+    def process(scope, data):
+        with lock:
+            in_flight["fetched"] -= 1
+        time.sleep(0.05)
+        return data
+
+    t0 = time.perf_counter()
+    pipeline.run_scopes(list(range(8)), fetch, process, lambda scope, result: time.sleep(0.05), prefetch=2)
+    elapsed = time.perf_counter() - t0
+
+    # one fetched scope is being processed while at most `prefetch` more wait
+    assert in_flight["max_fetched"] <= 3
+    # serially this is 8 * 0.15s, overlapping the stages brings it close to 8 * 0.05s
+    assert elapsed < 0.8
+
+
+def test_run_scopes_processes_scopes_concurrently_with_process_workers():
+    lock = threading.Lock()
+    active = {"now": 0, "max": 0}
+    uploaded = {}
+
+    def process(scope, data):
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.05)
+        with lock:
+            active["now"] -= 1
+        if scope == 5:
+            raise ValueError("process failed")
+        return data
+
+    failed = pipeline.run_scopes(list(range(12)), lambda scope: scope, process,
+                                 lambda scope, result: uploaded.__setitem__(scope, result),
+                                 prefetch=4, process_workers=3)
+
+    assert failed == [5]
+    assert uploaded == {scope: scope for scope in range(12) if scope != 5}
+    assert active["max"] == 3
+
+
+def test_fit_process_workers_stays_within_the_pool():
+    assert pipeline.fit_process_workers(4, pool_size=7, prefetch=2, upload_workers=1) == 4
+    assert pipeline.fit_process_workers(4, pool_size=4, prefetch=2, upload_workers=1) == 1
+
+    with pytest.raises(ValueError, match="SF_POOL_SIZE=7"):
+        pipeline.fit_process_workers(4, pool_size=4, prefetch=2, upload_workers=1, strict=True)
+    with pytest.raises(ValueError):
+        pipeline.fit_process_workers(1, pool_size=3, prefetch=2, upload_workers=1)
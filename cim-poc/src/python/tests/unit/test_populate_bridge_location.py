@@ -0,0 +1,29 @@
+import pandas as pd
+
+import populate_bridge_location as pbl
+
+
+def locations(rows):
+    return pd.DataFrame(rows, columns=["ID", "MAIN_LOC_NAME", "OPS_LOC_NAME"])
+
+
+def test_location_clusters_straddle_batches():
+    batches = [
+        locations([[1, "A", "A"], [2, "A", "A-1"], [3, "B", "B"]]),
+        locations([[4, "B", "B-1"], [5, "C", "C"]]),
+        locations([]),
+        locations([[6, "C", "C-1"]]),
+    ]
+
+    clusters = list(pbl.iter_location_clusters(batches))
+
+    assert [name for name, _ in clusters] == ["A", "B", "C"]
+    assert [[row["ID"] for row in rows] for _, rows in clusters] == [[1, 2], [3, 4], [5, 6]]
+
+
+def test_location_clusters_match_single_batch():
+    df = locations([[i, f"M{i // 3}", f"O{i}"] for i in range(10)])
+    batched = [df.iloc[:4], df.iloc[4:7], df.iloc[7:]]
+
+    assert list(pbl.iter_location_clusters(batched)) == list(pbl.iter_location_clusters([df]))
+    assert list(pbl.iter_location_clusters([])) == []
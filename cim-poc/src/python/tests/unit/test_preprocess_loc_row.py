@@ -1,5 +1,9 @@
+import timeit
+
 import pandas as pd
 import numpy as np
+import pytest
+from nltk.tokenize.treebank import TreebankWordDetokenizer
 
 
 from curation_wizard import preprocess_loc_row as pp
@@ -11,6 +15,35 @@ TEST_ADDRESS_4 = "123 Main Street Building 1"
 TEST_ADDRESS_5 = "Building 1 123 Main Street"
 TEST_ADDRESS_6 = "123 Main Street Dock 2"
 
+TOKENIZER_PARITY_CORPUS = [
+    TEST_ADDRESS,
+    TEST_ADDRESS_2,
+    TEST_ADDRESS_4,
+    "",
+    "   ",
+    "P.O. Box 123",
+    "PO B0X 456",
+    "N 64W 1024 Big Road",
+    "S96W4096 Sweet Way",
+    "490 S 22nd Street",
+    "247 W El Camino Real Ste 100",
+    "5816 S Avenida Isla Contoy",
+    "2nd & 4 th",
+    "5th&Main",
+    "Corner of 5th and Main",
+    "Building 21 Corner of Broad and High",
+    "Rt. 5 Box305 Hwy82 & Ponderos",
+    "Interstate 81 & 901 W , PO BOX 589",
+    "Science And Research Bld 1, Eas Dep",
+    "Attn: Receiving Dept. #4",
+    "c/o John O'Brien (Dock 3)",
+    "\"Warehouse B\"",
+    "123 Cannot Road",
+    "Gotta Lane & Wanna Way",
+    "Bldg 10-2; Door 7",
+    "1600 Pennsylvania Ave NW",
+]
+
 
 def test_ignore_characters():
     result = pp.ignore_characters(TEST_ADDRESS_2, ["!", "#"])
@@ -22,6 +55,49 @@ def test_tokenize():
     assert set(tokens) == set(['123', 'Main', 'Street', 'Dude'])
 
 
+def test_tokenize_backend_parity():
+    for street in TOKENIZER_PARITY_CORPUS:
+        for text in (street, pp.ignore_characters(street, pp.IGNORED_CHARS)):
+            assert pp.tokenize(text, backend="address") == pp.tokenize(text, backend="nltk")
+
+
+def test_address_tokenize_returns_fresh_list():
+    tokens = pp.address_tokenize(TEST_ADDRESS)
+    tokens.append("Extra")
+    assert pp.address_tokenize(TEST_ADDRESS) == ['123', 'Main', 'Street', 'Dude']
+
+
+def legacy_detokenize(tokens):
+    tokens = [
+        " ".join([word.upper() if pp.COORD_REGEX.match(word) else word.capitalize() for word in token.split(" ")])
+        for token in tokens
+    ]
+    return TreebankWordDetokenizer().detokenize(tokens)
+
+
+def test_detokenize_parity():
+    extra = [["Can", "Not", "Road"], ["1", "Gon", "Na", "Way"], ["N64W1024", "big", "road"], ["Building 1", "a"]]
+    for tokens in [pp.tokenize(street) for street in TOKENIZER_PARITY_CORPUS] + extra:
+        assert pp.detokenize(tokens) == legacy_detokenize(tokens)
+
+
+@pytest.mark.benchmark
+def test_detokenize_benchmark():
+    rows = [
+        pp.tokenize(pp.ignore_characters(street, pp.IGNORED_CHARS))
+        for street in TOKENIZER_PARITY_CORPUS
+    ]
+    number = 50
+
+    before = timeit.timeit(lambda: [legacy_detokenize(tokens) for tokens in rows], number=number)
+    after = timeit.timeit(lambda: [pp.detokenize(tokens) for tokens in rows], number=number)
+
+    n = number * len(rows)
+    print(f"detokenize per row: before {1e6 * before / n:.1f}us, after {1e6 * after / n:.1f}us")
+    assert [pp.detokenize(tokens) for tokens in rows] == [legacy_detokenize(tokens) for tokens in rows]
+    assert after < before
+
+
 def test_ignore_tokens():
     ignored = ['dude']
     tokens = pp.tokenize(TEST_ADDRESS)
@@ -104,6 +180,50 @@ def test_infer_address_and_sublocations():
     assert subloc2 == "Dock 2"
 
 
+def test_ignore_characters_series():
+    streets = pd.Series([TEST_ADDRESS_2, "Bldg.A", np.nan])
+    result = pp.ignore_characters_series(streets, ["!", "#", "."])
+    assert result.tolist() == [
+        pp.ignore_characters(TEST_ADDRESS_2, ["!", "#", "."]),
+        pp.ignore_characters("Bldg.A", ["!", "#", "."]),
+        "",
+    ]
+
+
+def test_infer_addresses_and_sublocations():
+    df = pd.DataFrame({
+        "STREET_NUM": ["", "", np.nan, "123", "", ""],
+        "STREET": [
+            "123 Main Street Building 1",
+            "123 Main Street Building 1",
+            "Main Street",
+            "Main Street",
+            "N 64W 1024 Big Rd",
+            "123 Main St.",
+        ],
+        "DEPARTMENT": ["", "", "", "", "", "BLDG 4"],
+        "ATTENTION": ["", "", "", "", "", ""],
+        "SUPPLEMENTAL": ["Dock 2", "Dock 2", "", "", "", ""],
+        "RECEIVER": ["", "", "", "", "WAREHOUSE B", ""],
+    })
+
+    addresses, sublocs1, sublocs2 = pp.infer_addresses_and_sublocations(
+        df.STREET_NUM,
+        df.STREET,
+        df.DEPARTMENT,
+        df.ATTENTION,
+        df.SUPPLEMENTAL,
+        df.RECEIVER,
+    )
+
+    expected = [
+        pp.infer_address_and_sublocations(*row)
+        for row in df[["STREET_NUM", "STREET", "DEPARTMENT", "ATTENTION", "SUPPLEMENTAL", "RECEIVER"]].values
+    ]
+    assert list(zip(addresses, sublocs1, sublocs2)) == expected
+    assert expected[0] == ("123 Main Street", "Building 1", "Dock 2")
+
+
 def test_clean_and_tokenize_field():
 
     result = pp.clean_and_tokenize_field(
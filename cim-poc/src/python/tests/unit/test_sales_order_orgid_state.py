@@ -0,0 +1,87 @@
+import pandas as pd
+import pytest
+
+from scopes import sales_order_orgid_state as so
+
+
+class FakeCursor:
+    def __init__(self, executed, result):
+        self.executed = executed
+        self.result = result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def fetch_pandas_all(self):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class FakeConnection:
+    def __init__(self, result=None):
+        self.executed = []
+        self.result = result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self.executed, self.result)
+
+
+def bulk_scope():
+    n_pairs = so.BULK_DIM_MIN_SCOPES
+    return so.ScopeSalesOrderOrgIdState(
+        organization_ids=[str(i) for i in range(n_pairs)],
+        states=["IL"] * n_pairs,
+    )
+
+
+def test_bulk_get_dim_joins_scope_keys(monkeypatch):
+    rows = pd.DataFrame({
+        "ORGANIZATION_ID": ["0", "1"],
+        "STATE": ["IL", "IL"],
+        "STREET": ["A ST", "B ST"],
+    })
+    conn = FakeConnection(rows)
+    written = []
+
+    def write_pandas(conn_, df, table_name, schema, quote_identifiers):
+        written.append((f"{schema}.{table_name}", df))
+
+    monkeypatch.setattr(so.persistence, "get_conn", lambda: conn)
+    monkeypatch.setattr(so, "write_pandas", write_pandas)
+
+    dim = bulk_scope().get_dim()
+
+    assert dim is rows
+    create, query, drop = conn.executed
+    # a single join on the keys table, no literal lists of the scope keys
+    assert "concat(" not in query
+    assert "'42'" not in query
+    assert "order by dl.STREET" in query
+    (keys_table, keys), = written
+    assert create.startswith(f"create temporary table {keys_table} ")
+    assert len(keys) == so.BULK_DIM_MIN_SCOPES
+    assert drop == f"drop table if exists {keys_table}"
+
+
+def test_bulk_get_dim_raises_query_errors(monkeypatch):
+    conn = FakeConnection(RuntimeError("warehouse suspended"))
+    monkeypatch.setattr(so.persistence, "get_conn", lambda: conn)
+    monkeypatch.setattr(so, "write_pandas", lambda *args, **kws: None)
+
+    # an empty scope would be curated as done, the error must reach the queue for a retry
+    with pytest.raises(RuntimeError):
+        bulk_scope().get_dim()
+    assert conn.executed[-1].startswith("drop table if exists")
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import scopes
+from utils import scopefiles, scopequeue
+
+
+def test_lpt_assign_balances_costs():
+    costs = np.array([10, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 9, 8, 2], dtype=float)
+
+    bins = scopefiles.lpt_assign(costs, 3)
+
+    loads = np.bincount(bins, weights=costs, minlength=3)
+    assert loads.max() - loads.min() <= 1
+    # splitting by count puts 10, 9 and 8 wherever the order happens to put them
+    assert loads.max() < max(chunk.sum() for chunk in np.array_split(costs, 3))
+
+
+def test_chunk_bounds_respects_size_and_cost():
+    costs = [50, 5, 5, 5, 5, 5, 5, 20, 20]
+
+    bounds = scopefiles.chunk_bounds(costs, chunk_size=4, chunk_cost=30)
+
+    assert bounds == [(0, 1), (1, 5), (5, 8), (8, 9)]
+    assert scopefiles.chunk_bounds([], chunk_size=4, chunk_cost=30) == []
+
+
+def test_plan_chunks_balances_pods():
+    sizes = [100_000, 90_000, 60_000, 50_000] + [100] * 400
+    scope_sizes = pd.DataFrame({"KEY": range(len(sizes)), "SIZE": sizes}).sample(frac=1.0, random_state=0)
+
+    pickler = scopefiles.ScopePickler(size_method="get_match_sizes")
+    pods = pickler.plan_chunks(scope_sizes, 2, chunk_size=100)
+
+    keys = sorted(key for pod in pods for chunk in pod for key in chunk["KEY"])
+    assert keys == list(range(len(sizes)))
+    loads = [sum(chunk["SIZE"].sum() for chunk in pod) for pod in pods]
+    assert abs(loads[0] - loads[1]) <= 10_000
+    # by default no chunk costs more than the costliest scope, which gets a chunk of its own
+    chunk_costs = [chunk["SIZE"].sum() for pod in pods for chunk in pod]
+    assert max(chunk_costs) == max(sizes)
+    assert sum(cost == max(sizes) for cost in chunk_costs) == 1
+
+
+def test_manifest_loads_single_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(scopefiles, "get_name", lambda identifier, group, pid: str(tmp_path / f"{group}_{pid}.arrow"))
+    scope_sizes = pd.DataFrame({
+        "ORGANIZATION_ID": [str(i) for i in range(10)],
+        "STATE": ["IL", "WI"] * 5,
+        "SIZE": range(10, 0, -1),
+    })
+
+    pickler = scopefiles.ScopePickler(
+        scope_class=scopes.ScopeSalesOrderOrgIdState, size_method="get_match_sizes", incremental=False
+    )
+    pickler._split_and_pickle(scope_sizes, 2, "small", chunk_size=2)
+
+    planned = pickler.plan_chunks(scope_sizes, 2, chunk_size=2)
+    manifest = scopefiles.load("salesorder", "small", 1)
+    assert len(manifest) == len(planned[1])
+    assert manifest.group == "small"
+    pd.testing.assert_frame_equal(manifest.chunk(-1), planned[1][-1].reset_index(drop=True))
+
+    scope = manifest[0]
+    assert isinstance(scope, scopes.ScopeSalesOrderOrgIdState)
+    assert not scope.incremental
+    assert scope.organization_ids == list(planned[1][0]["ORGANIZATION_ID"])
+    assert scope.states == list(planned[1][0]["STATE"])
+    assert sum(len(scope.states) for pid in range(2) for scope in scopefiles.load("salesorder", "small", pid)) == 10
+
+
+def test_queue_entries_reference_manifest_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(scopefiles, "get_name", lambda identifier, group, pid: str(tmp_path / f"{group}_{pid}.arrow"))
+    monkeypatch.setattr(scopequeue, "SCOPES_DIR", str(tmp_path))
+    scope_sizes = pd.DataFrame({
+        "ORGANIZATION_ID": [str(i) for i in range(10)],
+        "STATE": ["IL", "WI"] * 5,
+        "SIZE": range(10, 0, -1),
+    })
+
+    pickler = scopefiles.ScopePickler(
+        scope_class=scopes.ScopeSalesOrderOrgIdState, size_method="get_match_sizes", incremental=False,
+        identifier="salesorder", queue=True,
+    )
+    pickler._split_and_pickle(scope_sizes, 2, "small", chunk_size=2)
+
+    manifests = [scopefiles.load("salesorder", "small", pid) for pid in range(2)]
+    for stage in scopefiles.QUEUE_STAGES:
+        queue = scopequeue.stage_queue("salesorder", stage, "small")
+        tasks = list(queue.claims())
+        assert len(tasks) == sum(len(manifest) for manifest in manifests)
+        for task in tasks:
+            pid = int(task.entry["manifest"][-len("0.arrow"):-len(".arrow")])
+            expected = manifests[pid][task.entry["chunk"]]
+            assert isinstance(task.scope, scopes.ScopeSalesOrderOrgIdState)
+            assert (task.scope.organization_ids, task.scope.states) == (expected.organization_ids, expected.states)
+            queue.done(task)
+        assert queue.is_empty()
+    # costliest chunk first: the first entry holds the largest scope
+    assert tasks[0].scope.organization_ids[0] == "0"
+
+
+def test_run_info_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(scopefiles, "SCOPES_DIR", str(tmp_path))
+
+    with pytest.raises(FileNotFoundError):
+        scopefiles.read_run_info("salesorder")
+
+    scopefiles.write_run_info("salesorder", incremental=True)
+    assert scopefiles.read_run_info("salesorder") == {"incremental": True}
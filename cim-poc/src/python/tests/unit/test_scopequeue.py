@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+
+from utils import scopequeue
+from utils.scopequeue import ScopeQueue
+
+
+def make_queue(tmp_path, worker, **kws):
+    return ScopeQueue("test", directory=str(tmp_path / "queue"), worker=worker, poll_seconds=0.01, **kws)
+
+
+def test_workers_drain_queue_and_retry_failures(tmp_path):
+    make_queue(tmp_path, "init").fill(list(range(20)))
+    lock = threading.Lock()
+    runs = []
+
+    def work(scope):
+        with lock:
+            runs.append(scope)
+            first_attempt = runs.count(scope) == 1
+        time.sleep(0.002 * scope)
+        if scope % 7 == 0 and first_attempt:
+            raise ValueError(f"scope {scope} failed")
+
+    queues = [make_queue(tmp_path, f"worker{i}") for i in range(3)]
+    threads = [threading.Thread(target=queue.run, args=(work,)) for queue in queues]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(set(runs)) == list(range(20))
+    # every scope runs once, plus one retry of each that failed on its first attempt
+    assert len(runs) == 20 + 3
+    assert queues[0].is_empty()
+    assert len(os.listdir(tmp_path / "queue" / "done")) == 20
+    assert queues[0].failed() == []
+
+
+def test_chunks_give_up_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, "worker", max_attempts=2)
+    queue.fill(["ok", "broken"])
+
+    def work(scope):
+        if scope == "broken":
+            raise ValueError("broken")
+
+    assert queue.run(work) == [1]
+    assert os.listdir(tmp_path / "queue" / "failed") == ["00000001.2.json"]
+
+
+def test_expired_claims_are_taken_back(tmp_path):
+    crashed = make_queue(tmp_path, "crashed", lease_seconds=0.05)
+    crashed.fill(["a", "b"])
+    task = crashed.claim()
+    # the worker dies without releasing its claim, so the heartbeat stops too
+    crashed._release(task)
+    time.sleep(0.2)
+
+    seen = []
+    survivor = make_queue(tmp_path, "survivor", lease_seconds=0.05)
+    assert survivor.run(seen.append) == []
+    assert sorted(seen) == ["a", "b"]
+
+
+def test_heartbeat_keeps_claims_alive(tmp_path):
+    holder = make_queue(tmp_path, "holder", lease_seconds=0.15)
+    holder.fill(["a"])
+    task = holder.claim()
+    time.sleep(0.4)
+
+    other = make_queue(tmp_path, "other", lease_seconds=0.15)
+    assert other.claim() is None
+    holder.complete(task)
+    assert other.is_empty()
+
+
+def test_run_scopes_completes_after_upload(tmp_path):
+    queue = make_queue(tmp_path, "worker")
+    queue.fill([1, 2, 3])
+    uploaded = []
+    attempts = {}
+
+    def upload(scope, result):
+        attempts[scope] = attempts.get(scope, 0) + 1
+        if scope == 2 and attempts[scope] == 1:
+            raise ValueError("upload failed")
+        uploaded.append(result)
+
+    assert queue.run_scopes(lambda scope: scope * 10, lambda scope, data: data + 1, upload) == []
+    assert sorted(uploaded) == [11, 21, 31]
+    assert attempts[2] == 2
+
+
+def test_run_scopes_completes_after_commit(tmp_path):
+    queue = make_queue(tmp_path, "worker")
+    queue.fill([1, 2, 3])
+    done_dir = tmp_path / "queue" / "done"
+    uploaded = []
+    commits = []
+
+    def commit():
+        # nothing is done before the staged uploads are committed
+        assert os.listdir(done_dir) == []
+        commits.append(sorted(uploaded))
+        if len(commits) == 1:
+            uploaded.clear()
+            raise ValueError("merge failed")
+
+    assert queue.run_scopes(lambda scope: scope, lambda scope, data: data, lambda scope, result: uploaded.append(result), commit=commit) == []
+    # the chunks of the failed commit went back to the queue and were uploaded again
+    assert commits == [[1, 2, 3], [1, 2, 3]]
+    assert len(os.listdir(done_dir)) == 3
+
+
+def test_released_claims_are_not_touched_by_heartbeat(tmp_path, monkeypatch):
+    warnings = []
+    monkeypatch.setattr(scopequeue.logger, "warning", warnings.append)
+    queue = make_queue(tmp_path, "worker", lease_seconds=0.01)
+    queue.fill(list(range(200)))
+
+    for task in queue.claims():
+        queue.complete(task)
+
+    assert warnings == []
+    assert len(os.listdir(tmp_path / "queue" / "done")) == 200
+
+
+def test_entries_that_cannot_be_resolved_fail(tmp_path):
+    def resolve(entry):
+        if entry == "missing":
+            raise FileNotFoundError(entry)
+        return entry.upper()
+
+    queue = make_queue(tmp_path, "worker", max_attempts=1, resolve=resolve)
+    queue.fill(["a", "missing", "b"])
+
+    seen = []
+    assert queue.run(seen.append) == [1]
+    assert seen == ["A", "B"]
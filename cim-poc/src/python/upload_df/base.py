@@ -50,23 +50,28 @@ class UploadDFBase:
         return "CIM"
 
     @timer(logger)
-    def merge_ops_locations(self):
+    def merge_ops_locations(self, new_ids_table: str = None):
         """ To avoid duplicated records, first load to temporary table,
-            then get the difference between temp table and destination table, and then insert
+            then get the difference between temp table and destination table, and then insert.
+            With new_ids_table, the IDs of the inserted records are also added to that table of the temp schema.
         """
         column_list = self.ops_columns.copy()
         # column_list.remove("ID")
 
 
+        difference = "SELECT " + ",".join(column_list) + " FROM {}.{} ".format(self.get_temp_table_schema()+os.getenv("RUN_SCHEMA_NAME", ''),
+                                                                               self.temp_table_name) + \
+                     " MINUS " \
+                     "SELECT " + ",".join(column_list) + " FROM {}.{}".format(self.get_destination_table_schema()+os.getenv("RUN_SCHEMA_NAME", ''),
+                                                                              self.get_destination_table_name())
         sql = "INSERT INTO {}.{}".format(self.get_destination_table_schema()+os.getenv("RUN_SCHEMA_NAME", ''),
-                                         self.get_destination_table_name()) + "(" + ",".join(column_list) + ") " \
-              "SELECT " + ",".join(column_list) + " FROM {}.{} ".format(self.get_temp_table_schema()+os.getenv("RUN_SCHEMA_NAME", ''),
-                                                                        self.temp_table_name) + \
-              " MINUS " \
-              "SELECT " + ",".join(column_list) + " FROM {}.{}".format(self.get_destination_table_schema()+os.getenv("RUN_SCHEMA_NAME", ''),
-                                                                       self.get_destination_table_name())
+                                         self.get_destination_table_name()) + "(" + ",".join(column_list) + ") " + difference
 
         with persistence.get_conn() as conn:
+            if new_ids_table is not None:
+                # the same difference as the insert, recorded first so a failed insert is retried with it
+                conn.cursor().execute("INSERT INTO {}.{} (ID) SELECT ID FROM ({})".format(
+                    self.get_temp_table_schema()+os.getenv("RUN_SCHEMA_NAME", ''), new_ids_table, difference))
             # insert records into ops_location that don't yet exist in ops_location
             conn.cursor().execute(sql)
 
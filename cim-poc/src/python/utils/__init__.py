@@ -1,3 +1,6 @@
 from . import scopefiles
 from . import usaddress_util
 from . import mother_query
+from . import pipeline
+from . import scopequeue
+from . import scopemanifest
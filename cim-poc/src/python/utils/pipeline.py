@@ -0,0 +1,166 @@
+"""
+Pipelined scope runner for the generate workflows.
+
+Each scope goes through three stages: fetch (Snowflake round trip), process
+(CPU-bound curation) and upload (Snowflake round trip). run_scopes runs the
+process stage in the calling thread, while the next scopes are fetched and
+finished scopes are uploaded by background threads. Both sides are bounded so
+at most `prefetch` fetched scopes and `max_pending_uploads` processed scopes
+are held in memory at any time.
+
+With more than one process worker, scopes are processed by that many threads
+instead. Curation holds the GIL, so this only pays off when scopes wait on
+something else, e.g. the geocode broker batching their addresses together.
+
+Configuration (environment variables):
+    PIPELINE_PREFETCH_SCOPES        number of scopes fetched ahead of the one being processed
+    PIPELINE_UPLOAD_WORKERS         number of threads uploading processed scopes
+    PIPELINE_MAX_PENDING_UPLOADS    processed scopes waiting for upload before processing blocks
+    PIPELINE_PROCESS_WORKERS        number of scopes processed at the same time
+
+Every thread holds a pooled Snowflake connection while it works, so prefetch +
+upload workers + process workers must fit in SF_POOL_SIZE, see fit_process_workers.
+The generate workflows process several small and medium scopes at a time by default,
+see workflows.generate.process_workers.
+"""
+import itertools
+import os
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from loggers import get_logger
+
+logger = get_logger("PIPELINE")
+
+PREFETCH_SCOPES = int(os.getenv("PIPELINE_PREFETCH_SCOPES", 2))
+UPLOAD_WORKERS = int(os.getenv("PIPELINE_UPLOAD_WORKERS", 1))
+MAX_PENDING_UPLOADS = int(os.getenv("PIPELINE_MAX_PENDING_UPLOADS", 2))
+PROCESS_WORKERS = int(os.getenv("PIPELINE_PROCESS_WORKERS", 1))
+
+
+def fit_process_workers(
+    process_workers: int,
+    pool_size: int,
+    prefetch: int = PREFETCH_SCOPES,
+    upload_workers: int = UPLOAD_WORKERS,
+    strict: bool = False,
+) -> int:
+    """
+    Process workers that get a connection of a pool_size pool next to the prefetch and upload
+    threads. Lowers process_workers to fit, unless strict, and raises ValueError when they
+    do not fit and cannot be lowered.
+    """
+    free = pool_size - max(1, prefetch) - max(1, upload_workers)
+    needed = pool_size - free + max(1, process_workers)
+    if free < 1 or (strict and process_workers > free):
+        raise ValueError(
+            f"{max(1, prefetch)} prefetch, {max(1, upload_workers)} upload and {max(1, process_workers)} process "
+            f"threads need SF_POOL_SIZE={needed}, it is {pool_size}"
+        )
+    if process_workers > free:
+        logger.warning(f"Processing {free} scopes at a time instead of {process_workers}, set SF_POOL_SIZE={needed} to process more")
+    return min(process_workers, free)
+
+
+def run_scopes(
+    scopes,
+    fetch: callable,
+    process: callable,
+    upload: callable,
+    prefetch: int = PREFETCH_SCOPES,
+    upload_workers: int = UPLOAD_WORKERS,
+    max_pending_uploads: int = MAX_PENDING_UPLOADS,
+    on_done: callable = None,
+    process_workers: int = PROCESS_WORKERS,
+) -> list:
+    """
+    Runs upload(scope, process(scope, fetch(scope))) for every scope, overlapping the fetch
+    of the next scopes and the upload of the previous ones with the current process call.
+    process may return None to skip the upload. As in the serial workflows, a failing scope
+    is logged and the others carry on; the scopes that failed are returned.
+
+    scopes can be any iterable, it is only advanced as prefetch slots free up. When given,
+    on_done(scope, error) is called once per scope when it is finished, error being None
+    on success. process is called from the calling thread unless process_workers > 1.
+    """
+    n_scopes = len(scopes) if hasattr(scopes, "__len__") else "?"
+    failed = []
+    failed_lock = threading.Lock()
+    pending_uploads = threading.BoundedSemaphore(max(1, max_pending_uploads))
+    processing = threading.BoundedSemaphore(max(1, process_workers))
+
+    def done(scope, error=None):
+        if error is not None:
+            logger.error(f"EXCEPTION: {error}")
+            traceback.print_exception(type(error), error, error.__traceback__)
+            with failed_lock:
+                failed.append(scope)
+        if on_done is not None:
+            on_done(scope, error)
+
+    def upload_scope(scope, result):
+        try:
+            upload(scope, result)
+        except Exception as e:
+            done(scope, e)
+        else:
+            done(scope)
+        finally:
+            pending_uploads.release()
+
+    def process_scope(scope, future):
+        try:
+            result = process(scope, future.result())
+        except Exception as e:
+            done(scope, e)
+            return
+        # drop our reference so the fetched data can be freed while the scope uploads
+        del future
+
+        if result is None:
+            done(scope)
+            return
+        pending_uploads.acquire()
+        uploader.submit(upload_scope, scope, result)
+
+    def process_scope_in_worker(scope, future):
+        try:
+            process_scope(scope, future)
+        finally:
+            processing.release()
+
+    # the processor is shut down first, as it still hands scopes to the uploader
+    with ThreadPoolExecutor(max_workers=max(1, prefetch), thread_name_prefix="prefetch") as fetcher, \
+            ThreadPoolExecutor(max_workers=max(1, upload_workers), thread_name_prefix="upload") as uploader, \
+            ThreadPoolExecutor(max_workers=max(1, process_workers), thread_name_prefix="process") as processor:
+        to_fetch = iter(scopes)
+        fetched = deque()
+
+        def fetch_next():
+            for scope in itertools.islice(to_fetch, 1):
+                fetched.append((scope, fetcher.submit(fetch, scope)))
+
+        for _ in range(max(1, prefetch)):
+            fetch_next()
+
+        i = 0
+        while len(fetched) > 0:
+            scope, future = fetched.popleft()
+            if process_workers > 1:
+                processing.acquire()
+            # the slot freed by this scope goes to the next one right away
+            fetch_next()
+            i += 1
+            logger.info(f"Working on {i}/{n_scopes}")
+
+            if process_workers > 1:
+                processor.submit(process_scope_in_worker, scope, future)
+            else:
+                process_scope(scope, future)
+            del future
+
+    if len(failed) > 0:
+        logger.warning(f"{len(failed)}/{i} scopes failed")
+    return failed
@@ -1,30 +1,93 @@
+import heapq
+import json
+import os
+
 import numpy as np
 import pandas as pd
-import pickle
 
 import scopes
 from environment import SCOPES_DIR
 from loggers import get_logger, timer
+from utils.scopemanifest import ScopeManifest, chunk_entry, write_manifest
+from utils.scopequeue import stage_queue
 
 logger = get_logger("SCOPEFILES")
 
-
-def get_name(identifier: str, group: str, pid: int) -> str:
+# estimated cost of a scope from the SIZE column of its size method
+COST_MODELS = {
+    # curation is dominated by sorting and grouping the dims of the scope
+    "get_dim_sizes": lambda size: size * np.log2(size + 2),
+    "get_ops_sizes": lambda size: size * np.log2(size + 2),
+    # SIZE is already N_OPS * N_DIM, the number of candidate pairs to match
+    "get_match_sizes": lambda size: size,
+}
+# without an explicit chunk_cost, a pod is split into at least this many chunks
+MIN_CHUNKS_PER_POD = int(os.getenv("SCOPE_MIN_CHUNKS_PER_POD", 4))
+# stages draining their own copy of the work queue, one after the other
+QUEUE_STAGES = ["generate", "associate"]
+
+
+def get_name(identifier: str, group: str, pid: int, extension: str = "arrow") -> str:
     base = f"{SCOPES_DIR}/{identifier}_scopes"
     if group is None and pid is None:
-        return f"{base}.pkl"
+        return f"{base}.{extension}"
     elif group is None:
-        return f"{base}_{pid}.pkl"
+        return f"{base}_{pid}.{extension}"
     elif pid is None:
-        return f"{base}_{group}.pkl"
+        return f"{base}_{group}.{extension}"
     else:
-        return f"{base}_{group}_{pid}.pkl"
-
-def load(identifier: str, group: str, pid: int):
-    file = get_name(identifier, group, pid)
-    with open(file, "rb") as f:
-        scopes = pickle.load(f)
-    return scopes
+        return f"{base}_{group}_{pid}.{extension}"
+
+
+def lpt_assign(costs: np.ndarray, n_bins: int) -> np.ndarray:
+    """
+    Longest processing time first: hands the items out in decreasing cost, each to the
+    currently cheapest bin. Returns the bin of every item.
+    """
+    bins = np.zeros(len(costs), dtype=int)
+    loads = [(0.0, b) for b in range(n_bins)]
+    for i in np.argsort(-np.asarray(costs, dtype=float), kind="stable"):
+        load, b = heapq.heappop(loads)
+        bins[i] = b
+        heapq.heappush(loads, (load + costs[i], b))
+    return bins
+
+
+def chunk_bounds(costs: np.ndarray, chunk_size: int, chunk_cost: float) -> list:
+    """
+    Splits a sequence of items into contiguous chunks of at most chunk_size items whose
+    summed cost stays within chunk_cost. An item costlier than chunk_cost gets its own chunk.
+    Returns (start, stop) pairs.
+    """
+    bounds = []
+    start, total = 0, 0.0
+    for i, cost in enumerate(costs):
+        if i > start and (i - start >= chunk_size or total + cost > chunk_cost):
+            bounds.append((start, i))
+            start, total = i, 0.0
+        total += cost
+    if start < len(costs):
+        bounds.append((start, len(costs)))
+    return bounds
+
+
+def load(identifier: str, group: str, pid: int) -> ScopeManifest:
+    """ Scopes of a pod, as a sequence that only reads and builds a chunk's scope when accessed """
+    return ScopeManifest(get_name(identifier, group, pid))
+
+
+def write_run_info(identifier: str, **info):
+    """ Records how the scopes of identifier were initialized, for the tasks that run after them """
+    with open(get_name(identifier, None, None, "json"), "w") as f:
+        json.dump(info, f)
+
+
+def read_run_info(identifier: str) -> dict:
+    path = get_name(identifier, None, None, "json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, run initialize first")
+    with open(path) as f:
+        return json.load(f)
 
 
 class ScopePickler():
@@ -37,6 +100,8 @@ class ScopePickler():
         identifier: str = None,
         scope_class: scopes.ScopeBase = None,
         max_scopes: int = None,
+        cost_model: callable = None,
+        queue: bool = False,
     ):
         self.incremental = incremental
         self.min_size = min_size
@@ -45,6 +110,8 @@ class ScopePickler():
         self.scope_class = scope_class
         self.identifier = identifier
         self.max_scopes = max_scopes
+        self.cost_model = cost_model or COST_MODELS.get(size_method, lambda size: size)
+        self.queue = queue
 
 
     @timer(logger)
@@ -87,20 +154,70 @@ class ScopePickler():
                 df.drop(["GROUP"], axis=1).sample(frac=1.0),
                 group_defs[group]["n_parallel"],
                 group,
-                group_defs[group]["chunk_size"]
+                group_defs[group]["chunk_size"],
+                group_defs[group].get("chunk_cost")
             )
 
-    def _split_and_pickle(self, scope_sizes: pd.DataFrame, n_parallel: int, group: str, chunk_size: int):
-        pod_scope_dfs = np.array_split(scope_sizes.drop("SIZE", axis=1), n_parallel)
-
-        pod_scopes = [
-            [
-                self.scope_class.from_dataframe(pod.iloc[i:i+chunk_size], incremental=self.incremental)
-                for i in range(0, len(pod), chunk_size)
+    def plan_chunks(
+        self,
+        scope_sizes: pd.DataFrame,
+        n_parallel: int,
+        chunk_size: int,
+        chunk_cost: float = None,
+    ) -> list:
+        """
+        Balances the estimated cost of the scopes across n_parallel pods, then cuts the scopes
+        of every pod, costliest first, into chunks of at most chunk_size scopes and chunk_cost.
+        Returns the list of chunks, dataframes of scope keys and SIZE, of every pod.
+        """
+        costs = self.cost_model(scope_sizes["SIZE"].astype(float).to_numpy())
+        pods = lpt_assign(costs, n_parallel)
+        if chunk_cost is None:
+            chunk_cost = max(costs.max(initial=0.0), costs.sum() / max(1, n_parallel * MIN_CHUNKS_PER_POD))
+
+        pod_chunks = []
+        for i in range(n_parallel):
+            in_pod = np.flatnonzero(pods == i)
+            in_pod = in_pod[np.argsort(-costs[in_pod], kind="stable")]
+            pod = scope_sizes.iloc[in_pod]
+            pod_chunks.append([
+                pod.iloc[start:stop]
+                for start, stop in chunk_bounds(costs[in_pod], chunk_size, chunk_cost)
+            ])
+            logger.info(f"Pod {i}: {len(pod)} scopes in {len(pod_chunks[-1])} chunks, cost {costs[in_pod].sum():.3g}")
+        return pod_chunks
+
+    def _split_and_pickle(
+        self,
+        scope_sizes: pd.DataFrame,
+        n_parallel: int,
+        group: str,
+        chunk_size: int,
+        chunk_cost: float = None,
+    ):
+        """
+        Writes the chunks planned for every pod to the pod's scope manifest.
+        With queue=True, references to the chunks of all pods also go to the work queue of every
+        stage of the group, costliest first, for workers that pull chunks instead of reading a pod manifest.
+        """
+        pod_chunks = self.plan_chunks(scope_sizes, n_parallel, chunk_size, chunk_cost)
+
+        entries = []
+        for i, chunks in enumerate(pod_chunks):
+            entries += [
+                (chunk_entry(get_name(self.identifier, group, i), k), chunk)
+                for k, chunk in enumerate(chunks)
             ]
-            for pod in pod_scope_dfs
-        ]
+            write_manifest(
+                get_name(self.identifier, group, i),
+                chunks,
+                template=scope_sizes,
+                scope_class=self.scope_class,
+                incremental=self.incremental,
+                group=group,
+            )
 
-        for i, pod_scope in enumerate(pod_scopes):
-            with open(get_name(self.identifier, group, i), "wb") as f:
-                pickle.dump(pod_scope, f)
\ No newline at end of file
+        if self.queue:
+            entries.sort(key=lambda entry: -self.cost_model(entry[1]["SIZE"].astype(float).to_numpy()).sum())
+            for stage in QUEUE_STAGES:
+                stage_queue(self.identifier, stage, group).fill([entry for entry, _ in entries])
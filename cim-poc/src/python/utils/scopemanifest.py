@@ -0,0 +1,86 @@
+"""
+Columnar scope manifests.
+
+A manifest is an Arrow IPC file holding the scope keys and SIZE of a pod's scopes,
+one record batch per chunk. The scope class, incremental flag and group are kept in
+the schema metadata, so scopes are only built, with a fresh environment, when a
+worker asks for them. The file is memory mapped and chunk k is read from its batch
+offset in the footer, without reading the other chunks.
+"""
+import os
+
+import pandas as pd
+
+import scopes
+
+SIZE_COLUMN = "SIZE"
+
+
+def write_manifest(
+    path: str,
+    chunks: list,
+    template: pd.DataFrame,
+    scope_class: type,
+    incremental: bool,
+    group: str = None,
+):
+    """ Writes the chunks, dataframes with the columns and types of template, as one record batch each """
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(template, preserve_index=False).with_metadata({
+        "scope_class": scope_class.__name__,
+        "incremental": "true" if incremental else "false",
+        "group": "" if group is None else str(group),
+    })
+
+    tmp = f"{path}.tmp"
+    with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for chunk in chunks:
+            writer.write_batch(pa.RecordBatch.from_pandas(chunk[template.columns], schema=schema, preserve_index=False))
+    os.replace(tmp, path)
+
+
+class ScopeManifest:
+    """ Read-only sequence of the scopes of a manifest, built on access """
+
+    def __init__(self, path: str):
+        import pyarrow as pa
+
+        self.path = path
+        self._reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+        metadata = {k.decode(): v.decode() for k, v in (self._reader.schema.metadata or {}).items()}
+        self.scope_class = getattr(scopes, metadata["scope_class"])
+        self.incremental = metadata["incremental"] == "true"
+        self.group = metadata.get("group") or None
+
+    def __len__(self) -> int:
+        return self._reader.num_record_batches
+
+    def chunk(self, k: int) -> pd.DataFrame:
+        """ Scope keys and SIZE of chunk k """
+        return self._reader.get_batch(range(len(self))[k]).to_pandas()
+
+    def __getitem__(self, k: int):
+        return self.scope_class.from_manifest(self, k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+
+def chunk_entry(path: str, k: int) -> dict:
+    """ Queue entry of chunk k of the manifest at path """
+    return {"manifest": path, "chunk": k}
+
+
+class ManifestScopes:
+    """ Builds the scope of a chunk_entry, opening every manifest once """
+
+    def __init__(self):
+        self._manifests = {}
+
+    def __call__(self, entry: dict):
+        path = entry["manifest"]
+        if path not in self._manifests:
+            self._manifests[path] = ScopeManifest(path)
+        return self._manifests[path][entry["chunk"]]
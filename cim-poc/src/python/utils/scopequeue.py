@@ -0,0 +1,314 @@
+"""
+Work-stealing queue of scope chunks on the shared scopes volume.
+
+Instead of a manifest of chunks per pod, every chunk gets its own small JSON entry and
+workers claim them one at a time until the queue is empty, so a pod that finishes
+early keeps pulling work instead of idling. An entry of a stage queue only references
+a chunk of a pod manifest, the worker builds its scope from the manifest with a fresh
+environment. All state lives in the file names and moves between directories with
+os.rename, which is atomic on the shared volume:
+
+    pending/<index>.<attempt>.json           waiting to be claimed, lowest index first
+    claimed/<index>.<attempt>.<worker>.json  leased by a worker, its mtime is the heartbeat
+    done/<index>.json                        finished
+    failed/<index>.<attempt>.json            gave up after MAX_ATTEMPTS
+
+A claim whose heartbeat is older than the lease is considered lost with its worker and
+goes back to pending. A chunk that raises goes back to pending for another attempt.
+Every stage of a run (e.g. generate, then associate) drains its own queue, see stage_queue.
+
+Configuration (environment variables):
+    SCOPE_QUEUE_LEASE_SECONDS       heartbeat age after which a claim is taken back
+    SCOPE_QUEUE_MAX_ATTEMPTS        attempts of a chunk before it is moved to failed
+    SCOPE_QUEUE_POLL_SECONDS        wait between checks for work while others hold claims
+"""
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from environment import SCOPES_DIR
+from loggers import get_logger
+from utils import pipeline
+from utils.scopemanifest import ManifestScopes
+
+logger = get_logger("SCOPEQUEUE")
+
+LEASE_SECONDS = float(os.getenv("SCOPE_QUEUE_LEASE_SECONDS", 300))
+MAX_ATTEMPTS = int(os.getenv("SCOPE_QUEUE_MAX_ATTEMPTS", 3))
+POLL_SECONDS = float(os.getenv("SCOPE_QUEUE_POLL_SECONDS", 30))
+
+STATES = ["pending", "claimed", "done", "failed"]
+
+
+def get_queue_dir(identifier: str, group: str) -> str:
+    base = f"{SCOPES_DIR}/{identifier}_queue"
+    return base if group is None else f"{base}_{group}"
+
+
+def stage_queue(identifier: str, stage: str, group: str = None) -> "ScopeQueue":
+    """
+    The queue of one stage of the run, filled with the same manifest chunks as the other stages,
+    see ManifestScopes for its entries
+    """
+    return ScopeQueue(f"{identifier}_{stage}", group, resolve=ManifestScopes())
+
+
+def default_worker() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}".replace(".", "-")
+
+
+class Task:
+    """ A claimed chunk of scopes, entry as queued and scope as resolved from it """
+
+    def __init__(self, index: int, attempt: int, path: str, entry, scope):
+        self.index = index
+        self.attempt = attempt
+        self.path = path
+        self.entry = entry
+        self.scope = scope
+
+
+class ScopeQueue:
+
+    def __init__(
+        self,
+        identifier: str,
+        group: str = None,
+        worker: str = None,
+        lease_seconds: float = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+        poll_seconds: float = POLL_SECONDS,
+        directory: str = None,
+        resolve: callable = None,
+    ):
+        """ resolve(entry) builds the scope of a claimed entry, the scope is the entry itself by default """
+        self.directory = directory or get_queue_dir(identifier, group)
+        self.resolve = resolve
+        self.worker = worker or default_worker()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._heartbeat = None
+
+    def _dir(self, state: str) -> str:
+        return os.path.join(self.directory, state)
+
+    def _list(self, state: str) -> list:
+        try:
+            return sorted(os.listdir(self._dir(state)))
+        except FileNotFoundError:
+            return []
+
+    def fill(self, entries: list):
+        """ Replaces the content of the queue with JSON serializable entries, claimed in the given order """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        for state in STATES:
+            os.makedirs(self._dir(state))
+        for index, entry in enumerate(entries):
+            tmp = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            os.rename(tmp, os.path.join(self._dir("pending"), f"{index:08d}.0.json"))
+        logger.info(f"Queued {len(entries)} scope chunks in {self.directory}")
+
+    def _move(self, src: str, index: int, attempt: int, reason: str) -> bool:
+        """ Sends a claim back to pending for a next attempt, or to failed when out of attempts """
+        if attempt < self.max_attempts:
+            dst = os.path.join(self._dir("pending"), f"{index:08d}.{attempt}.json")
+        else:
+            dst = os.path.join(self._dir("failed"), f"{index:08d}.{attempt}.json")
+            logger.error(f"Scope chunk {index} failed after {attempt} attempts: {reason}")
+        try:
+            os.rename(src, dst)
+        except FileNotFoundError:
+            # another worker got to it first
+            return False
+        return True
+
+    def reclaim_expired(self):
+        """ Takes back the claims whose heartbeat stopped """
+        now = time.time()
+        for name in self._list("claimed"):
+            path = os.path.join(self._dir("claimed"), name)
+            try:
+                age = now - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age > self.lease_seconds:
+                index, attempt, worker, _ = name.split(".")
+                if self._move(path, int(index), int(attempt) + 1, f"lease of {worker} expired"):
+                    logger.warning(f"Took back scope chunk {index} from {worker}, no heartbeat for {age:.0f}s")
+
+    def claim(self):
+        """ Claims the next pending chunk, returns None when nothing is pending """
+        self.reclaim_expired()
+        for name in self._list("pending"):
+            index, attempt, _ = name.split(".")
+            src = os.path.join(self._dir("pending"), name)
+            dst = os.path.join(self._dir("claimed"), f"{index}.{attempt}.{self.worker}.json")
+            try:
+                # rename keeps the mtime, so refresh it first or the claim could look expired
+                os.utime(src)
+                os.rename(src, dst)
+            except FileNotFoundError:
+                continue
+            with open(dst) as f:
+                entry = json.load(f)
+            task = Task(int(index), int(attempt), dst, entry, None)
+            with self._held_lock:
+                self._held[task.index] = task
+                self._start_heartbeat()
+            try:
+                task.scope = entry if self.resolve is None else self.resolve(entry)
+            except Exception as e:
+                logger.error(f"Could not build the scope of chunk {task.index}: {e}")
+                self.fail(task, e)
+                continue
+            return task
+        return None
+
+    def claims(self):
+        """ Yields claimed chunks until nothing is pending """
+        while True:
+            task = self.claim()
+            if task is None:
+                return
+            yield task
+
+    def _start_heartbeat(self):
+        # called with _held_lock held, the heartbeat only stops under the same lock
+        if self._heartbeat is not None:
+            return
+        self._heartbeat = threading.Thread(target=self._beat, name="scopequeue-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            # the claims are touched under the lock, so a released claim is never touched
+            # again once _release returns and can be renamed without racing the heartbeat
+            with self._held_lock:
+                if len(self._held) == 0:
+                    self._heartbeat = None
+                    return
+                for task in self._held.values():
+                    try:
+                        os.utime(task.path)
+                    except FileNotFoundError:
+                        logger.warning(f"Lost the claim of scope chunk {task.index}")
+            time.sleep(self.lease_seconds / 3)
+
+    def _release(self, task: Task):
+        with self._held_lock:
+            self._held.pop(task.index, None)
+
+    def complete(self, task: Task):
+        self._release(task)
+        try:
+            os.rename(task.path, os.path.join(self._dir("done"), f"{task.index:08d}.json"))
+        except FileNotFoundError:
+            logger.warning(f"Scope chunk {task.index} finished after its claim was taken back")
+
+    def fail(self, task: Task, error: Exception = None):
+        self._release(task)
+        self._move(task.path, task.index, task.attempt + 1, repr(error))
+
+    def done(self, task: Task, error: Exception = None):
+        if error is None:
+            self.complete(task)
+        else:
+            self.fail(task, error)
+
+    def commit(self, tasks: list, commit: callable):
+        """ Calls commit() and completes the tasks once it returned, or fails them if it raises """
+        if len(tasks) == 0:
+            return
+        try:
+            commit()
+        except Exception as e:
+            logger.error(f"EXCEPTION: {e}")
+            traceback.print_exc()
+            for task in tasks:
+                self.fail(task, e)
+        else:
+            for task in tasks:
+                self.complete(task)
+
+    def is_empty(self) -> bool:
+        return len(self._list("pending")) == 0 and len(self._list("claimed")) == 0
+
+    def failed(self) -> list:
+        return [int(name.split(".")[0]) for name in self._list("failed")]
+
+    def drain(self, run: callable) -> list:
+        """
+        Calls run(tasks) with an iterable of claims, which must complete or fail each of them,
+        until the queue is empty. While other workers hold claims, it waits for them as they
+        can still come back for a retry. Returns the indices of the chunks that failed for good.
+        """
+        while True:
+            run(self.claims())
+            if self.is_empty():
+                break
+            time.sleep(self.poll_seconds)
+
+        failed = self.failed()
+        if len(failed) > 0:
+            logger.error(f"{len(failed)} scope chunks failed in {self.directory}: {failed}")
+        return failed
+
+    def run(self, func: callable) -> list:
+        """ Calls func(scope) for every chunk of the queue """
+        def run_tasks(tasks):
+            for task in tasks:
+                logger.info(f"Working on scope chunk {task.index}, attempt {task.attempt + 1}")
+                try:
+                    func(task.scope)
+                except Exception as e:
+                    logger.error(f"EXCEPTION: {e}")
+                    traceback.print_exc()
+                    self.fail(task, e)
+                else:
+                    self.complete(task)
+
+        return self.drain(run_tasks)
+
+    def run_scopes(
+        self,
+        fetch: callable,
+        process: callable,
+        upload: callable,
+        commit: callable = None,
+        **kws
+    ) -> list:
+        """
+        pipeline.run_scopes over the chunks of the queue. When upload only stages the results,
+        commit() makes them durable: the chunks uploaded in a round keep their claims until
+        commit returned, so they are retried if the worker dies before.
+        """
+        def run_tasks(tasks):
+            uploaded = []
+
+            def done(task, error=None):
+                if error is None and commit is not None:
+                    uploaded.append(task)
+                else:
+                    self.done(task, error)
+
+            pipeline.run_scopes(
+                tasks,
+                lambda task: fetch(task.scope),
+                lambda task, data: process(task.scope, data),
+                lambda task, result: upload(task.scope, result),
+                on_done=done,
+                **kws
+            )
+            self.commit(uploaded, commit)
+
+        return self.drain(run_tasks)
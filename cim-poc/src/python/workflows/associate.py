@@ -4,6 +4,7 @@ import traceback
 import association_wizard as aw
 from loggers import get_logger
 from utils import scopefiles
+from utils.scopequeue import stage_queue
 
 logger = get_logger("ASSOCIATE")
 
@@ -44,14 +45,21 @@ def build_associations_keepstock(
 def build_associations(
     pid: int = None,
     group: str = None,
+    queue: bool = False,
 ):
+    nchunks = 100 if group == "large" else 1
+    if queue:
+        # failing chunks go back to the queue for another attempt instead of being logged and lost
+        stage_queue("salesorder", "associate", group).run(lambda scope: aw.AssociationSalesOrder(scope).run(nchunks=nchunks))
+        return
+
     _scopes = scopefiles.load("salesorder", group, pid)
    
     n_scopes = len(_scopes)
     for i, scope in enumerate(_scopes):
         logger.info(f"{i+1}/{n_scopes}")
         try:
-            aw.AssociationSalesOrder(scope).run(nchunks=100 if group == "large" else 1)
+            aw.AssociationSalesOrder(scope).run(nchunks=nchunks)
         except Exception as e:
             logger.error(e)
             traceback.print_exc()
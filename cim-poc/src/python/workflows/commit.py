@@ -3,15 +3,21 @@ import ops_clustering
 import association_wizard as aw
 import populate_bridge_location
 from loggers import get_logger
+from utils import scopefiles
 
 
 logger = get_logger("COMMIT")
 
 
 def populate_bridge_table():
-    logger.info("Clearing existing clusters")
-    # TODO: figure out a better way to do incremental clustering
-    ops_clustering.delete_ops_location_clusters()
+    # the mode of the run is the one the salesorder scopes were initialized with
+    incremental = scopefiles.read_run_info("salesorder")["incremental"]
+    logger.info(f"Populating bridge table, incremental={incremental}")
+    if not incremental:
+        logger.info("Clearing existing clusters")
+        ops_clustering.delete_ops_location_clusters()
+    # incremental runs already applied their parent inserts, updates and deletes
+    # in generate_parent_ops_locations (see ops_clustering.cluster_ops_incremental)
     logger.info("Committing new clusters")
     ops_clustering.commit_clusters()
     logger.info("Populating BRG_OPS_LOCATION")
@@ -1,55 +1,103 @@
+import os
 import pickle
+from functools import partial
 import pandas as pd
 import traceback
 
 
 from utils import scopefiles
+from utils.scopequeue import stage_queue
 from loggers import get_logger
 from flag_residence import flag_residential_df
 import curation_wizard as cw
+import geocode
 import ops_clustering as oc
 import persistence
+from utils import pipeline
 from upload_df import UploadOpsLocation, UploadOpsSoldToLocation
 
 logger = get_logger("GENERATE")
 
+# scopes curated at the same time by default, so the geocode broker batches their addresses
+# together. Small and medium scopes mostly wait on geocoding, large ones are CPU bound.
+GROUP_PROCESS_WORKERS = {"small": 4, "medium": 2}
+
+
+def fetch_dim(scope):
+    return scope.get_dim()
+
+
+def geocode_producer(curate: callable) -> callable:
+    """ Registers the scopes being curated with the geocode broker, which holds partial batches for them """
+    def curate_scope(scope, dim_df):
+        with geocode.broker.producer():
+            return curate(scope, dim_df)
+
+    return curate_scope
+
+
+def process_workers(group: str) -> int:
+    """
+    Scopes of the group processed at the same time, PIPELINE_PROCESS_WORKERS when set.
+    Each of them takes a pooled connection for its geocode cache lookups, on top of the
+    prefetch and upload threads, e.g. small scopes need SF_POOL_SIZE=7 with the default
+    prefetch and upload workers. The group default is lowered to fit SF_POOL_SIZE, while
+    a PIPELINE_PROCESS_WORKERS that does not fit raises ValueError.
+    """
+    if "PIPELINE_PROCESS_WORKERS" in os.environ:
+        return pipeline.fit_process_workers(pipeline.PROCESS_WORKERS, persistence.POOL_SIZE, strict=True)
+    return pipeline.fit_process_workers(GROUP_PROCESS_WORKERS.get(group, 1), persistence.POOL_SIZE)
+
+
+def run_salesorder_scopes(group: str, pid: int, queue: bool, curate: callable, load: callable, merge: callable):
+    """
+    Runs the pod's pickled scopes, or pulls chunks from the group's generate queue until it is empty.
+    load stages the locations and merge commits them, queued chunks are only done once merged.
+    """
+    workers = process_workers(group)
+
+    if queue:
+        stage_queue("salesorder", "generate", group).run_scopes(
+            fetch_dim, geocode_producer(curate), load, commit=merge, process_workers=workers
+        )
+    else:
+        pipeline.run_scopes(
+            scopefiles.load("salesorder", group, pid), fetch_dim, geocode_producer(curate), load, process_workers=workers
+        )
+        merge()
+
 
 def generate_ops_locations_small(
     group: str = "small",
     pid: int = None,
+    queue: bool = False,
 ):
     logger.info(f"Generating OPS locations: pid {pid}")
-    _scopes = scopefiles.load("salesorder", group, pid)
-
-    n_scopes = len(_scopes)
 
     uploader = UploadOpsLocation()
 
-    for i, scope in enumerate(_scopes):
-        logger.info(f"Working on {i+1}/{n_scopes}")
-
-        try:
-            ops_df = cw.CurationSalesOrder(scope).autocurate(
-                auto_label=True,
-                simple_mode=True,
-            )
+    def curate(scope, dim_df):
+        ops_df = cw.CurationSalesOrder(scope).autocurate(
+            auto_label=True,
+            simple_mode=True,
+            dim_df=dim_df,
+        )
 
-            if ops_df is not None and len(ops_df) > 0:
-                # logger.info(f"Flagging residential locations {organization} @ {state}")
-                # ops_df = flag_residential_df(ops_df)
-                ops_df = ops_df.assign(IS_RESIDENTIAL=pd.NA)
+        if ops_df is None or len(ops_df) == 0:
+            logger.warning("No OPS locations to load")
+            return None
+        return ops_df
 
-                logger.info(f"Loading ops locations")
+    def load(scope, ops_df):
+        # logger.info(f"Flagging residential locations {organization} @ {state}")
+        # ops_df = flag_residential_df(ops_df)
+        ops_df = ops_df.assign(IS_RESIDENTIAL=pd.NA)
 
-                uploader.upload_ops_location_preload_temp_table(ops_df)
+        logger.info(f"Loading ops locations")
 
-            else:
-                logger.warning("No OPS locations to load")
-        except Exception as e:
-            logger.error("EXCEPTION: ", e)
-            traceback.print_exc()
+        uploader.upload_ops_location_preload_temp_table(ops_df)
 
-    uploader.merge_ops_locations()
+    run_salesorder_scopes(group, pid, queue, curate, load, partial(uploader.merge_ops_locations, new_ids_table=oc.NEW_OPS_TABLE))
 
     logger.info("Done.")
 
@@ -57,38 +105,35 @@ def generate_ops_locations_small(
 def generate_ops_locations(
     group: str = None,
     pid: int = None,
+    queue: bool = False,
 ):
     logger.info(f"Generating OPS locations: pid {pid}")
-    _scopes = scopefiles.load("salesorder", group, pid)
-
-    n_scopes = len(_scopes)
 
     uploader = UploadOpsLocation()
 
-    for i, scope in enumerate(_scopes):
-        logger.info(f"Working on {i+1}/{n_scopes}")
-
-        try:
-            ops_df = cw.CurationSalesOrder(scope).autocurate(
-                auto_label=True,
-                simple_mode=False
-            )
+    def curate(scope, dim_df):
+        ops_df = cw.CurationSalesOrder(scope).autocurate(
+            auto_label=True,
+            simple_mode=False,
+            dim_df=dim_df,
+        )
 
-            if ops_df is not None and len(ops_df) > 0:
-                logger.info(f"Flagging residential locations")
-                ops_df = flag_residential_df(ops_df)
+        if ops_df is None or len(ops_df) == 0:
+            logger.warning("No OPS locations to load")
+            return None
+        return ops_df
 
-                logger.info(f"Loading")
+    def load(scope, ops_df):
+        # residential flagging is a round trip to the address services, so it overlaps
+        # with the curation of the next scope as well
+        logger.info(f"Flagging residential locations")
+        ops_df = flag_residential_df(ops_df)
 
-                uploader.upload_ops_location_preload_temp_table(ops_df)
+        logger.info(f"Loading")
 
-            else:
-                logger.warning("No OPS locations to load")
-        except Exception as e:
-            logger.error("EXCEPTION: ", e)
-            traceback.print_exc()
+        uploader.upload_ops_location_preload_temp_table(ops_df)
 
-    uploader.merge_ops_locations()
+    run_salesorder_scopes(group, pid, queue, curate, load, partial(uploader.merge_ops_locations, new_ids_table=oc.NEW_OPS_TABLE))
 
     logger.info("Done.")
 
@@ -97,24 +142,20 @@ def generate_ops_soldto_locations(
     pid: int = None,
 ):
     _scopes = scopefiles.load("soldto", None, pid)
-    
-    nscopes = len(_scopes)
 
     uploader = UploadOpsSoldToLocation()
 
-    for i, scope in enumerate(_scopes):
-        logger.info(f"Working on {i+1}/{nscopes}")
-        try:
-            ops_df =cw.CurationSoldToAccount(scope).autocurate(
-                simple_mode=False,
-                auto_label=True,
-            )
+    def curate(scope, dim_df):
+        return cw.CurationSoldToAccount(scope).autocurate(
+            simple_mode=False,
+            auto_label=True,
+            dim_df=dim_df,
+        )
 
-            uploader.upload_ops_location_preload_temp_table(ops_df)
+    def load(scope, ops_df):
+        uploader.upload_ops_location_preload_temp_table(ops_df)
 
-        except Exception as e:
-            logger.error(e)
-            traceback.print_exc()
+    pipeline.run_scopes(_scopes, fetch_dim, geocode_producer(curate), load)
 
     uploader.merge_ops_locations()
 
@@ -129,17 +170,18 @@ def generate_parent_ops_locations(
     uploader = UploadOpsLocation()
 
     nscopes = len(_scopes)
-    for i, scope in enumerate(_scopes):
-        logger.info(f"Working on {i+1}/{nscopes}")
-
-        try:
-            
-            cluster_df = oc.cluster_ops_from_snowflake(scope)
-            if cluster_df is not None and len(cluster_df) > 0:
-                uploader.upload_ops_location_preload_temp_table(cluster_df)
-
-        except Exception as e:
-            logger.error("EXCEPTION: " + e)
-            traceback.print_exc()
+    # the workers are spawned once for all the scopes of the pod
+    with oc.cluster_pool() as pool:
+        for i, scope in enumerate(_scopes):
+            logger.info(f"Working on {i+1}/{nscopes}")
+
+            try:
+
+                # parents are written to the uploader's preload table as partitions finish
+                oc.cluster_ops_from_snowflake(scope, uploader=uploader, pool=pool)
+
+            except Exception as e:
+                logger.error("EXCEPTION: " + e)
+                traceback.print_exc()
     
     uploader.merge_ops_locations()
@@ -21,14 +21,18 @@ def salesorder(
     min_dims_medium: int = None,
     max_dims_medium: int = None,
     incremental: bool = True,
+    queue: bool = False,
 ):
     """ Resets ops, imports curated accounts, and pickles scopes for downstream tasks """
 
     association_wizard.AssociationSalesOrder().clear_associations()  # clears temp table
     ops_clustering.clear_cluster_temp_table()                        # clears temp table
+    ops_clustering.clear_new_ops_table()                             # clears the OPS rows new to the run
 
     if not incremental:
         ops_entities.reset_ops_locations()
+    # populate_bridge_table clears every site unless the run is incremental
+    scopefiles.write_run_info("salesorder", incremental=incremental)
 
     pickler = scopefiles.ScopePickler(
         identifier="salesorder",
@@ -36,6 +40,7 @@ def salesorder(
         scope_class=scopes.ScopeSalesOrderOrgIdState,
         size_method="get_dim_sizes",
         max_scopes=max_scopes,
+        queue=queue,
     )
 
     group_defs = {